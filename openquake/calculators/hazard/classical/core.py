@@ -19,6 +19,7 @@
 """Core functionality for Classical PSHA-based hazard calculations."""
 
 
+import functools
 import json
 import random
 import time
@@ -534,9 +535,12 @@ class ClassicalHazardCalculator(general.BaseHazardCalculator):
                 # No results found, increase the sleep pause.
                 pause = pgen.next()
             else:
-                hazard_output.SerializerContext().update(
-                    xsc._replace(i_next=len(hc_data)))
-                curve_writer.serialize(hc_data)
+                # the curves are serialized in the background, with the XML
+                # serialization context of this batch
+                self.calc_proxy.result_sink.submit(
+                    nrml_path, curve_writer, hc_data, functools.partial(
+                        hazard_output.SerializerContext().update,
+                        xsc._replace(i_next=len(hc_data))))
                 xsc = xsc._replace(i_done=xsc.i_done + len(hc_data))
                 pause *= 0.8
                 pause = min_pause if pause < min_pause else pause
@@ -638,8 +642,9 @@ class ClassicalHazardCalculator(general.BaseHazardCalculator):
                          stats.pk_get(self.calc_proxy.job_id, "blocks"),
                          stats.pk_get(self.calc_proxy.job_id, "cblock"),
                          len(sites), 0, len(hm_data))
-        hazard_output.SerializerContext().update(xsc)
-        map_writer.serialize(hm_data)
+        self.calc_proxy.result_sink.submit(
+            nrml_path, map_writer, hm_data, functools.partial(
+                hazard_output.SerializerContext().update, xsc))
 
         return nrml_path
 
@@ -117,13 +117,24 @@ def save_5d_matrix_to_h5(directory, matrix):
     :param str directory: directory where the hdf5 file shall be saved
     :param matrix: 5-dimensional :class:`numpy.ndarray`
 
+    The matrix is stored compressed, one latitude bin per chunk, so that
+    subset extraction tasks can read it a slab at a time (see
+    :func:`openquake.calculators.hazard.disagg.subsets.extract_subsets`).
+
     :returns: full path (including filename) where the hdf5 file was saved
     """
     file_name = '%s.h5' % str(uuid.uuid4())
     file_path = os.path.join(directory, file_name)
 
     with h5py.File(file_path, 'w') as target:
-        target.create_dataset(FULL_DISAGG_MATRIX, data=matrix)
+        if matrix.size:
+            target.create_dataset(
+                FULL_DISAGG_MATRIX, data=matrix,
+                chunks=(1,) + matrix.shape[1:], compression="gzip",
+                shuffle=True)
+        else:
+            # HDF5 does not support chunking an empty dataset
+            target.create_dataset(FULL_DISAGG_MATRIX, data=matrix)
 
     return file_path
 
@@ -251,6 +251,30 @@ SUBSET_EXTRACTORS = {
     "FullDisaggMatrix": fulldisaggmatrix,
 }
 
+#: Extractors whose results have a row per latitude bin. The results of
+#: the other extractors are sums over the latitude bins.
+#: Used by :func:`extract_subsets` to put together the results computed on
+#: each latitude slab of the full matrix.
+LATITUDE_EXTRACTORS = frozenset([
+    "LatLonPMF", "LatLonMagPMF", "LatLonMagEpsPMF", "LatLonTRTPMF",
+    "FullDisaggMatrix",
+])
+
+
+def _latitude_slabs(full_matrix):
+    """
+    Read a full matrix dataset a chunk of latitude bins at a time, through
+    hyperslab selections.
+
+    :param full_matrix: the 5D :class:`h5py.Dataset`
+    :returns: a generator of (first latitude bin, slab) pairs, the slabs
+        being 5D :class:`numpy.ndarray` objects
+    """
+    step = full_matrix.chunks[0] if full_matrix.chunks else 1
+
+    for start in xrange(0, full_matrix.shape[0], step):
+        yield start, full_matrix[start:start + step]
+
 
 @task
 def extract_subsets(
@@ -262,6 +286,9 @@ def extract_subsets(
     All subsets are saved in one file with dataset name equal
     to the extractor name.
 
+    The full matrix is never loaded as a whole: the subsets are computed on
+    a slab of latitude bins at a time and then put together.
+
     :param int job_id: current job identifier.
     :param site: :class:`openquake.shapes.Site` instance.
     :param full_matrix_path: Path to the full matrix file in hdf5 format.
@@ -285,14 +312,29 @@ def extract_subsets(
     subsets = set(subsets)
     assert not subsets - set(SUBSET_EXTRACTORS)
     assert subsets
-    with h5py.File(full_matrix_path, 'r') as source:
-        full_matrix = source[FULL_DISAGG_MATRIX].value
-    with h5py.File(target_path, 'w') as target:
-        for subset_type in subsets:
-            extractor = SUBSET_EXTRACTORS[subset_type]
-            dataset = extractor(
-                site, full_matrix,
-                lat_bin_edges, lon_bin_edges, distance_bin_edges,
-                nlat, nlon, nmag, neps, ntrt, ndist
-            )
+    sums = {}
+    with h5py.File(full_matrix_path, 'r') as source, \
+            h5py.File(target_path, 'w') as target:
+        full_matrix = source[FULL_DISAGG_MATRIX]
+        for start, slab in _latitude_slabs(full_matrix):
+            slab_lat_bin_edges = lat_bin_edges[start:start + len(slab) + 1]
+            for subset_type in subsets:
+                extractor = SUBSET_EXTRACTORS[subset_type]
+                dataset = extractor(
+                    site, slab,
+                    slab_lat_bin_edges, lon_bin_edges, distance_bin_edges,
+                    len(slab_lat_bin_edges), nlon, nmag, neps, ntrt, ndist
+                )
+                if subset_type not in LATITUDE_EXTRACTORS:
+                    if subset_type in sums:
+                        sums[subset_type] += dataset
+                    else:
+                        sums[subset_type] = dataset
+                    continue
+                if subset_type not in target:
+                    target.create_dataset(
+                        subset_type, dtype=DATA_TYPE,
+                        shape=(nlat - 1,) + dataset.shape[1:])
+                target[subset_type][start:start + len(slab)] = dataset
+        for subset_type, dataset in sums.iteritems():
             target.create_dataset(subset_type, data=dataset)
@@ -127,7 +127,8 @@ class EventBasedHazardCalculator(general.BaseHazardCalculator):
                     gmf_data[site_obj] = \
                         {'groundMotion': math.exp(float(site['mag']))}
 
-                gmf_writer.serialize(gmf_data)
+                self.calc_proxy.result_sink.submit(
+                    nrml_path, gmf_writer, gmf_data)
                 files.append(nrml_path)
         return files
 
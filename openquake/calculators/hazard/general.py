@@ -25,11 +25,13 @@ import json
 import math
 import numpy
 
+from itertools import izip
 from scipy.interpolate import interp1d
 from scipy.stats.mstats import mquantiles
 
 from openquake import java
 from openquake import kvs
+from openquake import shapes
 from openquake.input import logictree
 from openquake.java import list_to_jdouble_array
 from openquake.logs import LOG
@@ -256,33 +258,57 @@ class BaseHazardCalculator(Calculator):
         return gmpe_map
 
     def parameterize_sites(self, site_list):
-        """Convert python Sites to Java Sites, and add default parameters."""
+        """Convert python Sites to Java Sites, and add default parameters.
+
+        When `site_list` is a :py:class:`openquake.shapes.SiteCollection`
+        holding per-site Vs30 or depth values, those override the defaults
+        of the job configuration.
+        """
         # TODO(JMC): There's Java code for this already, sets each site to have
         # the same default parameters
 
         jpype = java.jvm()
         jsite_list = java.jclass("ArrayList")()
-        for x in site_list:
-            site = x.to_java()
-
-            vs30 = java.jclass("DoubleParameter")(jpype.JString("Vs30"))
-            vs30.setValue(
-                float(self.calc_proxy.params['REFERENCE_VS30_VALUE']))
-            depth25 = java.jclass("DoubleParameter")("Depth 2.5 km/sec")
-            depth25.setValue(float(
-                self.calc_proxy.params[
-                    'REFERENCE_DEPTH_TO_2PT5KM_PER_SEC_PARAM']))
-            sadigh = java.jclass("StringParameter")("Sadigh Site Type")
-            sadigh.setValue(self.calc_proxy.params['SADIGH_SITE_TYPE'])
-
-            depth1km = java.jclass("DoubleParameter")(jpype.JString(
-                "Depth 1.0 km/sec"))
-            depth1km.setValue(
-                float(self.calc_proxy.params['DEPTHTO1PT0KMPERSEC']))
-            vs30_type = java.jclass("StringParameter")("Vs30 Type")
-            # Enum values must be capitalized in the Java domain!
-            vs30_type.setValue(
-                self.calc_proxy.params['VS30_TYPE'].capitalize())
+
+        location_class = jpype.JClass("org.opensha.commons.geo.Location")
+        site_class = jpype.JClass("org.opensha.commons.data.Site")
+        double_param = java.jclass("DoubleParameter")
+        string_param = java.jclass("StringParameter")
+
+        params = self.calc_proxy.params
+        sadigh_type = params['SADIGH_SITE_TYPE']
+        # Enum values must be capitalized in the Java domain!
+        vs30_type_value = params['VS30_TYPE'].capitalize()
+
+        sites = site_list
+        if not isinstance(sites, shapes.SiteCollection):
+            sites = shapes.SiteCollection.from_sites(site_list)
+
+        def _values(values, param):
+            """Per-site values as a list of floats, or the default"""
+            if values is None:
+                return [float(params[param])] * len(sites)
+            return values.astype(float).tolist()
+
+        for lon, lat, vs30_value, depth25_value, depth1km_value in izip(
+                sites.longitudes.tolist(), sites.latitudes.tolist(),
+                _values(sites.vs30, 'REFERENCE_VS30_VALUE'),
+                _values(sites.depth_to_2pt5,
+                        'REFERENCE_DEPTH_TO_2PT5KM_PER_SEC_PARAM'),
+                _values(sites.depth_to_1pt0, 'DEPTHTO1PT0KMPERSEC')):
+            site = site_class(location_class(lat, lon))
+
+            vs30 = double_param(jpype.JString("Vs30"))
+            vs30.setValue(vs30_value)
+            depth25 = double_param("Depth 2.5 km/sec")
+            depth25.setValue(depth25_value)
+            sadigh = string_param("Sadigh Site Type")
+            sadigh.setValue(sadigh_type)
+
+            depth1km = double_param(jpype.JString("Depth 1.0 km/sec"))
+            depth1km.setValue(depth1km_value)
+            vs30_type = string_param("Vs30 Type")
+            vs30_type.setValue(vs30_type_value)
 
             site.addParameter(vs30)
             site.addParameter(depth25)
@@ -49,6 +49,9 @@ def touch_result_file(job_id, path, sites, realizations, n_periods):
     with the number of rows = number of samples and number of cols = number of
     UHS periods.
 
+    Each realization of a site is stored in its own compressed chunk, which
+    is the unit the results are computed and read in.
+
     :param int job_id:
         ID of the job record in the DB/KVS.
     :param str path:
@@ -68,7 +71,8 @@ def touch_result_file(job_id, path, sites, realizations, n_periods):
             ds_name = 'lon:%s-lat:%s' % (site.longitude, site.latitude)
             ds_shape = (realizations, n_periods)
             h5_file.create_dataset(ds_name, dtype=numpy.float64,
-                                   shape=ds_shape)
+                                   shape=ds_shape, chunks=(1, n_periods),
+                                   compression="gzip", shuffle=True)
 
 
 @task(ignore_results=True)
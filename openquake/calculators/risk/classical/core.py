@@ -32,6 +32,7 @@ from openquake import logs
 from openquake.db import models
 from openquake.parser import vulnerability
 from openquake.shapes import Curve
+from openquake.shapes import CurveSet
 from openquake.utils.general import MemoizeMutable
 from openquake.calculators.risk import general
 from openquake.calculators.risk.general import collect
@@ -66,7 +67,7 @@ def compute_loss_ratio_curve(vuln_function, hazard_curve, steps,
     lrem_po = _compute_lrem_po(vuln_function, lrem, hazard_curve)
     loss_ratios = _generate_loss_ratios(vuln_function, steps)
 
-    return Curve(zip(loss_ratios, lrem_po.sum(axis=1)))
+    return Curve.from_arrays(loss_ratios, lrem_po.sum(axis=1))
 
 
 def _compute_lrem_po(vuln_function, lrem, hazard_curve):
@@ -137,10 +138,10 @@ def _compute_lrem(vuln_function, steps, distribution='LN'):
     # and number of columns equal to the number if imls
     lrem = empty((loss_ratios.size, vuln_function.imls.size), float)
 
-    for col, _ in enumerate(vuln_function):
-        for row, loss_ratio in enumerate(loss_ratios):
-            lrem[row][col] = dist.survival_function(loss_ratio,
-                col=col, vf=vuln_function)
+    # the survival functions are evaluated for all the loss ratios at once
+    for col in xrange(vuln_function.imls.size):
+        lrem[:, col] = dist.survival_function(loss_ratios,
+            col=col, vf=vuln_function)
 
     return lrem
 
@@ -255,30 +256,55 @@ class ClassicalRiskCalculator(general.ProbabilisticRiskCalculator):
 
     def _get_db_curve(self, site):
         """Read hazard curve data from the DB"""
-        gh = geohash.encode(site.latitude, site.longitude, precision=12)
+        return self._get_db_curves([site])[site]
+
+    def _get_db_curves(self, sites):
+        """Read the hazard curves at many sites from the DB, a batch of
+        sites per query.
+
+        :returns: a dictionary mapping each site to its hazard curve
+        :raises: :exc:`ObjectDoesNotExist` if a site has no curve
+        """
         job = models.OqCalculation.objects.get(id=self.calc_proxy.job_id)
-        hc = models.HazardCurveData.objects.filter(
-            hazard_curve__output__oq_calculation=job,
-            hazard_curve__statistic_type='mean').extra(
-            where=["ST_GeoHash(location, 12) = %s"], params=[gh]).get()
+        geohashes = dict(
+            (site, geohash.encode(site.latitude, site.longitude,
+                                  precision=models.GEOHASH_PRECISION))
+            for site in sites)
+        poes = models.hazard_curves_by_geohash(job, geohashes.values())
+
+        for site, gh in geohashes.iteritems():
+            if gh not in poes:
+                raise models.HazardCurveData.DoesNotExist(
+                    "No mean hazard curve at %s" % site)
 
-        return Curve(zip(job.oq_job_profile.imls, hc.poes))
+        if not geohashes:
+            return {}
+
+        # all the curves share the IMLs of the job
+        sites = geohashes.keys()
+        curve_set = CurveSet(job.oq_job_profile.imls,
+                             [poes[geohashes[site]] for site in sites])
+
+        return dict(zip(sites, curve_set))
 
     def _compute_loss(self, block_id):
         """
         Calculate and store in the kvs the loss data.
         """
         block = general.Block.from_kvs(self.calc_proxy.job_id, block_id)
+        block_assets = general.BlockAssets.from_kvs(
+            self.calc_proxy.job_id, block_id)
 
         vuln_curves = vulnerability.load_vuln_model_from_kvs(
             self.calc_proxy.job_id)
 
-        for point in block.grid(self.calc_proxy.region):
-            hazard_curve = self._get_db_curve(point.site)
+        points = list(block.grid(self.calc_proxy.region))
+        hazard_curves = self._get_db_curves([point.site for point in points])
+
+        for point in points:
+            hazard_curve = hazard_curves[point.site]
 
-            asset_key = kvs.tokens.asset_key(self.calc_proxy.job_id,
-                            point.row, point.column)
-            for asset in kvs.get_list_json_decoded(asset_key):
+            for asset in block_assets.assets_at(point):
                 LOGGER.debug("processing asset %s" % (asset))
 
                 loss_ratio_curve = self.compute_loss_ratio_curve(
@@ -301,32 +327,34 @@ class ClassicalRiskCalculator(general.ProbabilisticRiskCalculator):
         """
         Calculate and store in the kvs the benefit-cost ratio data for block.
 
-        A value is stored with key :func:`openquake.kvs.tokens.bcr_block_key`.
-        See :func:`openquake.risk.job.general.compute_bcr_for_block` for result
-        data structure spec.
+        The value is stored with
+        :func:`openquake.calculators.risk.general.store_bcr_block`. See
+        :func:`openquake.calculators.risk.general.compute_bcr_for_block` for
+        result data structure spec.
         """
         calc_proxy = self.calc_proxy
         points = list(general.Block.from_kvs(
             calc_proxy.job_id, block_id).grid(calc_proxy.region))
-        hazard_curves = dict((point.site, self._get_db_curve(point.site))
-                             for point in points)
+        hazard_curves = self._get_db_curves([point.site for point in points])
 
-        def get_loss_curve(point, vuln_function, asset):
-            "Compute loss curve basing on hazard curve"
+        def get_mean_loss_ratios(point, vuln_function, _assets):
+            """Compute the mean loss ratio basing on hazard curve, the
+            same for all the assets of the point"""
             job_profile = self.calc_proxy.oq_job_profile
             hazard_curve = hazard_curves[point.site]
             loss_ratio_curve = compute_loss_ratio_curve(
                     vuln_function, hazard_curve,
                     job_profile.lrem_steps_per_interval)
-            return compute_loss_curve(loss_ratio_curve, asset['assetValue'])
+            return general.compute_mean_loss(loss_ratio_curve)
 
         bcr = general.compute_bcr_for_block(calc_proxy.job_id, points,
-            get_loss_curve, float(calc_proxy.params['INTEREST_RATE']),
+            general.BlockAssets.from_kvs(calc_proxy.job_id, block_id),
+            get_mean_loss_ratios, float(calc_proxy.params['INTEREST_RATE']),
             float(calc_proxy.params['ASSET_LIFE_EXPECTANCY'])
         )
-        bcr_block_key = kvs.tokens.bcr_block_key(calc_proxy.job_id, block_id)
-        kvs.set_value_json_encoded(bcr_block_key, bcr)
-        LOGGER.debug('bcr result for block %s: %r', block_id, bcr)
+        general.store_bcr_block(calc_proxy.job_id, block_id, bcr)
+        LOGGER.debug('bcr result for block %s: %s assets',
+                     block_id, len(bcr['bcr']))
         return True
 
     def compute_loss_curve(self, point, loss_ratio_curve, asset):
@@ -347,7 +375,7 @@ class ClassicalRiskCalculator(general.ProbabilisticRiskCalculator):
         loss_key = kvs.tokens.loss_curve_key(
             self.calc_proxy.job_id, point.row, point.column, asset['assetID'])
 
-        kvs.get_client().set(loss_key, loss_curve.to_json())
+        kvs.get_client().set(loss_key, loss_curve.to_binary())
 
         return loss_curve
 
@@ -387,6 +415,6 @@ class ClassicalRiskCalculator(general.ProbabilisticRiskCalculator):
         loss_ratio_key = kvs.tokens.loss_ratio_key(
             self.calc_proxy.job_id, point.row, point.column, asset['assetID'])
 
-        kvs.get_client().set(loss_ratio_key, loss_ratio_curve.to_json())
+        kvs.get_client().set(loss_ratio_key, loss_ratio_curve.to_binary())
 
         return loss_ratio_curve
@@ -20,9 +20,11 @@
 
 """Core functionality for Event-Based Risk calculations."""
 
+import itertools
+import operator
 import os
 
-from numpy import zeros
+from numpy import array, zeros
 
 from celery.exceptions import TimeoutError
 
@@ -42,24 +44,24 @@ def _filename(job_id):
     return "%s-aggregate-loss-curve.svg" % job_id
 
 
-def _for_plotting(loss_curve, time_span):
+def _for_plotting(loss_curve, time_span, label="AggregateLossCurve"):
     """Translate a loss curve into a dictionary compatible to
     the interface defined in CurvePlot.write."""
     data = {}
 
-    data["AggregateLossCurve"] = {}
-    data["AggregateLossCurve"]["abscissa"] = tuple(loss_curve.abscissae)
-    data["AggregateLossCurve"]["ordinate"] = tuple(loss_curve.ordinates)
-    data["AggregateLossCurve"]["abscissa_property"] = "Economic Losses"
-    data["AggregateLossCurve"]["ordinate_property"] = \
+    data[label] = {}
+    data[label]["abscissa"] = tuple(loss_curve.abscissae)
+    data[label]["ordinate"] = tuple(loss_curve.ordinates)
+    data[label]["abscissa_property"] = "Economic Losses"
+    data[label]["ordinate_property"] = \
             "PoE in %s years" % (str(time_span))
 
-    data["AggregateLossCurve"]["curve_title"] = "Aggregate Loss Curve"
+    data[label]["curve_title"] = "Aggregate Loss Curve"
 
     return data
 
 
-def plot_aggregate_curve(calculator, aggregate_curve):
+def plot_aggregate_curve(calculator, aggregate_curve, taxonomy_curves=None):
     """Plot an aggreate loss curve.
 
     This function is triggered only if the AGGREGATE_LOSS_CURVE
@@ -70,6 +72,10 @@ def plot_aggregate_curve(calculator, aggregate_curve):
         calculation.
     :param aggregate_curve: the aggregate curve to plot.
     :type aggregate_curve: :py:class:`openquake.shapes.Curve`
+    :param taxonomy_curves: optional aggregate curves keyed by taxonomy,
+        plotted along with the total one.
+    :type taxonomy_curves: :py:class:`dict` of
+        :py:class:`openquake.shapes.Curve`
     """
 
     if not calculator.calc_proxy.has("AGGREGATE_LOSS_CURVE"):
@@ -83,10 +89,15 @@ def plot_aggregate_curve(calculator, aggregate_curve):
             calculator.calc_proxy.params["OUTPUT_DIR"],
             _filename(calculator.calc_proxy.job_id))
 
+    time_span = calculator.calc_proxy.params["INVESTIGATION_TIME"]
+    data = _for_plotting(aggregate_curve, time_span)
+
+    for taxonomy, taxonomy_curve in (taxonomy_curves or {}).iteritems():
+        if taxonomy_curve is not shapes.EMPTY_CURVE:
+            data.update(_for_plotting(taxonomy_curve, time_span, taxonomy))
+
     plotter = curve.CurvePlot(path)
-    plotter.write(_for_plotting(aggregate_curve,
-            calculator.calc_proxy.params["INVESTIGATION_TIME"]),
-            autoscale_y=False)
+    plotter.write(data, autoscale_y=False)
 
     plotter.close()
     LOGGER.debug("Aggregate loss curve stored at %s" % path)
@@ -103,33 +114,52 @@ class EventBasedRiskCalculator(general.ProbabilisticRiskCalculator):
         """Execute the job."""
         general.preload(self)
 
-        aggregate_curve = general.AggregateLossCurve()
+        aggregate_losses = general.AggregateLosses()
 
-        tasks = []
+        pending = []
         for block_id in self.calc_proxy.blocks_keys:
             LOGGER.debug("Starting task block, block_id = %s of %s"
                     % (block_id, len(self.calc_proxy.blocks_keys)))
 
-            tasks.append(general.compute_risk.delay(self.calc_proxy.job_id,
-                                                    block_id))
+            pending.append((block_id, general.compute_risk.delay(
+                self.calc_proxy.job_id, block_id)))
+
+        # merge the partial aggregates as soon as the tasks complete,
+        # so that the master never holds more than one of them
+        while pending:
+            done = [(block_id, task) for block_id, task in pending
+                    if task.ready()] or pending[:1]
 
-        for task in tasks:
-            try:
-                task.wait()
+            for block_id, task in done:
+                try:
+                    task.wait()
+                except TimeoutError:
+                    # TODO(jmc): Cancel and respawn this task
+                    return
 
-                aggregate_curve.append(task.result)
-            except TimeoutError:
-                # TODO(jmc): Cancel and respawn this task
-                return
+                pending.remove((block_id, task))
+
+                if not self.is_benefit_cost_ratio_mode():
+                    aggregate_losses.merge_from_kvs(
+                        self.calc_proxy.job_id, block_id)
 
         if self.is_benefit_cost_ratio_mode():
             self.write_output_bcr()
             return
 
-        agg_curve = aggregate_curve.compute(
-            self._tses(), self._time_span(),
-            self.calc_proxy.oq_job_profile.loss_histogram_bins)
-        plot_aggregate_curve(self, agg_curve)
+        loss_histogram_bins = \
+            self.calc_proxy.oq_job_profile.loss_histogram_bins
+
+        agg_curve = aggregate_losses.total.compute(
+            self._tses(), self._time_span(), loss_histogram_bins)
+
+        taxonomy_curves = dict(
+            (taxonomy, taxonomy_losses.compute(
+                self._tses(), self._time_span(), loss_histogram_bins))
+            for taxonomy, taxonomy_losses in
+            aggregate_losses.groups("taxonomy").iteritems())
+
+        plot_aggregate_curve(self, agg_curve, taxonomy_curves)
 
         self.write_output()
 
@@ -161,19 +191,37 @@ class EventBasedRiskCalculator(general.ProbabilisticRiskCalculator):
 
     def _get_db_gmf(self, gmf_id):
         """Returns a field for the given GMF"""
+        return self._get_db_gmf_fields([gmf_id]).next()
+
+    def _get_db_gmf_fields(self, gmf_ids):
+        """Yield a field for each of the given GMFs, in the order of their
+        ids, reading all of them with a single query.
+
+        The ground motion values outside the region grid are skipped."""
         grid = self.calc_proxy.region.grid
-        field = zeros((grid.rows, grid.columns))
+        groups = itertools.groupby(
+            models.gmf_values(gmf_ids), key=operator.itemgetter(0))
+        group_id, group = next(groups, (None, None))
 
-        gmf_sites = models.GmfData.objects.filter(output=gmf_id)
+        for gmf_id in sorted(gmf_ids):
+            field = zeros((grid.rows, grid.columns))
 
-        for gmf_site in gmf_sites:
-            loc = gmf_site.location
-            site = shapes.Site(loc.x, loc.y)
-            grid_point = grid.point_at(site)
+            if gmf_id == group_id:
+                _, lons, lats, ground_motions = [
+                    array(values) for values in zip(*group)]
 
-            field[grid_point.row][grid_point.column] = gmf_site.ground_motion
+                inside = grid.on_grid(lons, lats)
 
-        return shapes.Field(field)
+                if not inside.all():
+                    LOGGER.debug("%s ground motion values of GMF %s are "
+                        "not on the region grid, skipping them"
+                        % ((~inside).sum(), gmf_id))
+
+                rows, columns = grid.cells_at(lons[inside], lats[inside])
+                field[rows, columns] = ground_motions[inside]
+                group_id, group = next(groups, (None, None))
+
+            yield shapes.Field(field)
 
     def _sites_to_gmf_keys(self, sites):
         """Returns the GMF keys "row!col" for the given site list"""
@@ -192,9 +240,7 @@ class EventBasedRiskCalculator(general.ProbabilisticRiskCalculator):
         gmf_keys = self._sites_to_gmf_keys(sites)
         gmfs = dict((k, []) for k in gmf_keys)
 
-        for gmf_id in all_gmfs:
-            field = self._get_db_gmf(gmf_id)
-
+        for field in self._get_db_gmf_fields(all_gmfs):
             for key in gmfs.keys():
                 (row, col) = key.split("!")
                 gmfs[key].append(field.get(int(row), int(col)))
@@ -249,19 +295,18 @@ class EventBasedRiskCalculator(general.ProbabilisticRiskCalculator):
             self.calc_proxy.job_id)
 
         block = general.Block.from_kvs(self.calc_proxy.job_id, block_id)
+        block_assets = general.BlockAssets.from_kvs(
+            self.calc_proxy.job_id, block_id)
 
         # aggregate the losses for this block
-        aggregate_curve = general.AggregateLossCurve()
+        aggregate_losses = general.AggregateLosses()
 
         for point in block.grid(self.calc_proxy.region):
             key = kvs.tokens.gmf_set_key(self.calc_proxy.job_id, point.column,
                                          point.row)
             gmf_slice = kvs.get_value_json_decoded(key)
 
-            asset_key = kvs.tokens.asset_key(
-                self.calc_proxy.job_id, point.row, point.column)
-
-            for asset in kvs.get_list_json_decoded(asset_key):
+            for asset in block_assets.assets_at(point):
                 LOGGER.debug("Processing asset %s" % (asset))
 
                 # loss ratios, used both to produce the curve
@@ -271,7 +316,8 @@ class EventBasedRiskCalculator(general.ProbabilisticRiskCalculator):
                 loss_ratio_curve = self.compute_loss_ratio_curve(
                     point.column, point.row, asset, gmf_slice, loss_ratios)
 
-                aggregate_curve.append(loss_ratios * asset["assetValue"])
+                aggregate_losses.append(
+                    asset, loss_ratios * asset["assetValue"])
 
                 if loss_ratio_curve:
                     loss_curve = self.compute_loss_curve(
@@ -284,15 +330,18 @@ class EventBasedRiskCalculator(general.ProbabilisticRiskCalculator):
                                 self.calc_proxy.job_id, point.column,
                                 point.row, loss_curve, asset, loss_poe)
 
-        return aggregate_curve.losses
+        aggregate_losses.to_kvs(self.calc_proxy.job_id, block_id)
+
+        return True
 
     def _compute_bcr(self, block_id):
         """
         Calculate and store in the kvs the benefit-cost ratio data for block.
 
-        A value is stored with key :func:`openquake.kvs.tokens.bcr_block_key`.
-        See :func:`openquake.risk.job.general.compute_bcr_for_block` for result
-        data structure spec.
+        The value is stored with
+        :func:`openquake.calculators.risk.general.store_bcr_block`. See
+        :func:`openquake.calculators.risk.general.compute_bcr_for_block` for
+        result data structure spec.
         """
         self.slice_gmfs(block_id)
 
@@ -305,28 +354,36 @@ class EventBasedRiskCalculator(general.ProbabilisticRiskCalculator):
             ))
             for point in points
         )
-        epsilon_provider = general.EpsilonProvider(self.calc_proxy.params)
+        epsilon_provider = general.create_epsilon_provider(
+            self.calc_proxy.params)
 
-        def get_loss_curve(point, vuln_function, asset):
-            "Compute loss curve basing on GMF data"
+        def get_mean_loss_ratios(point, vuln_function, assets):
+            "Compute the mean loss ratios basing on GMF data"
             gmf_slice = gmf_slices[point.site]
-            loss_ratios = general.compute_loss_ratios(
-                vuln_function, gmf_slice, epsilon_provider, asset)
-            loss_ratio_curve = general.compute_loss_ratio_curve(
-                vuln_function, gmf_slice, epsilon_provider, asset,
-                self.calc_proxy.oq_job_profile.loss_histogram_bins,
-                loss_ratios=loss_ratios)
-            return loss_ratio_curve.rescale_abscissae(asset["assetValue"])
+            mean_loss_ratios = []
+
+            for asset in assets:
+                loss_ratios = general.compute_loss_ratios(
+                    vuln_function, gmf_slice, epsilon_provider, asset)
+                loss_ratio_curve = general.compute_loss_ratio_curve(
+                    vuln_function, gmf_slice, epsilon_provider, asset,
+                    self.calc_proxy.oq_job_profile.loss_histogram_bins,
+                    loss_ratios=loss_ratios)
+                mean_loss_ratios.append(
+                    general.compute_mean_loss(loss_ratio_curve))
+
+            return array(mean_loss_ratios)
 
         result = general.compute_bcr_for_block(self.calc_proxy.job_id, points,
-            get_loss_curve, float(self.calc_proxy.params['INTEREST_RATE']),
+            general.BlockAssets.from_kvs(self.calc_proxy.job_id, block_id),
+            get_mean_loss_ratios,
+            float(self.calc_proxy.params['INTEREST_RATE']),
             float(self.calc_proxy.params['ASSET_LIFE_EXPECTANCY'])
         )
 
-        bcr_block_key = kvs.tokens.bcr_block_key(self.calc_proxy.job_id,
-                                                 block_id)
-        kvs.set_value_json_encoded(bcr_block_key, result)
-        LOGGER.debug('bcr result for block %s: %r', block_id, result)
+        general.store_bcr_block(self.calc_proxy.job_id, block_id, result)
+        LOGGER.debug('bcr result for block %s: %s assets',
+                     block_id, len(result['bcr']))
         return True
 
     def compute_loss_ratios(self, asset, gmf_slice):
@@ -334,7 +391,8 @@ class EventBasedRiskCalculator(general.ProbabilisticRiskCalculator):
         the loss ratios used to obtain the related loss ratio curve
         and aggregate loss curve."""
 
-        epsilon_provider = general.EpsilonProvider(self.calc_proxy.params)
+        epsilon_provider = general.create_epsilon_provider(
+            self.calc_proxy.params)
 
         vuln_function = self.vuln_curves.get(
             asset["taxonomy"], None)
@@ -364,7 +422,7 @@ class EventBasedRiskCalculator(general.ProbabilisticRiskCalculator):
 
             return None
 
-        epsilon_provider = general.EpsilonProvider(calc_proxy.params)
+        epsilon_provider = general.create_epsilon_provider(calc_proxy.params)
 
         loss_histogram_bins = calc_proxy.oq_job_profile.loss_histogram_bins
         loss_ratio_curve = general.compute_loss_ratio_curve(
@@ -378,7 +436,7 @@ class EventBasedRiskCalculator(general.ProbabilisticRiskCalculator):
         key = kvs.tokens.loss_ratio_key(
             self.calc_proxy.job_id, row, col, asset["assetID"])
 
-        kvs.get_client().set(key, loss_ratio_curve.to_json())
+        kvs.get_client().set(key, loss_ratio_curve.to_binary())
 
         LOGGER.debug("Loss ratio curve is %s, write to key %s" %
                 (loss_ratio_curve, key))
@@ -397,6 +455,6 @@ class EventBasedRiskCalculator(general.ProbabilisticRiskCalculator):
             self.calc_proxy.job_id, row, column, asset["assetID"])
 
         LOGGER.debug("Loss curve is %s, write to key %s" % (loss_curve, key))
-        kvs.get_client().set(key, loss_curve.to_json())
+        kvs.get_client().set(key, loss_curve.to_binary())
 
         return loss_curve
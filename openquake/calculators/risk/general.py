@@ -21,21 +21,30 @@
 # Silence 'Too many lines in module'
 # pylint: disable=C0302
 
-import json
+import cPickle
+import hashlib
 import math
 import os
 
 from collections import defaultdict
 from collections import OrderedDict
+from itertools import islice
+from itertools import izip
 
 from scipy import stats
-from scipy import sqrt, log
 
 from numpy import array
+from numpy import concatenate
 from numpy import exp
+from numpy import frombuffer
 from numpy import histogram
+from numpy import isnan
 from numpy import linspace
 from numpy import mean
+from numpy import nan
+from numpy import random
+from numpy import uint32
+from numpy import unique
 from numpy import where
 from numpy import zeros
 from scipy.stats import norm
@@ -45,7 +54,6 @@ from openquake import logs
 from openquake import shapes
 from openquake.job import config as job_config
 from openquake.output import risk as risk_output
-from openquake.parser import exposure
 from openquake.parser import vulnerability
 from openquake.calculators.base import Calculator
 from openquake.utils.tasks import calculator_for_task
@@ -55,19 +63,21 @@ from celery.task import task
 LOG = logs.LOG
 BLOCK_SIZE = 100
 
+# number of keys read from the KVS with a single MGET when assembling the
+# outputs
+KVS_BATCH_SIZE = 1000
+
 
 def preload(calculator):
     """
     Define some preliminary steps needed before starting
     the risk processing.
 
-    * read and store in KVS the assets
+    * split into blocks and store in KVS the exposure sites and assets
     * read and store in KVS the vulnerability model
-    * split into blocks and store in KVS the exposure sites
     """
-    calculator.store_exposure_assets()
-    calculator.store_vulnerability_model()
     calculator.partition()
+    calculator.store_vulnerability_model()
 
 
 def conditional_loss_poes(params):
@@ -130,6 +140,25 @@ def compute_risk(calculation_id, block_id, **kwargs):
     return calculator.compute_risk(block_id, **kwargs)
 
 
+@task
+def write_block_output(calculation_id, block_id, serialize_to):
+    """A task for writing the loss curves of a block, calls the
+    _write_output_for_block method defined in the chosen risk calculator.
+
+    :param serialize_to: where to serialize the curves, see
+        :py:func:`openquake.output.risk.create_loss_curve_writer`
+    :returns: the paths of the files written
+    """
+    calculator = calculator_for_task(calculation_id, 'risk')
+
+    try:
+        # pylint: disable=W0212
+        return calculator._write_output_for_block(
+            calculation_id, block_id, serialize_to)
+    finally:
+        calculator.calc_proxy.result_sink.close()
+
+
 class BaseRiskCalculator(Calculator):
     """Base abstract class for Risk calculators."""
 
@@ -147,45 +176,44 @@ class BaseRiskCalculator(Calculator):
         )
 
     def partition(self):
-        """Split the sites to compute in blocks and store
-        them in the underlying KVS system."""
+        """Split the sites to compute in blocks and store them in the
+        underlying KVS system, together with the exposure assets of each
+        block (one :py:class:`BlockAssets` per block).
+
+        The exposure is parsed only once, see
+        :py:meth:`openquake.engine.CalculationProxy.exposure_assets`."""
         # pylint: disable=W0404
         from openquake import engine
 
-        sites = []
         self.calc_proxy.blocks_keys = []  # pylint: disable=W0201
         sites = engine.read_sites_from_exposure(self.calc_proxy)
 
-        block_count = 0
+        site_blocks = {}
 
         for block in split_into_blocks(self.calc_proxy.job_id, sites):
             self.calc_proxy.blocks_keys.append(block.block_id)
             block.to_kvs()
 
-            block_count += 1
+            for site in block.sites:
+                site_blocks[site] = block.block_id
 
         LOG.info("Job has partitioned %s sites into %s blocks",
-                len(sites), block_count)
-
-    def store_exposure_assets(self):
-        """Load exposure assets and write them to KVS."""
-
-        exposure_parser = exposure.ExposurePortfolioFile(
-            os.path.join(self.calc_proxy.base_path,
-                         self.calc_proxy.params[job_config.EXPOSURE]))
+                len(sites), len(self.calc_proxy.blocks_keys))
 
         region = self.calc_proxy.region
+        block_assets = defaultdict(list)
 
-        for site, asset in exposure_parser.filter(region):
+        for site, asset in self.calc_proxy.exposure_assets():
             # TODO(ac): This is kludgey (?)
             asset["lat"] = site.latitude
             asset["lon"] = site.longitude
             gridpoint = region.grid.point_at(site)
 
-            asset_key = kvs.tokens.asset_key(
-                self.calc_proxy.job_id, gridpoint.row, gridpoint.column)
+            block_assets[site_blocks[site]].append((gridpoint, asset))
 
-            kvs.get_client().rpush(asset_key, json.JSONEncoder().encode(asset))
+        for block_id, assets in block_assets.iteritems():
+            BlockAssets.from_assets(assets).to_kvs(
+                self.calc_proxy.job_id, block_id)
 
     def store_vulnerability_model(self):
         """ load vulnerability and write to kvs """
@@ -201,13 +229,18 @@ class BaseRiskCalculator(Calculator):
             vulnerability.load_vulnerability_model(
                 self.calc_proxy.job_id, path, retrofitted=True)
 
-    def _serialize(self, block_id, **kwargs):
+    def _serialize(self, block_id, serialize_to=None, **kwargs):
         """
         Build filename/paths for serializing and call _serialize
 
+        The curves are serialized where the calculation says, unless
+        `serialize_to` is given.
+
         Return the list of filenames. The list will be empty if nothing was
         actually serialized.
         """
+        if serialize_to is None:
+            serialize_to = self.calc_proxy.serialize_results_to
 
         if kwargs['curve_mode'] == 'loss_ratio':
             serialize_filename = "%s-block-#%s-block#%s.xml" % (
@@ -226,64 +259,77 @@ class BaseRiskCalculator(Calculator):
 
         LOG.debug("Serializing %s" % kwargs['curve_mode'])
         writer = risk_output.create_loss_curve_writer(
-            self.calc_proxy.job_id, self.calc_proxy.serialize_results_to,
-            serialize_path, kwargs['curve_mode'])
+            self.calc_proxy.job_id, serialize_to, serialize_path,
+            kwargs['curve_mode'])
         if writer:
-            writer.serialize(kwargs['curves'])
+            self.calc_proxy.result_sink.submit(
+                serialize_path, writer, kwargs['curves'])
 
             return [serialize_path]
         else:
             return []
 
-    def grid_assets_iterator(self, grid):
+    def assets_iterator(self, block_ids=None):
         """
         Generates the tuples (point, asset) for all assets known to this job
-        that are contained in grid.
+        that are contained in the given blocks.
 
+        :param block_ids: the ids of the blocks, all the blocks of the job
+            by default.
         :returns: tuples (point, asset) where:
             * point is a :py:class:`openquake.shapes.GridPoint` on the grid
 
             * asset is a :py:class:`dict` representing an asset
         """
 
-        for point in grid:
-            asset_key = kvs.tokens.asset_key(
-                self.calc_proxy.job_id, point.row, point.column)
-            for asset in kvs.get_list_json_decoded(asset_key):
+        if block_ids is None:
+            block_ids = self.calc_proxy.blocks_keys
+
+        for block_id in block_ids:
+            block_assets = BlockAssets.from_kvs(
+                self.calc_proxy.job_id, block_id)
+
+            for point, asset in block_assets.points_and_assets(
+                    self.calc_proxy.region.grid):
                 yield point, asset
 
-    def _write_output_for_block(self, job_id, block_id):
+    def _write_output_for_block(self, job_id, block_id, serialize_to=None):
         """ Given a job and a block, write out a plotted curve """
         loss_ratio_curves = []
         loss_curves = []
-        block = Block.from_kvs(job_id, block_id)
-        for point, asset in self.grid_assets_iterator(
-                block.grid(self.calc_proxy.region)):
-            site = shapes.Site(asset['lon'], asset['lat'])
+        points_and_assets = list(self.assets_iterator([block_id]))
 
-            loss_curve = kvs.get_client().get(
-                kvs.tokens.loss_curve_key(
-                    job_id, point.row, point.column, asset["assetID"]))
-            loss_ratio_curve = kvs.get_client().get(
-                kvs.tokens.loss_ratio_key(
-                    job_id, point.row, point.column, asset["assetID"]))
+        keys = []
+        for point, asset in points_and_assets:
+            keys.append(kvs.tokens.loss_curve_key(
+                job_id, point.row, point.column, asset["assetID"]))
+            keys.append(kvs.tokens.loss_ratio_key(
+                job_id, point.row, point.column, asset["assetID"]))
+
+        # a single round trip for all the curves of the block
+        values = kvs.get_client().mget(keys) if keys else []
+
+        for (_, asset), loss_curve, loss_ratio_curve in izip(
+                points_and_assets, values[::2], values[1::2]):
+            site = shapes.Site(asset['lon'], asset['lat'])
 
             if loss_curve:
-                loss_curve = shapes.Curve.from_json(loss_curve)
+                loss_curve = shapes.Curve.from_binary(loss_curve)
                 loss_curves.append((site, (loss_curve, asset)))
 
             if loss_ratio_curve:
-                loss_ratio_curve = shapes.Curve.from_json(loss_ratio_curve)
+                loss_ratio_curve = shapes.Curve.from_binary(loss_ratio_curve)
                 loss_ratio_curves.append((site, (loss_ratio_curve, asset)))
 
-        results = self._serialize(block_id,
-                                           curves=loss_ratio_curves,
-                                           curve_mode='loss_ratio')
+        results = self._serialize(block_id, serialize_to,
+                                  curves=loss_ratio_curves,
+                                  curve_mode='loss_ratio')
         if loss_curves:
             results.extend(
                 self._serialize(
-                    block_id, curves=loss_curves, curve_mode='loss',
-                    curve_mode_prefix='loss_curve', render_multi=True))
+                    block_id, serialize_to, curves=loss_curves,
+                    curve_mode='loss', curve_mode_prefix='loss_curve',
+                    render_multi=True))
         return results
 
     def asset_losses_per_site(self, loss_poe, assets_iterator):
@@ -295,7 +341,7 @@ class BaseRiskCalculator(Calculator):
         :type:loss_poe: float
         :param:assets_iterator: an iterator over the assets, returning (point,
             asset) tuples. See
-            :py:class:`openquake.risk.job.general.grid_assets_iterator`.
+            :py:meth:`assets_iterator`.
 
         :returns: A list of tuples in the form expected by the
         :py:class:`LossMapWriter.serialize` method:
@@ -310,23 +356,31 @@ class BaseRiskCalculator(Calculator):
                 ***value*** - the value of the loss for the asset
         """
         result = defaultdict(list)
+        assets_iterator = iter(assets_iterator)
+        client = kvs.get_client()
 
-        for point, asset in assets_iterator:
-            key = kvs.tokens.loss_key(self.calc_proxy.job_id, point.row,
-                                      point.column,
-                    asset["assetID"], loss_poe)
+        while True:
+            batch = list(islice(assets_iterator, KVS_BATCH_SIZE))
 
-            loss_value = kvs.get_client().get(key)
+            if not batch:
+                break
 
-            LOG.debug("Loss for asset %s at %s %s is %s" %
-                (asset["assetID"], asset['lon'], asset['lat'], loss_value))
+            keys = [kvs.tokens.loss_key(self.calc_proxy.job_id, point.row,
+                                        point.column, asset["assetID"],
+                                        loss_poe)
+                    for point, asset in batch]
 
-            if loss_value:
-                risk_site = shapes.Site(asset['lon'], asset['lat'])
-                loss = {
-                    "value": loss_value,
-                }
-                result[risk_site].append((loss, asset))
+            for (_, asset), loss_value in izip(batch, client.mget(keys)):
+                LOG.debug("Loss for asset %s at %s %s is %s" %
+                    (asset["assetID"], asset['lon'], asset['lat'],
+                     loss_value))
+
+                if loss_value:
+                    risk_site = shapes.Site(asset['lon'], asset['lat'])
+                    loss = {
+                        "value": loss_value,
+                    }
+                    result[risk_site].append((loss, asset))
 
         return result.items()
 
@@ -338,13 +392,21 @@ class BaseRiskCalculator(Calculator):
             List of two-item tuples: site object and lists of BCR values per
             asset in that site. See :func:`compute_bcr_for_block`.
         """
-        data = []
+        data = OrderedDict()
         for block_id in self.calc_proxy.blocks_keys:
-            key = kvs.tokens.bcr_block_key(self.calc_proxy.job_id, block_id)
-            block_data = kvs.get_value_json_decoded(key)
-            data += [(shapes.Site(latitude=lat, longitude=lon), payload)
-                     for ((lat, lon), payload) in block_data]
-        return data
+            block_data = load_bcr_block(self.calc_proxy.job_id, block_id)
+
+            for lat, lon, asset_id, eal_original, eal_retrofitted, bcr in \
+                    izip(*[block_data[field].tolist() for field in (
+                        'lat', 'lon', 'assetID', 'eal_original',
+                        'eal_retrofitted', 'bcr')]):
+                data.setdefault((lat, lon), []).append(
+                    ({'bcr': bcr,
+                      'eal_original': eal_original,
+                      'eal_retrofitted': eal_retrofitted}, asset_id))
+
+        return [(shapes.Site(latitude=lat, longitude=lon), payload)
+                for ((lat, lon), payload) in data.iteritems()]
 
 
 class ProbabilisticRiskCalculator(BaseRiskCalculator):
@@ -373,12 +435,25 @@ class ProbabilisticRiskCalculator(BaseRiskCalculator):
 
     def write_output(self):
         """Write the output of a block to db/xml.
+
+        The loss curves of the blocks are written in parallel by
+        :func:`write_block_output` tasks, while the loss maps are put
+        together here. The HDF5 archive of the calculation can't be written
+        by many processes at once, so the loss curves are appended to it
+        here too.
         """
         calc_proxy = self.calc_proxy
 
-        for block_id in calc_proxy.blocks_keys:
-            #pylint: disable=W0212
-            self._write_output_for_block(calc_proxy.job_id, block_id)
+        # the targets are passed along, they are not stored in the KVS
+        serialize_to = [target for target in calc_proxy.serialize_results_to
+                        if target != 'hdf5']
+
+        tasks = []
+
+        if serialize_to:
+            tasks = [write_block_output.delay(
+                        calc_proxy.job_id, block_id, serialize_to)
+                     for block_id in calc_proxy.blocks_keys]
 
         for loss_poe in conditional_loss_poes(calc_proxy.params):
             path = os.path.join(calc_proxy.base_path,
@@ -398,11 +473,18 @@ class ProbabilisticRiskCalculator(BaseRiskCalculator):
                 writer.serialize(
                     [metadata]
                     + self.asset_losses_per_site(
-                        loss_poe,
-                        self.grid_assets_iterator(
-                            calc_proxy.region.grid)))
+                        loss_poe, self.assets_iterator()))
                 LOG.info('Loss Map is at: %s' % path)
 
+        if 'hdf5' in calc_proxy.serialize_results_to:
+            for block_id in calc_proxy.blocks_keys:
+                self._write_output_for_block(
+                    calc_proxy.job_id, block_id, ['hdf5'])
+
+        for a_task in tasks:
+            # re-raises the errors of the task
+            a_task.wait()
+
     def write_output_bcr(self):
         """
         Write BCR map in NRML format.
@@ -472,6 +554,102 @@ class EpsilonProvider(object):
             return samples[taxonomy]
 
 
+# number of consecutive events whose epsilons are drawn from the same
+# generator by a SeededEpsilonProvider
+EPSILON_CHUNK = 1000
+
+
+class SeededEpsilonProvider(object):
+    """
+    Epsilon provider returning reproducible epsilon vectors.
+
+    The events are split in chunks of :py:data:`EPSILON_CHUNK` events, the
+    epsilons of each chunk being drawn from a generator seeded with the
+    job seed (`EPSILON_RANDOM_SEED`), the asset (or its building typology,
+    for "perfectly" correlated jobs) and the index of the chunk. The
+    numbers are thus the same regardless of the order in which the assets
+    are processed, of how they are split in blocks and distributed among
+    the workers and of how the events are split in batches; a batch only
+    draws the chunks it overlaps.
+    """
+
+    def __init__(self, params):
+        """
+        :param params: configuration parameters from the job configuration
+        :type params: dict
+        """
+        self.seed = int(params["EPSILON_RANDOM_SEED"])
+        self.correlation = params.get("ASSET_CORRELATION")
+
+        if self.correlation and self.correlation != "perfect":
+            raise ValueError(
+                'Invalid "ASSET_CORRELATION": %s' % self.correlation)
+
+    def _stream_key(self, asset):
+        """Return the key of the epsilon stream used by the given asset.
+
+        For uncorrelated jobs each asset has its own stream, otherwise
+        assets with the same taxonomy share the same stream.
+        """
+        if not self.correlation:
+            return "asset!%s" % asset["assetID"]
+
+        taxonomy = asset.get("taxonomy")
+        if taxonomy is None:
+            raise ValueError("Asset %s has no taxonomy" % asset["assetID"])
+
+        return "taxonomy!%s" % taxonomy
+
+    def epsilons(self, asset, count, start=0):
+        """Sample from the standard normal distribution the epsilons
+        of the given asset for the events [start, start + count).
+
+        :param asset: the asset the epsilons are needed for
+        :type asset: :py:class:`dict` as provided by
+            :py:class:`openquake.parser.exposure.ExposurePortfolioFile`
+        :param int count: the number of events
+        :param int start: the index of the first event
+        :rtype: 1-dimensional :py:class:`numpy.ndarray`
+        """
+        if count <= 0:
+            return zeros(0)
+
+        stream_key = self._stream_key(asset)
+        first_chunk = start // EPSILON_CHUNK
+        last_chunk = (start + count - 1) // EPSILON_CHUNK
+
+        epsilons = concatenate([
+            self._chunk_epsilons(stream_key, chunk)
+            for chunk in xrange(first_chunk, last_chunk + 1)])
+
+        offset = start - first_chunk * EPSILON_CHUNK
+
+        return epsilons[offset:offset + count]
+
+    def _chunk_epsilons(self, stream_key, chunk):
+        """The epsilons of the events of the given chunk of a stream."""
+        digest = hashlib.sha1(
+            "%s!%s!%s" % (self.seed, stream_key, chunk)).digest()
+        generator = random.RandomState(frombuffer(digest[:16], dtype=uint32))
+
+        return generator.standard_normal(EPSILON_CHUNK)
+
+
+def create_epsilon_provider(params):
+    """Create the epsilon provider for a risk job.
+
+    A :py:class:`SeededEpsilonProvider` is used when the job defines an
+    `EPSILON_RANDOM_SEED`, an :py:class:`EpsilonProvider` otherwise.
+
+    :param params: configuration parameters from the job configuration
+    :type params: dict
+    """
+    if params.get("EPSILON_RANDOM_SEED") is not None:
+        return SeededEpsilonProvider(params)
+
+    return EpsilonProvider(params)
+
+
 class Block(object):
     """A block is a collection of sites to compute."""
 
@@ -542,6 +720,149 @@ class Block(object):
         kvs.set_value_json_encoded(block_key, raw_sites)
 
 
+class BlockAssets(object):
+    """The exposure assets of a block, stored by column.
+
+    Asset values, retrofitting costs and coordinates are kept in float
+    arrays (NaN when missing) and the grid point of each asset in integer
+    arrays. All the other attributes (taxonomy, exposure list metadata,
+    etc.) are shared by many assets: they are stored as integer codes
+    (-1 when missing) into a per-attribute table of values.
+    """
+
+    NUMERIC_FIELDS = ("assetValue", "retrofittingCost", "lon", "lat")
+
+    def __init__(self, rows, columns, asset_ids, numbers, codes, tables):
+        self.rows = rows
+        self.columns = columns
+        self.asset_ids = asset_ids
+        self.numbers = numbers
+        self.codes = codes
+        self.tables = tables
+        self._points = None
+
+    @classmethod
+    def from_assets(cls, assets):
+        """Build the columnar representation of the given assets.
+
+        :param assets: iterable of (point, asset) pairs, where point is a
+            :py:class:`openquake.shapes.GridPoint` and asset is a
+            :py:class:`dict` as produced by
+            :py:class:`openquake.parser.exposure.ExposurePortfolioFile`.
+        """
+        rows, columns, asset_ids = [], [], []
+        numbers = dict((field, []) for field in cls.NUMERIC_FIELDS)
+        codes = {}
+        tables = defaultdict(dict)
+
+        for index, (point, asset) in enumerate(assets):
+            rows.append(point.row)
+            columns.append(point.column)
+            asset_ids.append(asset.get("assetID"))
+
+            for field in cls.NUMERIC_FIELDS:
+                numbers[field].append(asset.get(field, nan))
+
+            for field, value in asset.iteritems():
+                if field in numbers or field == "assetID":
+                    continue
+
+                field_codes = codes.setdefault(field, [])
+                field_codes.extend([-1] * (index - len(field_codes)))
+                field_codes.append(
+                    tables[field].setdefault(value, len(tables[field])))
+
+        for field_codes in codes.itervalues():
+            field_codes.extend([-1] * (len(rows) - len(field_codes)))
+
+        return cls(array(rows, dtype=int), array(columns, dtype=int),
+                   asset_ids,
+                   dict((field, array(values, dtype=float))
+                        for field, values in numbers.iteritems()),
+                   dict((field, array(field_codes, dtype=int))
+                        for field, field_codes in codes.iteritems()),
+                   dict((field, sorted(table, key=table.get))
+                        for field, table in tables.iteritems()))
+
+    def __len__(self):
+        return len(self.asset_ids)
+
+    @property
+    def values(self):
+        """The values of the assets."""
+        return self.numbers["assetValue"]
+
+    @property
+    def retrofitting_costs(self):
+        """The retrofitting costs of the assets."""
+        return self.numbers["retrofittingCost"]
+
+    def asset(self, index):
+        """Return the asset with the given index as a :py:class:`dict`."""
+        asset = {}
+
+        if self.asset_ids[index] is not None:
+            asset["assetID"] = self.asset_ids[index]
+
+        for field, values in self.numbers.iteritems():
+            if not isnan(values[index]):
+                asset[field] = float(values[index])
+
+        for field, field_codes in self.codes.iteritems():
+            if field_codes[index] >= 0:
+                asset[field] = self.tables[field][field_codes[index]]
+
+        return asset
+
+    def indices_at(self, point):
+        """Return the indices of the assets located at the given
+        :py:class:`openquake.shapes.GridPoint`."""
+        if self._points is None:
+            self._points = defaultdict(list)
+
+            for index, row_column in enumerate(
+                    izip(self.rows.tolist(), self.columns.tolist())):
+                self._points[row_column].append(index)
+
+        return array(self._points.get((point.row, point.column), []),
+                     dtype=int)
+
+    def assets_at(self, point):
+        """Return the assets located at the given
+        :py:class:`openquake.shapes.GridPoint` as :py:class:`dict`s."""
+        return [self.asset(index) for index in self.indices_at(point)]
+
+    def points_and_assets(self, grid):
+        """Generate the (point, asset) pairs of this block, point being a
+        :py:class:`openquake.shapes.GridPoint` on the given grid."""
+        for index in xrange(len(self)):
+            yield (shapes.GridPoint(grid, int(self.columns[index]),
+                                    int(self.rows[index])),
+                   self.asset(index))
+
+    @staticmethod
+    def from_kvs(calculation_id, block_id):
+        """Return the assets of the block with the given id."""
+        data = kvs.get_client().get(
+            kvs.tokens.block_assets_key(calculation_id, block_id))
+
+        if data is None:
+            return BlockAssets.from_assets([])
+
+        return BlockAssets(**cPickle.loads(data))
+
+    def to_kvs(self, calculation_id, block_id):
+        """Store the assets of the block with the given id into the
+        underlying KVS system, as a single binary blob."""
+        kvs.get_client().set(
+            kvs.tokens.block_assets_key(calculation_id, block_id),
+            cPickle.dumps(dict(rows=self.rows, columns=self.columns,
+                               asset_ids=self.asset_ids,
+                               numbers=self.numbers, codes=self.codes,
+                               tables=self.tables),
+                          cPickle.HIGHEST_PROTOCOL))
+
+
 def split_into_blocks(calculation_id, sites, block_size=BLOCK_SIZE):
     """Creates a generator for splitting a list of sites into
     :class:`openquake.calculators.risk.general.Block`s.
@@ -566,63 +887,97 @@ def split_into_blocks(calculation_id, sites, block_size=BLOCK_SIZE):
                     sites=sites[i:i + block_size])
 
 
-def compute_bcr_for_block(job_id, points, get_loss_curve,
+def compute_bcr_for_block(job_id, points, block_assets, get_mean_loss_ratios,
                           interest_rate, asset_life_expectancy):
     """
     Compute and return Benefit-Cost Ratio data for a number of points.
 
-    :param get_loss_curve:
+    The assets of each point are grouped by taxonomy, so that the mean
+    loss ratios with the original and the retrofitted vulnerability
+    function are computed once per group and the expected annual losses
+    and BCRs of all the assets in it are obtained with array operations.
+
+    :param block_assets: the assets of the block the points belong to.
+    :type block_assets: :py:class:`BlockAssets`
+    :param get_mean_loss_ratios:
         Function that takes three positional arguments: point object,
-        vulnerability function object and asset object and is supposed
-        to return a loss curve.
+        vulnerability function object and a list of assets sharing that
+        vulnerability function, and is supposed to return their mean loss
+        ratios, either as a scalar or as an array with a value per asset.
     :return:
-        A list of tuples::
+        A dictionary of arrays with one item per asset::
 
-            [((site_lat, site_lon), [
-                ({'bcr': 1, 'eal_retrofitted': 2, 'eal_original': 3}, assetID),
-                ({'bcr': 3, 'eal_retrofitted': 4, 'eal_original': 5}, assetID),
-                ...]),
-             ...]
+            {'lat': ..., 'lon': ..., 'assetID': ...,
+             'eal_original': ..., 'eal_retrofitted': ..., 'bcr': ...}
     """
-    # too many local vars (16/15) -- pylint: disable=R0914
-    result = defaultdict(list)
-
     vuln_curves = vulnerability.load_vuln_model_from_kvs(job_id)
     vuln_curves_retrofitted = vulnerability.load_vuln_model_from_kvs(
         job_id, retrofitted=True)
 
+    taxonomies = block_assets.tables.get('taxonomy', [])
+    taxonomy_codes = block_assets.codes.get(
+        'taxonomy', zeros(len(block_assets), dtype=int))
+
+    groups = []
+    eals_original = []
+    eals_retrofitted = []
+
     for point in points:
-        asset_key = kvs.tokens.asset_key(job_id, point.row, point.column)
-        for asset in kvs.get_list_json_decoded(asset_key):
-            vuln_function = vuln_curves[asset['taxonomy']]
-            loss_curve = get_loss_curve(point, vuln_function, asset)
-            LOG.info('for asset %s loss_curve = %s',
-                     asset['assetID'], loss_curve)
-            eal_original = compute_mean_loss(loss_curve)
-
-            vuln_function = vuln_curves_retrofitted[asset['taxonomy']]
-            loss_curve = get_loss_curve(point, vuln_function, asset)
-            LOG.info('for asset %s loss_curve retrofitted = %s',
-                     asset['assetID'], loss_curve)
-            eal_retrofitted = compute_mean_loss(loss_curve)
-
-            bcr = compute_bcr(
-                eal_original, eal_retrofitted,
-                interest_rate, asset_life_expectancy,
-                asset['retrofittingCost']
-            )
-
-            LOG.info('for asset %s EAL original = %f, '
-                     'EAL retrofitted = %f, BCR = %f',
-                     asset['assetID'], eal_original, eal_retrofitted, bcr)
-
-            key = (asset['lat'], asset['lon'])
-            result[key].append(({'bcr': bcr,
-                                 'eal_original': eal_original,
-                                 'eal_retrofitted': eal_retrofitted},
-                                asset['assetID']))
-
-    return result.items()
+        indices = block_assets.indices_at(point)
+
+        for code in unique(taxonomy_codes[indices]):
+            if code < 0:
+                raise ValueError("missing taxonomy for the assets at %s"
+                                 % point.site)
+
+            group = indices[taxonomy_codes[indices] == code]
+            assets = [block_assets.asset(index) for index in group]
+            values = block_assets.values[group]
+
+            eals_original.append(values * get_mean_loss_ratios(
+                point, vuln_curves[taxonomies[code]], assets))
+            eals_retrofitted.append(values * get_mean_loss_ratios(
+                point, vuln_curves_retrofitted[taxonomies[code]], assets))
+            groups.append(group)
+
+    indices = concatenate(groups) if groups else array([], dtype=int)
+
+    result = {
+        'lat': block_assets.numbers['lat'][indices],
+        'lon': block_assets.numbers['lon'][indices],
+        'assetID': array([block_assets.asset_ids[index]
+                          for index in indices]),
+        'eal_original': concatenate(eals_original)
+            if groups else array([], dtype=float),
+        'eal_retrofitted': concatenate(eals_retrofitted)
+            if groups else array([], dtype=float)}
+
+    result['bcr'] = compute_bcr(
+        result['eal_original'], result['eal_retrofitted'],
+        interest_rate, asset_life_expectancy,
+        block_assets.retrofitting_costs[indices])
+
+    LOG.debug('computed the BCR of %s assets', len(result['bcr']))
+
+    return result
+
+
+def store_bcr_block(job_id, block_id, result):
+    """Store in the KVS the BCR data computed for a block.
+
+    :param result: the arrays returned by :func:`compute_bcr_for_block`.
+    """
+    kvs.get_client().set(kvs.tokens.bcr_block_key(job_id, block_id),
+                         cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL))
+
+
+def load_bcr_block(job_id, block_id):
+    """Return the BCR data stored in the KVS for a block.
+
+    :return: the arrays stored by :func:`store_bcr_block`.
+    """
+    return cPickle.loads(kvs.get_client().get(
+        kvs.tokens.bcr_block_key(job_id, block_id)))
 
 
 def compute_loss_curve(loss_ratio_curve, asset):
@@ -647,7 +1002,7 @@ def _compute_mid_mean_pe(loss_ratio_curve):
     ratios = collect(loop(loss_ratios, lambda x, y: mean([x, y])))
     mid_pes = collect(loop(pes, lambda x, y: mean([x, y])))
 
-    return shapes.Curve(zip(ratios, mid_pes))
+    return shapes.Curve.from_arrays(ratios, mid_pes)
 
 
 def _compute_mid_po(loss_ratio_pe_mid_curve):
@@ -660,15 +1015,20 @@ def _compute_mid_po(loss_ratio_pe_mid_curve):
     ratios = collect(loop(loss_ratios, lambda x, y: mean([x, y])))
     pos = collect(loop(pes, lambda x, y: x - y))
 
-    return shapes.Curve(zip(ratios, pos))
+    return shapes.Curve.from_arrays(ratios, pos)
 
 
 def compute_mean_loss(curve):
     """Compute the mean loss (or loss ratio) for the given curve."""
 
-    mid_curve = _compute_mid_po(_compute_mid_mean_pe(curve))
-    return sum(i * j for i, j in zip(
-            mid_curve.abscissae, mid_curve.ordinates))
+    # same as _compute_mid_po(_compute_mid_mean_pe(curve)), on arrays
+    loss_ratios = (curve.abscissae[:-1] + curve.abscissae[1:]) / 2.0
+    pes = (curve.ordinates[:-1] + curve.ordinates[1:]) / 2.0
+
+    mid_loss_ratios = (loss_ratios[:-1] + loss_ratios[1:]) / 2.0
+    pos = pes[:-1] - pes[1:]
+
+    return float((mid_loss_ratios * pos).sum())
 
 
 def loop(elements, func, *args):
@@ -719,7 +1079,7 @@ def compute_bcr(eal_original, eal_retrofitted, interest_rate,
 
 
 def compute_loss_ratios(vuln_function, ground_motion_field_set,
-        epsilon_provider, asset):
+        epsilon_provider, asset, start=0):
     """Compute the set of loss ratios using the set of
     ground motion fields passed.
 
@@ -739,6 +1099,9 @@ def compute_loss_ratios(vuln_function, ground_motion_field_set,
     :param asset: the asset used to compute the loss ratios.
     :type asset: :py:class:`dict` as provided by
         :py:class:`openquake.parser.exposure.ExposurePortfolioFile`
+    :param int start: the index of the event of the first ground motion
+        field, when the set is a slice of the events of the job (see
+        :py:meth:`SeededEpsilonProvider.epsilons`)
     """
 
     if vuln_function.is_empty:
@@ -750,11 +1113,11 @@ def compute_loss_ratios(vuln_function, ground_motion_field_set,
         return _mean_based(vuln_function, ground_motion_field_set)
     else:
         return _sampled_based(vuln_function, ground_motion_field_set,
-                epsilon_provider, asset)
+                epsilon_provider, asset, start)
 
 
 def _sampled_based(vuln_function, ground_motion_field_set,
-        epsilon_provider, asset):
+        epsilon_provider, asset, start=0):
     """Compute the set of loss ratios when at least one CV
     (Coefficent of Variation) defined in the vulnerability function
     is greater than zero.
@@ -775,29 +1138,26 @@ def _sampled_based(vuln_function, ground_motion_field_set,
     :param asset: the asset used to compute the loss ratios.
     :type asset: :py:class:`dict` as provided by
         :py:class:`openquake.parser.exposure.ExposurePortfolioFile`
+    :param int start: the index of the event of the first ground motion
+        field
     """
 
-    loss_ratios = []
+    imls = array(ground_motion_field_set["IMLs"], dtype=float)
+    means = vuln_function.loss_ratio_for(imls)
 
-    means = vuln_function.loss_ratio_for(ground_motion_field_set["IMLs"])
-    covs = vuln_function.cov_for(ground_motion_field_set["IMLs"])
-
-    for mean_ratio, cov in zip(means, covs):
-        if mean_ratio <= 0.0:
-            loss_ratios.append(0.0)
-        else:
-            variance = (mean_ratio * cov) ** 2.0
-
-            epsilon = epsilon_provider.epsilon(asset)
-            sigma = math.sqrt(
-                        math.log((variance / mean_ratio ** 2.0) + 1.0))
-
-            mu = math.log(mean_ratio ** 2.0 / math.sqrt(
-                    variance + mean_ratio ** 2.0))
+    if isinstance(epsilon_provider, SeededEpsilonProvider):
+        # one epsilon per event, sampled at once
+        epsilons = epsilon_provider.epsilons(asset, len(imls), start)
+    else:
+        # epsilons are drawn only for the events with a positive
+        # mean loss ratio, as they are consumed in order
+        epsilons = zeros(len(imls))
 
-            loss_ratios.append(math.exp(mu + (epsilon * sigma)))
+        for i, mean_ratio in enumerate(means):
+            if mean_ratio > 0.0:
+                epsilons[i] = epsilon_provider.epsilon(asset)
 
-    return array(loss_ratios)
+    return vuln_function.sample_loss_ratios(imls, epsilons, means)
 
 
 def _mean_based(vuln_function, ground_motion_field_set):
@@ -816,30 +1176,13 @@ def _mean_based(vuln_function, ground_motion_field_set):
         **TSES** - time representative of the Stochastic Event Set (float)
     """
 
-    loss_ratios = []
-    retrieved = {}
     imls = vuln_function.imls
+    ground_motion_fields = array(ground_motion_field_set["IMLs"], dtype=float)
 
-    # seems like with numpy you can only specify a single fill value
-    # if the x_new is outside the range. Here we need two different values,
-    # depending if the x_new is below or upon the defined values
-    for ground_motion_field in ground_motion_field_set["IMLs"]:
-        if ground_motion_field < imls[0]:
-            loss_ratios.append(0.0)
-        elif ground_motion_field > imls[-1]:
-            loss_ratios.append(vuln_function.loss_ratios[-1])
-        else:
-            # The actual value is computed later
-            mark = len(loss_ratios)
-            retrieved[mark] = ground_motion_field_set['IMLs'][mark]
-            loss_ratios.append(0.0)
-
-    means = vuln_function.loss_ratio_for(retrieved.values())
-
-    for mark, mean_ratio in zip(retrieved.keys(), means):
-        loss_ratios[mark] = mean_ratio
-
-    return array(loss_ratios)
+    # numpy.interp clips to the first loss ratio below the defined
+    # values, but here the loss ratio must be zero
+    return where(ground_motion_fields < imls[0], 0.0,
+            vuln_function.loss_ratio_for(ground_motion_fields))
 
 
 def _compute_loss_ratios_range(loss_ratios, loss_histogram_bins):
@@ -949,15 +1292,8 @@ class Lognorm(object):
         vuln_function = kwargs.get('vf')
         position = kwargs.get('col')
 
-        vf_loss_ratio = vuln_function.loss_ratios[position]
-
-        stddev = vuln_function.covs[position] * vf_loss_ratio
-
-        variance = stddev ** 2.0
-
-        sigma = sqrt(log((variance / vf_loss_ratio ** 2.0) + 1.0))
-        mu = exp(log(vf_loss_ratio ** 2.0 /
-            sqrt(variance + vf_loss_ratio ** 2.0)))
+        sigma = vuln_function.sigmas[position]
+        mu = exp(vuln_function.mus[position])
 
         return stats.lognorm.sf(loss_ratio, sigma, scale=mu)
 
@@ -1045,7 +1381,7 @@ def _generate_curve(losses, probs_of_exceedance):
     """
 
     mean_losses = collect(loop(losses, lambda x, y: mean([x, y])))
-    return shapes.Curve(zip(mean_losses, probs_of_exceedance))
+    return shapes.Curve.from_arrays(mean_losses, probs_of_exceedance)
 
 
 class AggregateLossCurve(object):
@@ -1094,3 +1430,82 @@ class AggregateLossCurve(object):
                 losses, loss_range), tses), time_span)
 
         return _generate_curve(loss_range, probs_of_exceedance)
+
+
+class AggregateLosses(object):
+    """Aggregate the losses of a set of assets, both as a whole and
+    grouped by the values of some asset attributes (e.g. taxonomy).
+
+    Instances are mergeable: each block task accumulates the losses of
+    its own assets, stores the partial sums in the KVS with
+    :py:meth:`to_kvs` and the master folds them in, in any order, with
+    :py:meth:`merge_from_kvs` as soon as each task completes. This way
+    the per-event loss vectors never travel through the result backend.
+    """
+
+    def __init__(self, group_by=("taxonomy",)):
+        self.group_by = tuple(group_by)
+        self.curves = defaultdict(AggregateLossCurve)
+
+    def append(self, asset, losses):
+        """Accumulate the losses of the given asset.
+
+        :param asset: the asset the losses refer to.
+        :type asset: :py:class:`dict`
+        :param losses: an array of loss values.
+        :type losses: 1-dimensional :py:class:`numpy.ndarray`
+        """
+
+        self.curves[None].append(losses)
+
+        for attribute in self.group_by:
+            self.curves[(attribute, asset.get(attribute))].append(losses)
+
+    def merge(self, other):
+        """Fold the partial sums of another aggregate into this one.
+
+        :param other: the losses to merge, either another
+            :py:class:`AggregateLosses` or the dictionary of its sums.
+        """
+
+        sums = other if isinstance(other, dict) else other.sums()
+
+        for group, losses in sums.iteritems():
+            self.curves[group].append(losses)
+
+    def sums(self):
+        """Return the partial sums keyed by group, the total being
+        keyed by `None`."""
+        return dict((group, curve.losses)
+                    for group, curve in self.curves.iteritems()
+                    if not curve.empty)
+
+    @property
+    def total(self):
+        """The aggregate curve of all the assets."""
+        return self.curves[None]
+
+    def groups(self, attribute):
+        """Return the aggregate curves for the given asset attribute,
+        keyed by attribute value."""
+        return dict((group[1], curve)
+                    for group, curve in self.curves.iteritems()
+                    if group is not None and group[0] == attribute)
+
+    def to_kvs(self, job_id, block_id):
+        """Store the partial sums of this aggregate in the KVS."""
+        key = kvs.tokens.aggregate_losses_key(job_id, block_id)
+        kvs.get_client().set(key, cPickle.dumps(
+            self.sums(), cPickle.HIGHEST_PROTOCOL))
+
+    def merge_from_kvs(self, job_id, block_id):
+        """Merge and discard the partial sums stored in the KVS by the
+        task computing the given block."""
+        key = kvs.tokens.aggregate_losses_key(job_id, block_id)
+        client = kvs.get_client()
+
+        data = client.get(key)
+
+        if data is not None:
+            self.merge(cPickle.loads(data))
+            client.delete(key)
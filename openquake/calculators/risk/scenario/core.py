@@ -22,9 +22,12 @@ event based approach.
 """
 
 
+import functools
 import numpy
 import os
 
+from collections import OrderedDict
+
 from openquake import kvs
 from openquake import logs
 from openquake import shapes
@@ -36,6 +39,10 @@ from openquake.calculators.risk import general
 
 LOGGER = logs.LOG
 
+# number of ground motion fields (realizations) whose losses are computed
+# by a task
+GMF_BATCH_SIZE = 1000
+
 
 class ScenarioRiskCalculator(general.BaseRiskCalculator):
     """Scenario method for performing risk calculations."""
@@ -49,46 +56,57 @@ class ScenarioRiskCalculator(general.BaseRiskCalculator):
         LOGGER.debug("This will calculate mean and standard deviation loss"
             "values for the region defined in the job config.")
 
-        tasks = []
+        # the statistics of the region loss of each realization, and of
+        # the losses of each asset
+        region_stats = LossStatistics()
+        region_loss_map_data = OrderedDict()
 
-        vuln_model = \
-            vulnerability.load_vuln_model_from_kvs(self.calc_proxy.job_id)
+        gmfs = int(self.calc_proxy.params[
+            "NUMBER_OF_GROUND_MOTION_FIELDS_CALCULATIONS"])
 
-        epsilon_provider = general.EpsilonProvider(self.calc_proxy.params)
+        # the realizations are processed in batches: the losses of a batch
+        # are summed over all the blocks, then only their statistics are
+        # kept
+        for start in xrange(0, gmfs, GMF_BATCH_SIZE):
+            tasks = []
 
-        sum_per_gmf = SumPerGroundMotionField(vuln_model,
-                                                       epsilon_provider)
+            for block_id in self.calc_proxy.blocks_keys:
+                LOGGER.debug("Dispatching task for block %s of %s, "
+                    "realizations from %s"
+                    % (block_id, len(self.calc_proxy.blocks_keys), start))
+                a_task = general.compute_risk.delay(
+                    self.calc_proxy.job_id, block_id, start=start,
+                    size=GMF_BATCH_SIZE)
+                tasks.append(a_task)
 
-        region_loss_map_data = {}
+            sum_per_gmf = SumPerGroundMotionField(None, None)
 
-        for block_id in self.calc_proxy.blocks_keys:
-            LOGGER.debug("Dispatching task for block %s of %s"
-                % (block_id, len(self.calc_proxy.blocks_keys)))
-            a_task = general.compute_risk.delay(
-                self.calc_proxy.job_id, block_id, vuln_model=vuln_model,
-                epsilon_provider=epsilon_provider)
-            tasks.append(a_task)
+            for task in tasks:
+                task.wait()
+                if not task.successful():
+                    raise Exception(task.result)
 
-        for task in tasks:
-            task.wait()
-            if not task.successful():
-                raise Exception(task.result)
+                block_loss, block_loss_map_data = task.result
 
-            block_loss, block_loss_map_data = task.result
+                # do some basic validation on our results
+                assert block_loss is not None, "Expected a result != None"
+                assert isinstance(block_loss, numpy.ndarray), \
+                    "Expected a numpy array"
 
-            # do some basic validation on our results
-            assert block_loss is not None, "Expected a result != None"
-            assert isinstance(block_loss, numpy.ndarray), \
-                "Expected a numpy array"
+                # our result should be a 1-dimensional numpy.array of loss
+                # values
+                sum_per_gmf.sum_losses(block_loss)
 
-            # our result should be a 1-dimensional numpy.array of loss values
-            sum_per_gmf.sum_losses(block_loss)
+                collect_region_data(
+                    block_loss_map_data, region_loss_map_data)
 
-            collect_region_data(
-                block_loss_map_data, region_loss_map_data)
+            region_stats.update(sum_per_gmf.losses)
 
-        loss_map_data = [(site, data)
-                for site, data in region_loss_map_data.iteritems()]
+        loss_map_data = [
+            (site, [({'mean_loss': stats.mean, 'stddev_loss': stats.stddev},
+                     {'assetID': asset_id})
+                    for asset_id, stats in site_stats.iteritems()])
+            for site, site_stats in region_loss_map_data.iteritems()]
 
         # serialize the loss map data to XML
         loss_map_path = os.path.join(
@@ -110,8 +128,8 @@ class ScenarioRiskCalculator(general.BaseRiskCalculator):
 
         # For now, just print these values.
         # These are not debug statements; please don't remove them!
-        print "Mean region loss value: %s" % sum_per_gmf.mean
-        print "Standard deviation region loss value: %s" % sum_per_gmf.stddev
+        print "Mean region loss value: %s" % region_stats.mean
+        print "Standard deviation region loss value: %s" % region_stats.stddev
 
     def compute_risk(self, block_id, **kwargs):
         """
@@ -131,6 +149,9 @@ class ScenarioRiskCalculator(general.BaseRiskCalculator):
         gives 1 loss value _per_ asset _per_ realization. We then need to take
         the mean & standard deviation.
 
+        Only a batch of the realizations is computed by a task: the
+        statistics of the assets are merged by the caller.
+
         Other info:
 
         The GMF data for each realization is stored in the KVS by the preceding
@@ -139,58 +160,43 @@ class ScenarioRiskCalculator(general.BaseRiskCalculator):
         :param block_id: id of the region block data we need to pull from the
             KVS
         :type block_id: str
-        :keyword vuln_model:
-            dict of :py:class:`openquake.shapes.VulnerabilityFunction` objects,
-            keyed by the vulnerability function name as a string
-        :keyword epsilon_provider:
-            :py:class:`openquake.risk.job.EpsilonProvider` object
+        :keyword start: the index of the first realization of the batch,
+            0 by default
+        :keyword size: the number of realizations of the batch, all the
+            realizations from `start` by default
 
         :returns: 2-tuple of the following data:
             * 1-dimensional :py:class:`numpy.ndarray` of loss values for this
                 region block (again, 1 value per realization)
 
-            * list of 2-tuples containing Site, Loss, and Asset
-                information.
-
-                The first element of each 2-tuple shall be a
-                :py:class:`openquake.shapes.Site` object, which represents the
-                geographical location of the asset loss.
-
-                The second element shall be a list of
-                2-tuples of dicts representing the Loss and Asset data (in that
-                order).
-
-                Example::
-
-                    [(<Site(-117.0, 38.0)>,
-                     [({'mean_loss': 200.0, 'stddev_loss': 100},
-                      {'assetID': 'a171'}), ({'mean_loss': 200.0,
-                      'stddev_loss': 100}, {'assetID': 'a187'})]),
-                     (<Site(-117.0, 38.0)>,
-                     ({'mean_loss': 200, 'stddev_loss': 100.0},
-                      {'assetID': 'a172'})),
-                     ...
-                     (<Site(-118.0, 39.0)>,
-                     ({'mean_loss': 50, 'stddev_loss': 50.0},
-                      {'assetID': 'a192'}))]
-
+            * dict of the loss statistics of the assets in the block, see
+                :meth:`_compute_losses_for_block`
         """
-        vuln_model = kwargs['vuln_model']
-        epsilon_provider = kwargs['epsilon_provider']
+        # the vulnerability model is shared by all the tasks of the job and
+        # fetched only once per worker process
+        vuln_model = \
+            vulnerability.load_vuln_model_from_kvs(self.calc_proxy.job_id)
+        # rebuilt from the job parameters, instead of being sent along
+        # with every task
+        epsilon_provider = general.create_epsilon_provider(
+            self.calc_proxy.params)
 
         block = general.Block.from_kvs(self.calc_proxy.job_id, block_id)
 
-        block_losses = self._compute_loss_for_block(
-            block, vuln_model, epsilon_provider)
-
-        asset_losses = self._compute_asset_losses_for_block(
-            block, vuln_model, epsilon_provider)
+        return self._compute_losses_for_block(
+            block, vuln_model, epsilon_provider, kwargs.get('start', 0),
+            kwargs.get('size'))
 
-        return block_losses, asset_losses
-
-    def _compute_loss_for_block(self, block, vuln_model, epsilon_provider):
+    def _compute_losses_for_block(self, block, vuln_model, epsilon_provider,
+                                  start=0, size=None):
         """
-        Compute the sum of all asset losses for the given region block.
+        Compute the sum of all asset losses for the given region block,
+        together with the statistics of the losses of each asset in the
+        block, for a batch of realizations.
+
+        The loss ratios of each asset are sampled only once: the same
+        realizations feed the block sum and the per-asset statistics,
+        which are therefore statistically consistent with each other.
 
         :param block: a block of sites represented by a
             :py:class:`openquake.job.Block` object
@@ -199,223 +205,81 @@ class ScenarioRiskCalculator(general.BaseRiskCalculator):
             keyed by the vulnerability function name as a string
         :param epsilon_provider:
             :py:class:`openquake.risk.job.EpsilonProvider` object
+        :param int start: the index of the first realization
+        :param int size: the number of realizations, all the realizations
+            from `start` when None
 
-        :returns: 1-dimensional :py:class:`numpy.ndarray` of floats
-            representing loss values for this block. There will be one value
-            per realization.
+        :returns: 2-tuple of the following data:
+            * 1-dimensional :py:class:`numpy.ndarray` of floats
+                representing loss values for this block. There will be one
+                value per realization.
 
+            * dict of the :py:class:`LossStatistics` of the assets, keyed by
+                :py:class:`openquake.shapes.Site` and then by asset id
         """
-        sum_per_gmf = SumPerGroundMotionField(vuln_model,
-                                                       epsilon_provider)
-        for point in block.grid(self.calc_proxy.region):
-            gmvs = load_gmvs_for_point(self.calc_proxy.job_id, point)
-            assets = load_assets_for_point(self.calc_proxy.job_id, point)
-            for asset in assets:
-                # the SumPerGroundMotionField add() method expects a dict
-                # with a single key ('IMLs') and value set to the sequence of
-                # GMVs
-                sum_per_gmf.add({'IMLs': gmvs}, asset)
-        return sum_per_gmf.losses
-
-    def _compute_asset_losses_for_block(
-        self, block, vuln_model, epsilon_provider):
-        """
-        Compute the mean & standard deviation loss values for each asset in the
-        given block.
+        # the epsilons of seeded jobs are keyed on the realization
+        sum_per_gmf = SumPerGroundMotionField(
+            vuln_model, epsilon_provider, lr_calculator=functools.partial(
+                general.compute_loss_ratios, start=start))
+        loss_data = OrderedDict()
 
-        :param block: a block of sites represented by a
-            :py:class:`openquake.job.Block` object
-        :param vuln_model:
-            dict of :py:class:`openquake.shapes.VulnerabilityFunction` objects,
-            keyed by the vulnerability function name as a string
-        :param epsilon_provider:
-            :py:class:`openquake.risk.job.EpsilonProvider` object
-
-        :returns: list of 2-tuples containing Site, Loss, and Asset
-            information.
-
-            The first element of each 2-tuple shall be a
-            :py:class:`openquake.shapes.Site` object, which represents the
-            geographical location of the asset loss.
-
-            The second element shall be a list of
-            2-tuples of dicts representing the Loss and Asset data (in that
-            order).
-
-            Example::
-
-                [(<Site(-117.0, 38.0)>,
-                 [({'mean_loss': 200.0, 'stddev_loss': 100},
-                  {'assetID': 'a171'}), ({'mean_loss': 200.0,
-                  'stddev_loss': 100}, {'assetID': 'a187'})]),
-                 (<Site(-117.0, 38.0)>,
-                 ({'mean_loss': 200, 'stddev_loss': 100.0},
-                  {'assetID': 'a172'})),
-                 ...
-                 (<Site(-118.0, 39.0)>,
-                 ({'mean_loss': 50, 'stddev_loss': 50.0},
-                  {'assetID': 'a192'}))]
-        """
-        loss_data = {}
+        block_assets = general.BlockAssets.from_kvs(
+            self.calc_proxy.job_id, block.block_id)
 
         for point in block.grid(self.calc_proxy.region):
-            # the mean and stddev calculation functions used below
-            # require the gmvs to be wrapped in a dict with a single key:
-            # 'IMLs'
+            # the loss ratios calculator requires the gmvs to be
+            # wrapped in a dict with a single key: 'IMLs'
             gmvs = {'IMLs': load_gmvs_for_point(self.calc_proxy.job_id,
-                                                point)}
-            assets = load_assets_for_point(self.calc_proxy.job_id, point)
-            for asset in assets:
-                vuln_function = \
-                    vuln_model[asset['taxonomy']]
+                                                point, start, size)}
+            for asset in block_assets.assets_at(point):
+                losses = sum_per_gmf.add(gmvs, asset)
 
-                asset_mean_loss = compute_mean_loss(
-                    vuln_function, gmvs, epsilon_provider, asset)
+                if losses is None:
+                    continue
 
-                asset_stddev_loss = compute_stddev_loss(
-                    vuln_function, gmvs, epsilon_provider, asset)
+                stats = LossStatistics()
+                stats.update(losses)
 
                 asset_site = shapes.Site(asset['lon'], asset['lat'])
+                loss_data.setdefault(
+                    asset_site, OrderedDict())[asset['assetID']] = stats
 
-                loss = ({'mean_loss': asset_mean_loss,
-                         'stddev_loss': asset_stddev_loss},
-                        {'assetID': asset['assetID']})
-
-                collect_block_data(loss_data, asset_site, loss)
-
-        return loss_data
+        return sum_per_gmf.losses, loss_data
 
 
-def load_gmvs_for_point(job_id, point):
+def load_gmvs_for_point(job_id, point, start=0, size=None):
     """
-    From the KVS, load all the ground motion values for the given point. We
+    From the KVS, load the ground motion values for the given point. We
     expect one ground motion value per realization of the calculation.
-    Since there can be tens of thousands of realizations, this could return a
-    large list.
-
-    Note(LB): In the future, we may want to refactor this (and the code which
-    uses the values) to use a generator instead.
+    Since there can be tens of thousands of realizations, they can be
+    loaded in batches.
 
     :param point: :py:class:`openquake.shapes.GridPoint` object
+    :param int start: the index of the first realization
+    :param int size: the number of realizations, all the realizations from
+        `start` when None
 
     :returns: List of ground motion values (as floats). Each value represents a
         realization of the calculation for a single point.
     """
     gmfs_key = kvs.tokens.ground_motion_values_key(job_id, point)
-    return [float(x['mag']) for x in kvs.get_list_json_decoded(gmfs_key)]
-
-
-def load_assets_for_point(job_id, point):
-    """
-    From the KVS, load all assets for the given point.
-
-    :param point: :py:class:`openquake.shapes.GridPoint` object
+    stop = -1 if size is None else start + size - 1
 
-    :returns: List of asset dicts at the given location (point) in the
-        following form::
-            {u'assetValue': 124.27, u'taxonomy': u'ID'}
-    """
-    assets_key = kvs.tokens.asset_key(job_id, point.row, point.column)
-    return kvs.get_list_json_decoded(assets_key)
+    return [float(x['mag'])
+            for x in kvs.get_list_json_decoded(gmfs_key, start, stop)]
 
 
 def collect_region_data(block_loss_map_data, region_loss_map_data):
-    """Collect the loss map data for all the region."""
-    for site, data in block_loss_map_data.iteritems():
-        if site in region_loss_map_data:
-            region_loss_map_data[site].extend(data)
-        else:
-            region_loss_map_data[site] = data
-
+    """Merge the loss statistics of the assets of a block, for a batch of
+    realizations, into the ones of the region."""
+    for site, block_stats in block_loss_map_data.iteritems():
+        site_stats = region_loss_map_data.setdefault(site, OrderedDict())
 
-def collect_block_data(loss_data, asset_site, asset_data):
-    """Collect the loss map map for a single block."""
-    data = loss_data.get(asset_site, [])
-    data.append(asset_data)
-    loss_data[asset_site] = data
-
-
-def _mean_loss_from_loss_ratios(loss_ratios, asset):
-    """Compute the mean loss using the set of loss ratios given.
-
-    :param loss_ratios: the set of loss ratios used.
-    :type loss_ratios: numpy.ndarray
-    :param asset: the asset used to compute the losses.
-    :type asset: :py:class:`dict` as provided by
-        :py:class:`openquake.parser.exposure.ExposurePortfolioFile`
-    """
-
-    losses = loss_ratios * asset["assetValue"]
-    return numpy.mean(losses)
-
-
-def _stddev_loss_from_loss_ratios(loss_ratios, asset):
-    """Compute the standard deviation of the losses
-    using the set of loss ratios given.
-
-    :param loss_ratios: the set of loss ratios used.
-    :type loss_ratios: numpy.ndarray
-    :param asset: the asset used to compute the losses.
-    :type asset: :py:class:`dict` as provided by
-        :py:class:`openquake.parser.exposure.ExposurePortfolioFile`
-    """
-
-    losses = loss_ratios * asset["assetValue"]
-    return numpy.std(losses, ddof=1)
-
-
-def compute_mean_loss(vuln_function, ground_motion_field_set,
-                      epsilon_provider, asset):
-    """Compute the mean loss for the given asset using the
-    related ground motion field set and vulnerability function.
-
-    :param vuln_function: the vulnerability function used to
-        compute the loss ratios.
-    :type vuln_function: :py:class:`openquake.shapes.VulnerabilityFunction`
-    :param ground_motion_field_set: the set of ground motion
-        fields used to compute the loss ratios.
-    :type ground_motion_field_set: :py:class:`dict` with the following
-        keys:
-        **IMLs** - tuple of ground motion fields (float)
-    :param epsilon_provider: service used to get the epsilon when
-        using the sampled based algorithm.
-    :type epsilon_provider: object that defines an :py:meth:`epsilon` method
-    :param asset: the asset used to compute the loss ratios and losses.
-    :type asset: :py:class:`dict` as provided by
-        :py:class:`openquake.parser.exposure.ExposurePortfolioFile`
-    """
-
-    loss_ratios = general.compute_loss_ratios(
-        vuln_function, ground_motion_field_set, epsilon_provider, asset)
-
-    return _mean_loss_from_loss_ratios(loss_ratios, asset)
-
-
-def compute_stddev_loss(vuln_function, ground_motion_field_set,
-                        epsilon_provider, asset):
-    """Compute the standard deviation of the losses for the given asset
-    using the related ground motion field set and vulnerability function.
-
-    :param vuln_function: the vulnerability function used to
-        compute the loss ratios.
-    :type vuln_function: :py:class:`openquake.shapes.VulnerabilityFunction`
-    :param ground_motion_field_set: the set of ground motion
-        fields used to compute the loss ratios.
-    :type ground_motion_field_set: :py:class:`dict` with the following
-        keys:
-        **IMLs** - tuple of ground motion fields (float)
-    :param epsilon_provider: service used to get the epsilon when
-        using the sampled based algorithm.
-    :type epsilon_provider: object that defines an :py:meth:`epsilon` method
-    :param asset: the asset used to compute the loss ratios and losses.
-    :type asset: :py:class:`dict` as provided by
-        :py:class:`openquake.parser.exposure.ExposurePortfolioFile`
-    """
-
-    loss_ratios = general.compute_loss_ratios(
-        vuln_function, ground_motion_field_set, epsilon_provider, asset)
-
-    return _stddev_loss_from_loss_ratios(loss_ratios, asset)
+        for asset_id, stats in block_stats.iteritems():
+            if asset_id in site_stats:
+                site_stats[asset_id].merge(stats)
+            else:
+                site_stats[asset_id] = stats
 
 
 class SumPerGroundMotionField(object):
@@ -464,6 +328,10 @@ class SumPerGroundMotionField(object):
         :param asset: the asset used to compute the loss ratios and losses.
         :type asset: :py:class:`dict` as provided by
             :py:class:`openquake.parser.exposure.ExposurePortfolioFile`
+
+        :returns: the losses computed for the asset (1 per realization),
+            or None if the asset has been discarded
+        :rtype: 1-dimensional :py:class:`numpy.ndarray`
         """
 
         if asset["taxonomy"] not in self.vuln_model:
@@ -472,7 +340,7 @@ class SumPerGroundMotionField(object):
                       % (asset["taxonomy"],
                       asset["assetID"]))
 
-            return
+            return None
 
         vuln_function = self.vuln_model[
             asset["taxonomy"]]
@@ -485,6 +353,8 @@ class SumPerGroundMotionField(object):
 
         self.sum_losses(losses)
 
+        return losses
+
     def sum_losses(self, losses):
         """
         Accumulate losses into a single sum.
@@ -517,3 +387,64 @@ class SumPerGroundMotionField(object):
         :rtype: numpy.float64
         """
         return numpy.std(self.losses, ddof=1)
+
+
+class LossStatistics(object):
+    """Streaming mean and standard deviation of a set of losses.
+
+    Values are accumulated with the Welford (and Chan et al. for batches)
+    update, so the statistics can be computed without keeping all the
+    losses in memory and partial results can be merged in any order.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def update(self, losses):
+        """Accumulate the given losses.
+
+        :param losses: an array of loss values (1 per realization)
+        :type losses: 1-dimensional :py:class:`numpy.ndarray`
+        """
+        losses = numpy.asarray(losses, dtype=float)
+
+        if losses.size == 0:
+            return
+
+        batch_mean = losses.mean()
+        batch_m2 = ((losses - batch_mean) ** 2).sum()
+
+        self._combine(losses.size, batch_mean, batch_m2)
+
+    def merge(self, other):
+        """Merge the statistics accumulated by another instance.
+
+        :param other: the statistics to merge into this one
+        :type other: :py:class:`LossStatistics`
+        """
+        if other.count:
+            self._combine(other.count, other.mean, other._m2)
+
+    def _combine(self, count, mean, m2):
+        """Combine the current statistics with the ones of a batch."""
+        total = self.count + count
+        delta = mean - self.mean
+
+        self.mean += delta * count / float(total)
+        self._m2 += m2 + delta ** 2 * self.count * count / float(total)
+        self.count = total
+
+    @property
+    def stddev(self):
+        """Return the sample standard deviation of the losses.
+
+        :returns: the standard deviation of the losses accumulated so far,
+            NaN if less than two values are available
+        :rtype: float
+        """
+        if self.count < 2:
+            return float("nan")
+
+        return numpy.sqrt(self._m2 / (self.count - 1))
@@ -28,6 +28,16 @@ from datetime import datetime
 from django.contrib.gis.db import models
 from django.contrib.gis.geos.geometry import GEOSGeometry
 
+from openquake.utils import db
+
+
+# the number of characters of the geohashes identifying the hazard curve
+# locations
+GEOHASH_PRECISION = 12
+
+# the number of locations looked up by a single hazard curve query
+GEOHASH_BATCH_SIZE = 500
+
 
 def per_asset_value(exd):
     """Return per-asset value for the given exposure data set.
@@ -119,6 +129,60 @@ def model_equals(model_a, model_b, ignore=None):
     return True
 
 
+def hazard_curves_by_geohash(calculation, geohashes, statistic_type="mean",
+                             batch_size=GEOHASH_BATCH_SIZE):
+    """Read the hazard curves of a calculation at many locations, with one
+    query per `batch_size` locations instead of one query per location.
+
+    The locations are matched by their geohash, see the
+    `hzrdr_hazard_curve_data_hazard_curve_id_geohash_idx` index.
+
+    :param calculation: the :class:`OqCalculation` that computed the curves
+    :param geohashes: the geohashes (with `GEOHASH_PRECISION` characters)
+        of the locations
+    :param str statistic_type: the statistic type of the curves
+    :param int batch_size: the number of locations looked up per query
+    :returns: a dictionary mapping each geohash to the PoEs of its curve,
+        locations without a curve are left out
+    """
+    geohash = "ST_GeoHash(location, %d)" % GEOHASH_PRECISION
+    geohashes = list(set(geohashes))
+    curves = {}
+
+    for start in xrange(0, len(geohashes), batch_size):
+        batch = geohashes[start:start + batch_size]
+        rows = HazardCurveData.objects.filter(
+            hazard_curve__output__oq_calculation=calculation,
+            hazard_curve__statistic_type=statistic_type).extra(
+            select={"geohash": geohash},
+            where=["%s IN (%s)" % (geohash, ", ".join(["%s"] * len(batch)))],
+            params=batch).values_list("geohash", "poes")
+        curves.update(rows)
+
+    return curves
+
+
+def gmf_values(output_ids, size=db.DEFAULT_FETCH_SIZE):
+    """Read the ground motion values of many GMF outputs with a single
+    query.
+
+    :param output_ids: the ids of the GMF :class:`Output` records
+    :param int size: the number of rows fetched at a time
+    :returns: a generator of (output id, longitude, latitude, ground motion)
+        tuples, sorted by output id
+    """
+    if not output_ids:
+        return
+
+    queryset = GmfData.objects.filter(output__in=output_ids).extra(
+        select=db.point_coordinates(GmfData)).order_by(
+        "output", "id").values_list("output", "lon", "lat", "ground_motion")
+
+    for batch in db.stream_values_list(queryset, size):
+        for row in batch:
+            yield row
+
+
 class FloatArrayField(models.Field):  # pylint: disable=R0904
     """This field models a postgres `float` array."""
 
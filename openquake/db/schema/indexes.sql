@@ -57,6 +57,7 @@ CREATE INDEX uiapi_oq_calculation_owner_id_idx on uiapi.oq_calculation(owner_id)
 CREATE INDEX uiapi_oq_job_profile_owner_id_idx on uiapi.oq_job_profile(owner_id);
 CREATE INDEX uiapi_oq_calculation_status_running on uiapi.oq_calculation(status) WHERE status = 'running';
 CREATE INDEX uiapi_output_owner_id_idx on uiapi.output(owner_id);
+CREATE INDEX uiapi_output_oq_calculation_id_idx on uiapi.output(oq_calculation_id, output_type);
 CREATE INDEX uiapi_upload_owner_id_idx on uiapi.upload(owner_id);
 
 -- uiapi indexes on foreign keys
@@ -69,8 +70,12 @@ CREATE INDEX hzrdr_hazard_map_data_hazard_map_id_idx on hzrdr.hazard_map_data(ha
 -- hazard curve
 CREATE INDEX hzrdr_hazard_curve_output_id_idx on hzrdr.hazard_curve(output_id);
 CREATE INDEX hzrdr_hazard_curve_data_hazard_curve_id_idx on hzrdr.hazard_curve_data(hazard_curve_id);
+-- risk calculations look up the curves of a site by geohash
+CREATE INDEX hzrdr_hazard_curve_data_hazard_curve_id_geohash_idx on hzrdr.hazard_curve_data(hazard_curve_id, ST_GeoHash(location, 12));
+CREATE INDEX hzrdr_hazard_curve_data_location_idx on hzrdr.hazard_curve_data USING gist(location);
 -- gmf
 CREATE INDEX hzrdr_gmf_data_output_id_idx on hzrdr.gmf_data(output_id);
+CREATE INDEX hzrdr_gmf_data_location_idx on hzrdr.gmf_data USING gist(location);
 -- uhs
 CREATE INDEX hzrdr_uh_spectra_output_id_idx on hzrdr.uh_spectra(output_id);
 CREATE INDEX hzrdr_uh_spectrum_uh_spectra_id_idx on hzrdr.uh_spectrum(uh_spectra_id);
@@ -79,8 +84,10 @@ CREATE INDEX hzrdr_uh_spectrum_data_uh_spectrum_id_idx on hzrdr.uh_spectrum_data
 -- riskr indexes
 CREATE INDEX riskr_loss_map_output_id_idx on riskr.loss_map(output_id);
 CREATE INDEX riskr_loss_map_data_loss_map_id_idx on riskr.loss_map_data(loss_map_id);
+CREATE INDEX riskr_loss_map_data_location_idx on riskr.loss_map_data USING gist(location);
 CREATE INDEX riskr_loss_curve_output_id_idx on riskr.loss_curve(output_id);
 CREATE INDEX riskr_loss_curve_data_loss_curve_id_idx on riskr.loss_curve_data(loss_curve_id);
+CREATE INDEX riskr_loss_curve_data_location_idx on riskr.loss_curve_data USING gist(location);
 CREATE INDEX riskr_aggregate_loss_curve_data_loss_curve_id_idx on riskr.aggregate_loss_curve_data(loss_curve_id);
 CREATE INDEX riskr_collapse_map_output_id_idx on riskr.collapse_map(output_id);
 CREATE INDEX riskr_collapse_map_data_collapse_map_id_idx on riskr.collapse_map_data(collapse_map_id);
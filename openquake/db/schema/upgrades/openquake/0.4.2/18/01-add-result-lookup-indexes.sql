@@ -0,0 +1,29 @@
+/*
+
+    Copyright (c) 2010-2012, GEM Foundation.
+
+    OpenQuake database is made available under the Open Database License:
+    http://opendatacommons.org/licenses/odbl/1.0/. Any rights in individual
+    contents of the database are licensed under the Database Contents License:
+    http://opendatacommons.org/licenses/dbcl/1.0/
+
+*/
+
+
+-- The outputs of a calculation are selected by calculation and type.
+CREATE INDEX uiapi_output_oq_calculation_id_idx
+    ON uiapi.output(oq_calculation_id, output_type);
+
+-- Risk calculations look up the hazard curves of a site by geohash.
+CREATE INDEX hzrdr_hazard_curve_data_hazard_curve_id_geohash_idx
+    ON hzrdr.hazard_curve_data(hazard_curve_id, ST_GeoHash(location, 12));
+
+-- Spatial indexes on the result locations.
+CREATE INDEX hzrdr_hazard_curve_data_location_idx
+    ON hzrdr.hazard_curve_data USING gist(location);
+CREATE INDEX hzrdr_gmf_data_location_idx
+    ON hzrdr.gmf_data USING gist(location);
+CREATE INDEX riskr_loss_map_data_location_idx
+    ON riskr.loss_map_data USING gist(location);
+CREATE INDEX riskr_loss_curve_data_location_idx
+    ON riskr.loss_curve_data USING gist(location);
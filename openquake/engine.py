@@ -47,6 +47,7 @@ from openquake.flags import FLAGS
 from openquake import kvs
 from openquake import logs
 from openquake import shapes
+from openquake import writer
 from openquake import xml
 from openquake.job import config as jobconf
 from openquake.job.params import ARRAY_RE
@@ -102,6 +103,8 @@ class CalculationProxy(object):
 
         self.sites = []
         self.blocks_keys = []
+        self._exposure_assets = None
+        self._result_sink = None
         self.params = params
         self.sections = list(set(sections))
         self.serialize_results_to = []
@@ -122,6 +125,14 @@ class CalculationProxy(object):
         else:
             return self.params.get('BASE_PATH')
 
+    @property
+    def result_sink(self):
+        """The :class:`openquake.writer.ResultSink` serializing the results
+        of this calculation in the background."""
+        if self._result_sink is None:
+            self._result_sink = writer.ResultSink()
+        return self._result_sink
+
     @staticmethod
     def from_kvs(job_id):
         """Return the job in the underlying kvs system with the given id."""
@@ -179,6 +190,32 @@ class CalculationProxy(object):
         region.cell_size = float(self['REGION_GRID_SPACING'])
         return region
 
+    def exposure_assets(self):
+        """The (site, asset) pairs of the exposure located within the
+        region of interest.
+
+        The exposure file is parsed and validated once per calculation
+        (and reused across calculations when the `[exposure] cache_dir`
+        setting is enabled), whoever asks for the sites or the assets. Only
+        the assets within the region are kept, the others are dropped while
+        the exposure is read.
+
+        :returns: a list of (:py:class:`openquake.shapes.Site`, asset)
+            pairs, see
+            :py:class:`openquake.parser.exposure.ExposurePortfolioFile`
+        """
+        if self._exposure_assets is None:
+            path = os.path.join(self.base_path, self.params[jobconf.EXPOSURE])
+            constraint = self.region
+
+            logs.LOG.debug(
+                "Constraining exposure parsing to %s" % constraint)
+
+            self._exposure_assets = exposure.read_exposure(
+                path, utils_config.get("exposure", "cache_dir"), constraint)
+
+        return self._exposure_assets
+
     def __getitem__(self, name):
         defined_param = PARAMS.get(name)
         if (hasattr(defined_param, 'to_job')
@@ -230,6 +267,8 @@ class CalculationProxy(object):
         If the COMPUTE_HAZARD_AT_ASSETS_LOCATIONS parameter is specified,
         the hazard computation is triggered only on sites defined in the risk
         exposure file and located inside the region of interest.
+
+        :returns: a :py:class:`openquake.shapes.SiteCollection`
         """
 
         if self.sites:
@@ -241,7 +280,8 @@ class CalculationProxy(object):
             print "COMPUTE_HAZARD_AT_ASSETS_LOCATIONS selected, " \
                 "computing hazard on exposure sites..."
 
-            self.sites = read_sites_from_exposure(self)
+            self.sites = shapes.SiteCollection.from_sites(
+                read_sites_from_exposure(self))
         elif self.has(jobconf.SITES):
 
             coords = self._extract_coords(jobconf.SITES)
@@ -250,7 +290,7 @@ class CalculationProxy(object):
             for coord in coords:
                 sites.append(shapes.Site(coord[0], coord[1]))
 
-            self.sites = sites
+            self.sites = shapes.SiteCollection.from_sites(sites)
         else:
             self.sites = self._sites_for_region()
 
@@ -267,7 +307,7 @@ class CalculationProxy(object):
             self._extract_coords('REGION_VERTEX'))
 
         region.cell_size = self['REGION_GRID_SPACING']
-        return [site for site in region]
+        return region.grid.site_collection()
 
     def build_nrml_path(self, nrml_file):
         """Return the complete output path for the given nrml_file"""
@@ -332,19 +372,13 @@ def read_sites_from_exposure(calc_proxy):
     """
 
     sites = []
-    path = os.path.join(calc_proxy.base_path,
-                        calc_proxy.params[jobconf.EXPOSURE])
+    seen = set()
 
-    reader = exposure.ExposurePortfolioFile(path)
-    constraint = calc_proxy.region
-
-    logs.LOG.debug(
-        "Constraining exposure parsing to %s" % constraint)
-
-    for site, _asset_data in reader.filter(constraint):
+    for site, _asset_data in calc_proxy.exposure_assets():
 
         # we don't want duplicates (bug 812395):
-        if not site in sites:
+        if not site in seen:
+            seen.add(site)
             sites.append(site)
 
     return sites
@@ -363,6 +397,7 @@ def _job_from_file(config_file, output_type, owner_username='openquake'):
         Where to store results:
         * 'db' database
         * 'xml' XML files *plus* database
+        * 'hdf5' HDF5 archive *plus* database
     :param owner_username:
         oq_user.user_name which defines the owner of all DB artifacts created
         by this function.
@@ -374,7 +409,7 @@ def _job_from_file(config_file, output_type, owner_username='openquake'):
     # This allows to run tests without requiring a database.
     # This is not documented in the public interface because it is
     # essentially a detail of our current tests and ci infrastructure.
-    assert output_type in ('db', 'xml')
+    assert output_type in ('db', 'xml', 'hdf5')
 
     params, sections = _parse_config_file(config_file)
     params, sections = _prepare_config_parameters(params, sections)
@@ -397,10 +432,9 @@ def _job_from_file(config_file, output_type, owner_username='openquake'):
         calculation.save()
         calculation_id = calculation.id
 
-    if output_type == 'db':
-        serialize_results_to = ['db']
-    else:
-        serialize_results_to = ['db', 'xml']
+    serialize_results_to = ['db']
+    if output_type != 'db':
+        serialize_results_to.append(output_type)
 
     base_path = params['BASE_PATH']
 
@@ -651,13 +685,13 @@ def run_calculation(job_profile, params, sections, output_type='db'):
     :param sections:
         A list of sections parsed from the calculation config file.
     :param output_type:
-        'db' or 'xml' (defaults to 'db')
+        'db', 'xml' or 'hdf5' (defaults to 'db')
 
     :returns:
         :class:`openquake.db.models.OqCalculation` instance.
     """
-    if not output_type in ('db', 'xml'):
-        raise RuntimeError("output_type must be 'db' or 'xml'")
+    if not output_type in ('db', 'xml', 'hdf5'):
+        raise RuntimeError("output_type must be 'db', 'xml' or 'hdf5'")
 
     calculation = OqCalculation(owner=job_profile.owner)
     calculation.oq_job_profile = job_profile
@@ -674,8 +708,8 @@ def run_calculation(job_profile, params, sections, output_type='db'):
     utils_config.Config().job_id = calculation.id
 
     serialize_results_to = ['db']
-    if output_type == 'xml':
-        serialize_results_to.append('xml')
+    if output_type != 'db':
+        serialize_results_to.append(output_type)
 
     calc_proxy = CalculationProxy(params, calculation.id, sections=sections,
                                   serialize_results_to=serialize_results_to,
@@ -765,7 +799,11 @@ def _launch_calculation(calc_proxy, sections):
         calculator.analyze()
         calculator.pre_execute()
         calculator.execute()
+        # the results queued during the execution must be written before
+        # the post-execution steps
+        calc_proxy.result_sink.flush()
         calculator.post_execute()
+        calc_proxy.result_sink.close()
 
 
 def import_job_profile(path_to_cfg):
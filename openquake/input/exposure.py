@@ -20,10 +20,21 @@
 
 """Serializer to save exposure data to the database"""
 
+from cStringIO import StringIO
+from itertools import islice
+
+from openquake import logs
 from openquake.db import models
+from openquake.writer import copy_value
+from django.db import connections
 from django.db import router
 from django.db import transaction
 
+LOG = logs.LOG
+
+# number of assets written (and committed) at a time by ExposureBulkWriter
+DEFAULT_CHUNK_SIZE = 10000
+
 
 class ExposureDBWriter(object):
     """
@@ -61,13 +72,7 @@ class ExposureDBWriter(object):
         """
 
         if not self.model:
-            self.model = models.ExposureModel(
-                owner=self.owner,
-                description=values.get('listDescription'),
-                category=values['assetCategory'],
-                stco_type="aggregated",
-                stco_unit=values['unit'])
-            self.model.save()
+            self.insert_model(values)
 
         data = models.ExposureData(
             exposure_model=self.model, asset_ref=values['assetID'],
@@ -76,3 +81,133 @@ class ExposureDBWriter(object):
             site="POINT(%s %s)" % (point.point.x, point.point.y),
             reco=values['retrofittingCost'])
         data.save()
+
+    def insert_model(self, values):
+        """
+        Insert the main exposure model entry.
+
+        :param values: dictionary of values of the first asset (see
+            :class:`openquake.parser.exposure.ExposurePortfolioFile`)
+        """
+        self.model = models.ExposureModel(
+            owner=self.owner,
+            description=values.get('listDescription'),
+            category=values['assetCategory'],
+            stco_type="aggregated",
+            stco_unit=values['unit'])
+        self.model.save()
+
+
+class ExposureBulkWriter(ExposureDBWriter):
+    """
+    Serialize the exposure model to database using the PostgreSQL COPY
+    protocol.
+
+    The assets are written in chunks of `chunk_size`, each one in its own
+    transaction: a load that was interrupted can be resumed by passing
+    the exposure model it was writing to, the assets already stored are
+    skipped.
+    """
+
+    COLUMNS = ("asset_ref", "taxonomy", "lon", "lat", "stco", "reco")
+
+    def __init__(self, owner, chunk_size=DEFAULT_CHUNK_SIZE, model=None):
+        """
+        :param owner: the owner of the exposure model
+        :type owner: :class:`openquake.db.models.OqUser`
+        :param int chunk_size: number of assets committed at a time
+        :param model: the exposure model of an interrupted load to resume
+        :type model: :class:`openquake.db.models.ExposureModel`
+        """
+        super(ExposureBulkWriter, self).__init__(owner)
+        self.model = model
+        self.chunk_size = chunk_size
+
+    def serialize(self, iterator):
+        """
+        Serialize a list of values produced by
+        :class:`openquake.parser.exposure.ExposurePortfolioFile`
+
+        :type iterator: any iterable
+        :returns: the number of assets stored by this call
+        """
+        iterator = iter(iterator)
+        skipped = self.model.exposuredata_set.count() if self.model else 0
+        stored = 0
+
+        if skipped:
+            LOG.info("Resuming the load of exposure model %s after %s assets"
+                     % (self.model.id, skipped))
+            # the chunks are committed in input order, so the assets
+            # already stored are the first ones
+            for _ in islice(iterator, skipped):
+                pass
+
+        while True:
+            chunk = list(islice(iterator, self.chunk_size))
+
+            if not chunk:
+                break
+
+            if not self.model:
+                self.insert_committed_model(chunk[0][1])
+
+            self.insert_chunk(chunk)
+            stored += len(chunk)
+
+            LOG.info("Stored %s exposure assets in exposure model %s"
+                     % (skipped + stored, self.model.id))
+
+        return stored
+
+    @transaction.commit_on_success(router.db_for_write(models.ExposureModel))
+    def insert_committed_model(self, values):
+        """
+        Insert the main exposure model entry in its own transaction, so
+        that the load can be resumed even if the first chunk fails.
+        """
+        self.insert_model(values)
+
+    @transaction.commit_on_success(router.db_for_write(models.ExposureData))
+    def insert_chunk(self, chunk):
+        """
+        Insert a chunk of asset entries with a single COPY.
+
+        The assets are copied in a temporary table first, the point
+        geometries are then built by PostGIS while moving the rows to the
+        exposure data table.
+
+        :param chunk: a list of (:class:`openquake.shapes.Site`, values)
+            pairs, see :class:`openquake.parser.exposure.ExposurePortfolioFile`
+        """
+        rows = StringIO()
+
+        for site, values in chunk:
+            rows.write("\t".join(copy_value(value) for value in (
+                values['assetID'], values['taxonomy'], site.longitude,
+                site.latitude, values['assetValue'],
+                values['retrofittingCost'])))
+            rows.write("\n")
+
+        rows.seek(0)
+
+        alias = router.db_for_write(models.ExposureData)
+        cursor = connections[alias].cursor()
+        columns = ", ".join(self.COLUMNS)
+
+        cursor.execute(
+            "CREATE TEMPORARY TABLE exposure_data_load (asset_ref VARCHAR, "
+            "taxonomy VARCHAR, lon float, lat float, stco float, reco float) "
+            "ON COMMIT DROP")
+        cursor.copy_expert(
+            "COPY exposure_data_load (%s) FROM STDIN" % columns, rows)
+
+        # pylint: disable=W0212
+        cursor.execute(
+            "INSERT INTO \"%s\" (exposure_model_id, asset_ref, taxonomy, "
+            "stco, reco, site) SELECT %%s, asset_ref, taxonomy, stco, reco, "
+            "ST_SetSRID(ST_MakePoint(lon, lat), 4326) "
+            "FROM exposure_data_load" % models.ExposureData._meta.db_table,
+            [self.model.id])
+
+        transaction.set_dirty(using=alias)
@@ -314,6 +314,8 @@ define_param('SUBDUCTION_RUPTURE_FLOATING_TYPE',
 
 # Everything else; please maintain alphabetical ordering.
 define_param('AGGREGATE_LOSS_CURVE', 'aggregate_loss_curve', to_job=str2bool)
+define_param('ASSET_CORRELATION', None,
+             modes=('scenario', 'event_based', 'event_based_bcr'))
 define_param('ASSET_LIFE_EXPECTANCY', 'asset_life_expectancy', to_job=float,
              modes=("classical_bcr", "event_based_bcr"))
 define_param('COMPONENT', 'component', to_db=map_enum)
@@ -325,6 +327,8 @@ define_param('COMPUTE_MEAN_HAZARD_CURVE', 'compute_mean_hazard_curve',
              modes=('classical', 'classical_bcr'), to_job=str2bool)
 define_param('CONDITIONAL_LOSS_POE', 'conditional_loss_poe', to_job=cttfl)
 define_param('DAMPING', 'damping', default=0.0, to_job=float)
+define_param('EPSILON_RANDOM_SEED', None,
+             modes=('scenario', 'event_based', 'event_based_bcr'), to_job=int)
 define_param('GMF_OUTPUT', None,
              modes=('event_based', 'scenario'), to_job=str2bool)
 define_param('GMF_RANDOM_SEED', 'gmf_random_seed',
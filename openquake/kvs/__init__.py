@@ -22,6 +22,7 @@ This module contains generic functions to access
 the underlying kvs systems.
 """
 
+import cPickle
 import json
 import numpy
 import redis
@@ -41,6 +42,10 @@ SITES_KEY_TOKEN = "sites"
 # Module-private kvs connection pool, to be used by get_client().
 __KVS_CONN_POOL = None
 
+# Module-private cache of the shared job artifacts fetched by this process,
+# see get_artifact(). Maps job ids to {artifact key: artifact} dicts.
+__ARTIFACT_CACHE = {}
+
 
 # pylint: disable=W0603
 def get_client(**kwargs):
@@ -69,18 +74,21 @@ def get_value_json_decoded(key):
         return None
 
 
-def get_list_json_decoded(key):
+def get_list_json_decoded(key, start=0, stop=-1):
     """
     Get from the KVS a list of items.
 
     :param key: the KVS key
     :type key: string
+    :param int start: the index of the first item
+    :param int stop: the index of the last item (included), all the items
+        from `start` by default
 
     The items stored under key are expected to be JSON encoded, and are decoded
     before being returned.
     """
 
-    return [json.loads(x) for x in get_client().lrange(key, 0, -1)]
+    return [json.loads(x) for x in get_client().lrange(key, start, stop)]
 
 
 class NumpyAwareJSONEncoder(json.JSONEncoder):
@@ -109,6 +117,85 @@ def set_value_json_encoded(key, value):
     return True
 
 
+def share_artifact(job_id, artifact):
+    """
+    Store a read-only job artifact (vulnerability model, exposure metadata,
+    etc.) in the KVS and return the key it can be fetched with.
+
+    Artifacts are content-addressed: storing the same artifact twice for
+    a job results in a single copy. Tasks should be given the returned key
+    instead of the artifact itself, to keep task messages small.
+
+    :param job_id: the job id
+    :type job_id: int
+    :param artifact: any picklable object
+    :returns: the KVS key of the artifact
+    :rtype: string
+    """
+    blob = cPickle.dumps(artifact, cPickle.HIGHEST_PROTOCOL)
+    key = tokens.generate_blob_key(job_id, blob)
+
+    get_client().setnx(key, blob)
+    __ARTIFACT_CACHE.setdefault(job_id, {})[key] = artifact
+
+    return key
+
+
+def get_artifact(job_id, key):
+    """
+    Return the job artifact stored with :func:`share_artifact` under the
+    given key.
+
+    The artifact is fetched from the KVS only the first time it is needed
+    by the current process, and cached for the lifetime of the job.
+    Artifacts must therefore be treated as read-only by the callers.
+
+    :param job_id: the job id
+    :type job_id: int
+    :param key: the key returned by :func:`share_artifact`
+    :type key: string
+    :raises KeyError: if no artifact is stored under the given key
+    """
+    if job_id not in __ARTIFACT_CACHE:
+        _evict_stale_artifacts()
+
+    job_artifacts = __ARTIFACT_CACHE.setdefault(job_id, {})
+
+    if key not in job_artifacts:
+        blob = get_client().get(key)
+
+        if blob is None:
+            raise KeyError(key)
+
+        job_artifacts[key] = cPickle.loads(blob)
+
+    return job_artifacts[key]
+
+
+def clear_artifact_cache(job_id):
+    """
+    Drop the artifacts cached by the current process for the given job.
+
+    :param job_id: the job id
+    :type job_id: int
+    """
+    __ARTIFACT_CACHE.pop(job_id, None)
+
+
+def _evict_stale_artifacts():
+    """
+    Drop the cached artifacts of the jobs which are not current anymore.
+    Worker processes outlive jobs, so this is done whenever the artifacts
+    of a new job are requested.
+    """
+    if __ARTIFACT_CACHE:
+        running = set(current_jobs())
+
+        for job_id in __ARTIFACT_CACHE.keys():
+            if job_id not in running:
+                del __ARTIFACT_CACHE[job_id]
+
+
 def mark_job_as_current(job_id):
     """
     Add a job to the set of current jobs, to be later garbage collected.
@@ -166,6 +253,7 @@ def cache_gc(job_id):
 
         # finally, remove the job key from CURRENT_JOBS
         client.srem(tokens.CURRENT_JOBS, job_id)
+        clear_artifact_cache(job_id)
 
         msg = 'KVS garbage collection removed %s keys for job %s'
         msg %= (len(keys), job_id)
@@ -45,6 +45,7 @@ LOSS_RATIO_CURVE_KEY_TOKEN = 'LOSS_RATIO_CURVE'
 LOSS_CURVE_KEY_TOKEN = 'LOSS_CURVE'
 VULNERABILITY_CURVE_KEY_TOKEN = 'VULNERABILITY_CURVE'
 BCR_BLOCK_KEY_TOKEN = 'BCR_BLOCK'
+AGGREGATE_LOSSES_KEY_TOKEN = 'AGGREGATE_LOSSES'
 
 
 CURRENT_JOBS = 'CURRENT_JOBS'
@@ -101,9 +102,9 @@ def vuln_key(job_id, retrofitted=False):
                          "retrofitted" if retrofitted else "normal")
 
 
-def asset_key(job_id, row, col):
-    """ Return an asset key """
-    return _generate_key(job_id, EXPOSURE_KEY_TOKEN, row, col)
+def block_assets_key(job_id, block_id):
+    """ Return the key for the assets of a risk block """
+    return _generate_key(job_id, EXPOSURE_KEY_TOKEN, block_id)
 
 
 def source_model_key(job_id):
@@ -131,21 +132,6 @@ def mgm_key(job_id, block_id, site_id):
     return _generate_key(job_id, MGM_KEY_TOKEN, block_id, site_id)
 
 
-def asset_row_col_from_kvs_key(kvs_key):
-    """
-    Extract row and column from a key of type EXPOSURE_KEY_TOKEN
-    :param:kvs_key: the key
-    :type:kvs_key: string
-
-    :returns: a tuple (row, col)
-    """
-    assert _kvs_key_type(kvs_key) == EXPOSURE_KEY_TOKEN
-
-    row, col = kvs_key.rsplit(_KVS_KEY_SEPARATOR, 2)[-2:]
-
-    return int(row), int(col)
-
-
 def risk_block_key(job_id, block_index):
     """ Return the key for a risk block """
     return _generate_key(job_id, BLOCK_KEY_TOKEN, block_index)
@@ -174,6 +160,11 @@ def bcr_block_key(job_id, block_id):
     return _generate_key(job_id, BCR_BLOCK_KEY_TOKEN, block_id)
 
 
+def aggregate_losses_key(job_id, block_id):
+    """ Return the key for the partial aggregate losses of a block """
+    return _generate_key(job_id, AGGREGATE_LOSSES_KEY_TOKEN, block_id)
+
+
 def _mean_hazard_curve_key(job_id, site_fragment):
     "Common code for the key functions below"
     return _generate_key(job_id, MEAN_HAZARD_CURVE_KEY_TOKEN, site_fragment)
@@ -23,10 +23,17 @@ This module plots curves (hazard/loss/loss ratio) as read from an NRML file.
 As plotting engine, matplotlib is used. The plots are in SVG format.
 """
 
+import math
+import multiprocessing
+
+from itertools import izip
+
 import matplotlib
 matplotlib.use('SVG')
 import pylab
 
+from matplotlib.backends.backend_svg import FigureCanvasSVG
+from matplotlib.figure import Figure
 from matplotlib.font_manager import FontProperties
 
 from openquake import writer
@@ -38,6 +45,13 @@ COLOR_CODES = ('k', 'r', 'g', 'b')
 
 CURVE_BRANCH_PLACEHOLDER = 'Curve'
 
+# number of worker processes drawing the plots in batch mode
+PLOT_PROCESSES = multiprocessing.cpu_count()
+
+# size (in inches) of the plot of each site, when many sites are plotted
+# in the same file
+SHEET_PLOT_SIZE = 4
+
 
 class CurvePlotter(object):
     """Base class for plotting curves from NRML files to SVG.
@@ -94,6 +108,39 @@ class CurvePlotter(object):
             plot.write(site_data['curves'], autoscale_y)
         plot.close()
 
+    def plot_batch(self, autoscale_y=True, sites_per_file=1,
+                   processes=PLOT_PROCESSES):
+        """Create the plots of all the sites in the dataset at once, in
+        worker processes each reusing a single figure (see
+        :func:`plot_sheets`).
+
+        :param bool autoscale_y: as in :meth:`plot`
+        :param int sites_per_file: the number of sites plotted side by side
+            in each SVG file. With more than one site per file, the files are
+            named after the output base path and a sheet number.
+        :param int processes: the number of worker processes
+        :returns: the paths of the SVG files
+        """
+        site_data = sorted(self.data.values(), key=lambda sd: sd['path'])
+
+        if sites_per_file == 1:
+            sheets = [(sd['path'], [sd['curves']]) for sd in site_data]
+        else:
+            sheets = [
+                ("%s_sheet-%04d.svg" % (self.output_base_path,
+                                        start // sites_per_file),
+                 [sd['curves']
+                  for sd in site_data[start:start + sites_per_file]])
+                for start in xrange(0, len(site_data), sites_per_file)]
+
+        columns = int(math.ceil(math.sqrt(sites_per_file)))
+        rows = int(math.ceil(float(sites_per_file) / columns))
+
+        plot_sheets(sheets, autoscale_y, rows, columns, processes=processes)
+
+        self.svg_filenames = [path for path, _ in sheets]
+        return self.svg_filenames
+
     def filenames(self):
         """ Generator yields the path value for each dict in self.data """
         return (path for path in self.svg_filenames)
@@ -185,28 +232,32 @@ class HazardCurvePlotter(CurvePlotter):
         # one plot contains hazard curves for several end branches
         # of the logic tree
         # each end branch can have its own abscissa value set
-        for (nrml_point, nrml_attr) in nrml_element.filter(
-            region_constraint=None):
-
-            site_hash = hash(nrml_point)
-            ebl = nrml_attr['endBranchLabel']
+        # the curves are read as arrays, a batch of sites at a time
+        for field_meta, sites, poes in nrml_element.batches():
+            if 'endBranchLabel' in field_meta:
+                ebl = field_meta['endBranchLabel']
+            elif 'quantileValue' in field_meta:
+                ebl = "%s %s" % (field_meta['statistics'],
+                                 field_meta['quantileValue'])
+            else:
+                ebl = field_meta['statistics']
 
-            if site_hash not in self.data:
-                self.data[site_hash] = {
-                    # capture SVG filename for each site
-                    'path': self._generate_filename(nrml_point),
-                    'curves': {}}
+            for nrml_point, site_poes in izip(sites, poes):
+                site_hash = hash(nrml_point)
 
-            if ebl not in self.data[site_hash]['curves']:
-                self.data[site_hash]['curves'][ebl] = {}
+                if site_hash not in self.data:
+                    self.data[site_hash] = {
+                        # capture SVG filename for each site
+                        'path': self._generate_filename(nrml_point),
+                        'curves': {}}
 
-            self.data[site_hash]['curves'][ebl] = {
-                'abscissa': nrml_attr['IMLValues'],
-                'abscissa_property': nrml_attr['IMT'],
-                'ordinate': nrml_attr['Values'],
-                'ordinate_property': 'Probability of Exceedance',
-                'Site': nrml_point,
-                'curve_title': self.curve_title}
+                self.data[site_hash]['curves'][ebl] = {
+                    'abscissa': field_meta['IMLValues'],
+                    'abscissa_property': field_meta['IMT'],
+                    'ordinate': site_poes,
+                    'ordinate_property': 'Probability of Exceedance',
+                    'Site': nrml_point,
+                    'curve_title': self.curve_title}
 
 
 class CurvePlot(writer.FileWriter):
@@ -324,6 +375,160 @@ class CurvePlot(writer.FileWriter):
         pylab.close()
 
 
+class CurveFigure(object):
+    """A figure reused to draw many curve plots, with one or more sites
+    ("small multiples") per SVG file.
+
+    The figure, its axes and their lines are created once: drawing a plot
+    only replaces the data of the lines. The plots look like the ones drawn
+    by :class:`CurvePlot`.
+    """
+
+    def __init__(self, rows=1, columns=1, use_title=False):
+        self.use_title = use_title
+
+        if rows * columns == 1:
+            figsize = CurvePlot._plotFig['figsize']
+        else:
+            figsize = (columns * SHEET_PLOT_SIZE, rows * SHEET_PLOT_SIZE)
+
+        self.figure = Figure(figsize=figsize)
+        FigureCanvasSVG(self.figure)
+
+        self.axes = [self.figure.add_subplot(rows, columns, index + 1)
+                     for index in xrange(rows * columns)]
+        self.lines = [[] for _ in self.axes]
+
+    def draw(self, path, sheet, autoscale_y=True):
+        """Draw the curves of one or more sites and save the SVG file.
+
+        :param str path: the path of the SVG file
+        :param sheet: a list with the curves of each site, in the format
+            expected by :meth:`CurvePlot.write`
+        :param bool autoscale_y: as in :meth:`CurvePlotter.plot`
+        """
+        if len(sheet) > len(self.axes):
+            raise ValueError("Cannot draw %s sites on %s plots" % (
+                len(sheet), len(self.axes)))
+
+        for index, axes in enumerate(self.axes):
+            axes.set_visible(index < len(sheet))
+
+            if index < len(sheet):
+                self._draw_curves(index, sheet[index], autoscale_y)
+
+        self.figure.savefig(path, format=IMAGE_FORMAT.lower())
+
+    def _draw_curves(self, index, data, autoscale_y):
+        """Replace the curves drawn on the given axes."""
+        # pylint: disable=W0212
+        axes = self.axes[index]
+        lines = self.lines[index]
+        color_codes = _color_code_generator()
+
+        for position, label in enumerate(data):
+            if position == len(lines):
+                line, = axes.plot(
+                    [], [], linestyle=CurvePlot._plotCurve['linestyle'][2])
+                lines.append(line)
+
+            line = lines[position]
+            line.set_data(data[label]['abscissa'], data[label]['ordinate'])
+            line.set_color(color_codes.next())
+            line.set_label(label)
+            line.set_visible(True)
+
+        # the hidden lines are emptied, so that they don't count in the
+        # data limits
+        for line in lines[len(data):]:
+            line.set_data([], [])
+            line.set_visible(False)
+            line.set_label('_nolegend_')
+
+        axes.set_autoscale_on(True)
+        axes.relim()
+        axes.autoscale_view()
+
+        if autoscale_y is False:
+            axes.set_ylim(CurvePlot._plotAxes['ymin'],
+                          CurvePlot._plotAxes['ymax'])
+
+        curve = data.keys()[0]
+        axes.set_xlabel(data[curve]['abscissa_property'],
+                        CurvePlot._plotLabelsFont)
+        axes.set_ylabel(data[curve]['ordinate_property'],
+                        CurvePlot._plotLabelsFont)
+
+        if self.use_title or 'Site' not in data[curve]:
+            axes.set_title(data[curve]['curve_title'])
+        else:
+            axes.set_title("%s for (%7.3f, %6.3f)" % (
+                data[curve]['curve_title'],
+                data[curve]['Site'].longitude,
+                data[curve]['Site'].latitude))
+
+        legend = CurvePlot._plotLegend
+        legend_font = CurvePlot._plotLegendFont
+        axes.legend(loc=legend['style'],
+                    markerscale=legend['markerscale'],
+                    borderpad=legend['borderpad'],
+                    borderaxespad=legend['borderaxespad'],
+                    handletextpad=legend['handletextpad'],
+                    handlelength=legend['handlelength'],
+                    labelspacing=legend['labelspacing'],
+                    prop=FontProperties(
+                        size=legend_font['size'],
+                        style=legend_font['style'],
+                        family=legend_font['family'][1]))
+
+
+def plot_sheets(sheets, autoscale_y=True, rows=1, columns=1,
+                use_title=False, processes=PLOT_PROCESSES):
+    """Draw many curve plots, splitting them among worker processes. Each
+    process draws its share of the plots with a single
+    :class:`CurveFigure`.
+
+    :param sheets: a list of (path of the SVG file, curves of each site)
+        pairs, see :meth:`CurveFigure.draw`
+    :param bool autoscale_y: as in :meth:`CurvePlotter.plot`
+    :param int rows: the number of rows of plots in each file
+    :param int columns: the number of columns of plots in each file
+    :param bool use_title: do not put the site in the titles
+    :param int processes: the number of worker processes, with 1 the plots
+        are drawn in the calling process
+    """
+    if not sheets:
+        return
+
+    processes = max(1, min(processes, len(sheets)))
+    size = int(math.ceil(float(len(sheets)) / processes))
+    tasks = [(sheets[start:start + size], autoscale_y, rows, columns,
+              use_title)
+             for start in xrange(0, len(sheets), size)]
+
+    if processes == 1:
+        for task in tasks:
+            _draw_sheets(task)
+        return
+
+    pool = multiprocessing.Pool(processes)
+
+    try:
+        pool.map(_draw_sheets, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _draw_sheets(task):
+    """Draw a share of the plots of :func:`plot_sheets`."""
+    sheets, autoscale_y, rows, columns, use_title = task
+    figure = CurveFigure(rows, columns, use_title)
+
+    for path, sheet in sheets:
+        figure.draw(path, sheet, autoscale_y)
+
+
 def _color_code_generator():
     """Generator that walks through a sequence of color codes for matplotlib.
     When reaching the end of the color code list, start at the beginning again.
@@ -28,7 +28,6 @@ import os
 
 import numpy
 from osgeo import osr, gdal
-from scipy import interpolate
 
 from openquake import writer
 from openquake.output import template
@@ -41,6 +40,10 @@ TIFF_BAND = 4
 TIFF_LONGITUDE_ROTATION = 0
 TIFF_LATITUDE_ROTATION = 0
 
+# images with at least this number of pixels are tiled and compressed
+TILED_TIFF_MIN_PIXELS = 512 * 512
+TILED_TIFF_OPTIONS = ["TILED=YES", "COMPRESS=DEFLATE", "BIGTIFF=IF_SAFER"]
+
 COLORMAPS = {
     'green-red': {
         'id': 'green-red',
@@ -123,6 +126,9 @@ class GeoTiffFile(writer.FileWriter):
     """
     format = GDAL_FORMAT
     html_template = None
+    # alpha of the pixels with a value
+    # TODO (LB): we might want to make this configurable in the future
+    alpha_value = 255.0
 
     def __init__(
         self, path, image_grid, init_value=numpy.nan, html_wrapper=True,
@@ -187,9 +193,44 @@ class GeoTiffFile(writer.FileWriter):
         self.raster[int(coords[0]), int(coords[1])] = float(value)
         # Set AlphaLayer
         if value:
-            # set the alpha at this point to fully opqaue
-            # TODO (LB): we might want to make this configurable in the future
-            self.alpha_raster[int(coords[0]), int(coords[1])] = 255.0
+            self.alpha_raster[int(coords[0]), int(coords[1])] = \
+                self.alpha_value
+
+    def write_cells(self, rows, columns, values):
+        """
+        Plot many values to the image raster at once.
+
+        :param rows: the zero-based rows of the cells
+        :type rows: sequence or numpy.array of integers
+        :param columns: the zero-based columns of the cells
+        :type columns: sequence or numpy.array of integers
+        :param values: the raw values of the cells
+        :type values: sequence or numpy.array of floats
+        """
+        rows = numpy.asarray(rows, dtype=int)
+        columns = numpy.asarray(columns, dtype=int)
+        values = numpy.asarray(values, dtype=float)
+
+        self.raster[rows, columns] = values
+        # as in write(), NaN values are made visible too
+        visible = values != 0
+        self.alpha_raster[rows[visible], columns[visible]] = self.alpha_value
+
+    def write_raster(self, raster):
+        """
+        Plot a value for each pixel of the image.
+
+        :param raster: the raw values, with a row per image row
+        :type raster: 2-dimensional numpy.array of floats
+        """
+        raster = numpy.asarray(raster, dtype=float)
+
+        if raster.shape != self.raster.shape:
+            raise ValueError("Expected a %sx%s raster, got %sx%s" % (
+                self.raster.shape + raster.shape))
+
+        self.raster = raster.copy()
+        self.alpha_raster[raster != 0] = self.alpha_value
 
     def _normalize(self):
         """
@@ -271,6 +312,9 @@ class LossMapGeoTiffFile(GeoTiffFile):
     the TIFF with a color-scale legend."""
 
     html_template = template.HTML_TEMPLATE_LOSSRATIO
+    # TODO (LB): I don't like this hard-coded alpha value
+    # this should probably be configurable
+    alpha_value = 250.0
 
     def __init__(
         self, path, grid, init_value=numpy.nan, pixel_type=gdal.GDT_Byte,
@@ -295,17 +339,6 @@ class LossMapGeoTiffFile(GeoTiffFile):
             path, grid, init_value=init_value, pixel_type=pixel_type)
         self.normalize = normalize
 
-    def write(self, cell, value):
-        """Stores the cell values in the NumPy array for later
-        serialization. Make sure these are zero-based cell addresses."""
-        self.raster[int(cell[0]), int(cell[1])] = float(value)
-
-        # Set AlphaLayer
-        if value:
-            # TODO (LB): I don't like this hard-coded alpha value
-            # this should probably be configurable
-            self.alpha_raster[int(cell[0]), int(cell[1])] = 250.0
-
     def _normalize(self):
         """ Normalize the raster matrix """
         if self.normalize:
@@ -449,6 +482,22 @@ class HazardMapGeoTiffFile(GeoTiffFile):
         return super(HazardMapGeoTiffFile, self).write(
             (point.row, point.column), haz_map_data['IML'])
 
+    def write_sites(self, sites, haz_map_data):
+        """
+        Plot the hazard map data of many sites at once.
+
+        :param sites: the locations of the data
+        :type sites: list of shapes.Site objects
+        :param haz_map_data: the hazard map data of each site, as documented
+            in :meth:`write`
+        :type haz_map_data: list of dicts
+        """
+        rows, columns = self.grid.cells_at(
+            [site.longitude for site in sites],
+            [site.latitude for site in sites])
+
+        self.write_cells(rows, columns, [data['IML'] for data in haz_map_data])
+
     def _normalize(self):
         """
         Transform the raw IML values in the raster to the corresponding color
@@ -781,12 +830,10 @@ def interpolate_color(fractional_values, colormap, color):
     :returns: a numpy.array of color values for each pixel in the image from
         the color band defined by the input color parameter
     """
-    color_interpolate = interpolate.interp1d(
-        condense_to_unity(numpy.array(colormap['z_values'])),
-        colormap[color])
-    return numpy.reshape(
-        color_interpolate(fractional_values.flatten()),
-        fractional_values.shape)
+    return numpy.interp(
+        fractional_values,
+        condense_to_unity(numpy.array(colormap['z_values'], dtype=float)),
+        numpy.asarray(colormap[color], dtype=float))
 
 
 def rgb_from_raster(colormap, raster):
@@ -810,26 +857,16 @@ def rgb_from_raster(colormap, raster):
         # now figure out the proper colors
         # we need to build a list of indices to grab the right
         # colors from the colormap
-        bins = numpy.digitize(raster.flatten(), colormap['z_values'])
+        bins = numpy.digitize(raster, colormap['z_values'])
         # type is discrete; we need the bins to correspond to color indices
         # we subtract 1 because (len(z_vals) == len(rgb_vals) + 1)
-        bins -= 1
         # the last z_val range is inclusive on the high end
         # i.e., [a, b), [c, d), ... , [y, z]
-
-        # handle low-end outliers (set to lowest value in range):
-        numpy.putmask(bins, bins < 0, 0)
-        # handle high-end outliers (set to highest value in range):
-        numpy.putmask(
-            bins,
-            bins > len(colormap['red']) - 1,
-            len(colormap['red']) - 1)
+        # outliers are set to the lowest/highest value in range
+        bins = numpy.clip(bins - 1, 0, len(colormap['red']) - 1)
         # TODO: verify color value list lengths in the constructor
         # all of them should be equal
-        red, green, blue = rgb_values_from_colormap(colormap, bins)
-        # now re-shape the color lists per the image shape and return
-        return [numpy.reshape(color, raster.shape) for color in \
-            (red, green, blue)]
+        return list(rgb_values_from_colormap(colormap, bins))
 
 
 def rgb_values_from_colormap(colormap, index_list):
@@ -869,20 +906,22 @@ def rgb_values_from_colormap(colormap, index_list):
     :type colormap: dict
 
     :param index_list: color value indices
-    :type index_list: list of integers
+    :type index_list: list or numpy.array of integers, of any shape
 
-    :returns: tuple of three 1-dimensional numpy.array objects (red, green,
-        blue)
+    :returns: tuple of three numpy.array objects (red, green, blue), with
+        the shape of index_list
     """
+    # the colormap is a lookup table with a (red, green, blue) row per
+    # color index
+    table = numpy.array(
+        [colormap['red'], colormap['green'], colormap['blue']]).T
+
     # make sure the color value lists are equal in length
     # if they're not, this is a bad colormap
-    assert len(colormap['red']) == len(colormap['green']) \
-        and len(colormap['red']) == len(colormap['blue'])
+    assert table.ndim == 2
 
-    get_colors = lambda color_list: \
-        numpy.array([color_list[i] for i in index_list])
-    red, green, blue = \
-        [get_colors(colormap[j]) for j in ('red', 'green', 'blue')]
+    red, green, blue = numpy.rollaxis(
+        table[numpy.asarray(index_list, dtype=int)], -1)
     return red, green, blue
 
 
@@ -902,11 +941,21 @@ def make_target(path, grid, output_format, pixel_type, bands=4):
 
     :param bands: number of raster bands; 4 is default (R,G,B, and Alpha)
 
+    GeoTIFF images of at least :data:`TILED_TIFF_MIN_PIXELS` pixels are
+    tiled and compressed.
+
     :returns: gdal.Dataset object representing the file target
     """
     driver = gdal.GetDriverByName(output_format)
 
-    target = driver.Create(path, grid.columns, grid.rows, bands, pixel_type)
+    options = []
+    if (output_format == GDAL_FORMAT
+        and grid.columns * grid.rows >= TILED_TIFF_MIN_PIXELS):
+        # large images are read by tiles and take much less space
+        options = TILED_TIFF_OPTIONS
+
+    target = driver.Create(
+        path, grid.columns, grid.rows, bands, pixel_type, options)
 
     # upper left corner of the region
     ul_corner = grid.region.upper_left_corner
@@ -22,20 +22,28 @@ This module provides classes that serialize hazard-related objects
 to NRML format.
 """
 
+import itertools
 import logging
+import os
+import shutil
+import tempfile
+import threading
 
-from collections import defaultdict, namedtuple
+from collections import defaultdict, namedtuple, OrderedDict
 from lxml import etree
+from xml.sax.saxutils import quoteattr
 
 from openquake import shapes
 from openquake import writer
 from openquake.db import models
 from openquake.job.params import REVERSE_ENUM_MAP
+from openquake.output import hdf5
 from openquake.utils import config
+from openquake.utils import db as db_utils
 from openquake.utils import general
 from openquake.utils import round_float
 from openquake.utils import stats
-from openquake.xml import NSMAP, NRML, GML
+from openquake.xml import NSMAP, NRML, GML, NRML_NS, GML_NS
 
 
 LOGGER = logging.getLogger('hazard-serializer')
@@ -48,16 +56,48 @@ GMFS_GML_ID = 'gmfs_1'
 GMF_GML_ID = 'gmf_1'
 SRS_EPSG_4326 = 'epsg:4326'
 
+HAZARD_CURVES_HEADER = """\
+<?xml version='1.0' encoding='UTF-8'?>
+<nrml xmlns:gml="%s" xmlns="%s"%%s>
+  <hazardResult%%s>
+    <config>
+      <hazardProcessing%%s/>
+    </config>
+""" % (GML_NS, NRML_NS)
+
+HAZARD_CURVE_FIELD = """\
+    <hazardCurveField%s>
+      <IML%s>%s</IML>
+"""
+
+HAZARD_CURVE_NODE = """\
+      <HCNode%s>
+        <site>
+          <gml:Point%s>
+            <gml:pos>%s %s</gml:pos>
+          </gml:Point>
+        </site>
+        <hazardCurve>
+          <poE>%s</poE>
+        </hazardCurve>
+      </HCNode>
+"""
+
 
 class HazardCurveXMLWriter(writer.FileWriter):
-    """This class serializes hazard curve information to NRML format."""
+    """This class serializes hazard curve information to NRML format.
+
+    The curves are streamed: the nodes of each hazardCurveField are
+    written to a temporary file section as they arrive, and the sections
+    are concatenated into the NRML document when the last block is
+    serialized, so the memory used does not depend on the number of curves.
+    """
 
     def __init__(self, path):
         """Initialize the data to be used."""
         super(HazardCurveXMLWriter, self).__init__(path)
-        self.nrml_el = None
-        self.result_el = None
-        self.curves_per_branch_label = {}
+        self.header = None
+        self.curves_per_branch_label = OrderedDict()
         self.hcnode_counter = 0
         self.hcfield_counter = 0
 
@@ -74,9 +114,10 @@ class HazardCurveXMLWriter(writer.FileWriter):
         super(HazardCurveXMLWriter, self).open()
 
     def close(self):
-        """Write all the collected lxml object model to the stream."""
+        """Write the document, with all the sections collected so far, to
+        the stream."""
 
-        if self.nrml_el is None:
+        if self.header is None:
             error_msg = ("You need to add at least a curve to build "
                          "a valid output!")
             raise RuntimeError(error_msg)
@@ -84,43 +125,41 @@ class HazardCurveXMLWriter(writer.FileWriter):
         self.mode = SerializerContext().get_mode()
         if self.mode.end:
             self._maintain_debug_stats()
-            self.file.write(etree.tostring(
-                self.nrml_el, pretty_print=True, xml_declaration=True,
-                encoding="UTF-8"))
-            writer.FileWriter.close(self)
 
-    def write(self, point, values):
-        """Write a hazard curve.
-
-        point must be of type shapes.Site values is a dictionary that matches
-        the one produced by the parser nrml.NrmlFile."""
+            self.file.write(self.header)
 
-        # if we are writing the first hazard curve, create wrapping elements
-        if self.nrml_el is None:
+            for section in self.curves_per_branch_label.itervalues():
+                section.seek(0)
+                shutil.copyfileobj(section, self.file)
+                section.close()
 
-            # nrml:nrml, needs gml:id
-            self.nrml_el = etree.Element("%snrml" % NRML, nsmap=NSMAP)
+                self.file.write("    </hazardCurveField>\n")
 
-            _set_gml_id(self.nrml_el, _gml_id("nrml_id", values,
-                    NRML_GML_ID))
+            self.file.write("  </hazardResult>\n</nrml>\n")
 
-            # nrml:hazardResult, needs gml:id
-            self.result_el = etree.SubElement(self.nrml_el,
-                "%shazardResult" % NRML)
+            self.header = None
+            self.curves_per_branch_label.clear()
 
-            _set_gml_id(self.result_el,
-                        _gml_id("hazres_id", values, HAZARDRESULT_GML_ID))
+            writer.FileWriter.close(self)
 
-            # nrml:config
-            config_el = etree.SubElement(self.result_el, "%sconfig" % NRML)
+    def write(self, point, values):
+        """Write a hazard curve.
 
-            # nrml:hazardProcessing
-            hazard_processing_el = etree.SubElement(
-                config_el, "%shazardProcessing" % NRML)
+        point must be of type shapes.Site values is a dictionary that matches
+        the one produced by the parser nrml.NrmlFile."""
 
-            # the following XML attributes are all optional
-            _set_optional_attributes(hazard_processing_el, values,
-                ('investigationTimeSpan', 'IDmodel', 'saPeriod', 'saDamping'))
+        # if we are writing the first hazard curve, create wrapping elements
+        if self.header is None:
+            # nrml:nrml, nrml:hazardResult and nrml:config, need gml:id
+            # the hazardProcessing XML attributes are all optional
+            self.header = HAZARD_CURVES_HEADER % (
+                _xml_attributes([(
+                    "gml:id", _gml_id("nrml_id", values, NRML_GML_ID))]),
+                _xml_attributes([("gml:id", _gml_id(
+                    "hazres_id", values, HAZARDRESULT_GML_ID))]),
+                _xml_attributes((key, values[key]) for key in (
+                    'investigationTimeSpan', 'IDmodel', 'saPeriod',
+                    'saDamping') if key in values))
 
         # check if we have hazard curves for an end branch label, or
         # for mean/median/quantile
@@ -138,61 +177,47 @@ class HazardCurveXMLWriter(writer.FileWriter):
             raise ValueError(error_msg)
 
         if curve_label in self.curves_per_branch_label:
-            hazard_curve_field_el = self.curves_per_branch_label[curve_label]
+            section = self.curves_per_branch_label[curve_label]
         else:
-            # nrml:hazardCurveField, needs gml:id
-            hazard_curve_field_el = etree.SubElement(self.result_el,
-                "%shazardCurveField" % NRML)
+            section = tempfile.TemporaryFile(
+                dir=os.path.dirname(os.path.abspath(self.path)))
 
-            _set_gml_id(hazard_curve_field_el, _gml_id(
-                    "hcfield_id", values,
-                    "hcf_%s" % self.hcfield_counter))
+            # nrml:hazardCurveField, needs gml:id
+            field_attributes = [("gml:id", _gml_id(
+                "hcfield_id", values, "hcf_%s" % self.hcfield_counter))]
 
             if "hcfield_id" not in values:
                 self.hcfield_counter += 1
 
             if 'endBranchLabel' in values:
-                hazard_curve_field_el.set("endBranchLabel",
-                    str(values["endBranchLabel"]))
+                field_attributes.append(
+                    ("endBranchLabel", values["endBranchLabel"]))
             elif 'statistics' in values:
-                hazard_curve_field_el.set("statistics",
-                    str(values["statistics"]))
+                field_attributes.append(("statistics", values["statistics"]))
                 if 'quantileValue' in values:
-                    hazard_curve_field_el.set("quantileValue",
-                        str(values["quantileValue"]))
+                    field_attributes.append(
+                        ("quantileValue", values["quantileValue"]))
 
             # nrml:IML
-            iml_el = etree.SubElement(hazard_curve_field_el, "%sIML" % NRML)
-            iml_el.text = " ".join([str(x) for x in values["IMLValues"]])
-            iml_el.set("IMT", str(values["IMT"]))
+            section.write(HAZARD_CURVE_FIELD % (
+                _xml_attributes(field_attributes),
+                _xml_attributes([("IMT", values["IMT"])]),
+                " ".join([str(x) for x in values["IMLValues"]])))
 
-            self.curves_per_branch_label[curve_label] = hazard_curve_field_el
+            self.curves_per_branch_label[curve_label] = section
 
         # nrml:HCNode, needs gml:id
-        hcnode_el = etree.SubElement(hazard_curve_field_el, "%sHCNode" % NRML)
-
-        _set_gml_id(hcnode_el, _gml_id(
-                "hcnode_id", values,
-                "hcn_%s" % self.hcnode_counter))
+        # nrml:site, nrml:Point, nrml:hazardCurve, nrml:poE
+        section.write(HAZARD_CURVE_NODE % (
+            _xml_attributes([("gml:id", _gml_id(
+                "hcnode_id", values, "hcn_%s" % self.hcnode_counter))]),
+            _xml_attributes([("srsName", SRS_EPSG_4326)]),
+            point.longitude, point.latitude,
+            " ".join([str(x) for x in values["PoEValues"]])))
 
         if "hcnode_id" not in values:
             self.hcnode_counter += 1
 
-        # nrml:site, nrml:Point
-        point_el = etree.SubElement(etree.SubElement(
-                hcnode_el, "%ssite" % NRML), "%sPoint" % GML)
-
-        point_el.set("srsName", SRS_EPSG_4326)
-
-        pos_el = etree.SubElement(point_el, "%spos" % GML)
-        pos_el.text = "%s %s" % (point.longitude, point.latitude)
-
-        # nrml:hazardCurve, nrml:poE
-        poe_el = etree.SubElement(etree.SubElement(
-                hcnode_el, "%shazardCurve" % NRML), "%spoE" % NRML)
-
-        poe_el.text = " ".join([str(x) for x in values["PoEValues"]])
-
 
 class HazardMapXMLWriter(writer.XMLFileWriter):
     """This class serializes hazard map information to NRML format."""
@@ -493,13 +518,10 @@ class GMFXMLWriter(writer.XMLFileWriter):
         self.node_counter += 1
 
 
-def _set_optional_attributes(element, value_dict, attr_keys):
-    """Set the attributes for the given element specified
-    in attr_keys if they are present in the value_dict dictionary."""
-
-    for curr_key in attr_keys:
-        if curr_key in value_dict:
-            element.set(curr_key, str(value_dict[curr_key]))
+def _xml_attributes(attributes):
+    """Render the given (name, value) pairs as (escaped) XML attributes."""
+    return "".join(" %s=%s" % (name, quoteattr(str(value)))
+                   for name, value in attributes)
 
 
 def _set_gml_id(element, gml_id):
@@ -555,28 +577,46 @@ class HazardMapDBReader(object):
         The structure of the result is documented in
         :class:`HazardMapDBWriter`.
         """
+        return list(itertools.chain.from_iterable(
+            HazardMapDBReader.stream(output_id)))
+
+    @staticmethod
+    def stream(output_id, size=db_utils.DEFAULT_FETCH_SIZE):
+        """
+        Read the given hazard map from the database in batches of `size`
+        points, through a server-side cursor.
+
+        The batches can be passed to :func:`serialize_in_stages`.
+        """
         hazard_map = models.HazardMap.objects.get(output=output_id)
-        hazard_map_data = hazard_map.hazardmapdata_set.all()
         params = hazard_map.output.oq_calculation.oq_job_profile
-        points = []
 
-        for datum in hazard_map_data:
-            values = {
-                'IML': datum.value,
-                'IMT': REVERSE_ENUM_MAP[params.imt],
-                'investigationTimeSpan': params.investigation_time,
-                'poE': hazard_map.poe,
-                'statistics': hazard_map.statistic_type,
-                'vs30': params.reference_vs30_value,
-            }
+        common = {
+            'IMT': REVERSE_ENUM_MAP[params.imt],
+            'investigationTimeSpan': params.investigation_time,
+            'poE': hazard_map.poe,
+            'statistics': hazard_map.statistic_type,
+            'vs30': params.reference_vs30_value,
+        }
+
+        if hazard_map.statistic_type == 'quantile':
+            common['quantileValue'] = hazard_map.quantile
 
-            if hazard_map.statistic_type == 'quantile':
-                values['quantileValue'] = hazard_map.quantile
+        hazard_map_data = models.HazardMapData.objects.filter(
+            hazard_map=hazard_map).extra(
+            select=db_utils.point_coordinates(models.HazardMapData)).order_by(
+            'id').values_list('lon', 'lat', 'value')
 
-            loc = datum.location
-            points.append((shapes.Site(loc.x, loc.y), values))
+        for batch in db_utils.stream_values_list(hazard_map_data, size):
+            points = []
 
-        return points
+            for lon, lat, value in batch:
+                values = common.copy()
+                values['IML'] = value
+
+                points.append((shapes.Site(lon, lat), values))
+
+            yield points
 
 
 class HazardMapDBWriter(writer.DBWriter):
@@ -668,42 +708,58 @@ class HazardCurveDBReader(object):
     structure that can be passed to
     :func:`HazardCurveXMLWriter.serialize` to produce an XML file.
     """
-    def deserialize(self, output_id):  # pylint: disable=R0201
+    def deserialize(self, output_id):
         """
         Read a the given hazard curve from the database.
 
         The structure of the result is documented in
         :class:`HazardCurveDBWriter`.
         """
-        hazard_curves = models.HazardCurve.objects.filter(output=output_id)
+        return list(itertools.chain.from_iterable(self.stream(output_id)))
+
+    def stream(self, output_id,  # pylint: disable=R0201
+               size=db_utils.DEFAULT_FETCH_SIZE):
+        """
+        Read the given hazard curves from the database in batches of at
+        most `size` curves, through a server-side cursor.
+
+        The batches can be passed to :func:`serialize_in_stages`.
+        """
+        hazard_curves = models.HazardCurve.objects.filter(
+            output=output_id).order_by('id')
         params = models.Output.objects.get(
             id=output_id).oq_calculation.oq_job_profile
-        points = []
-
-        for hazard_curve_datum in hazard_curves:
-            hazard_curve_data = hazard_curve_datum.hazardcurvedata_set.all()
 
+        for hazard_curve in hazard_curves:
             common = {
                 'IMLValues': params.imls,
                 'investigationTimeSpan': params.investigation_time,
                 'IMT': REVERSE_ENUM_MAP[params.imt],
             }
 
-            if hazard_curve_datum.end_branch_label is None:
-                common['statistics'] = hazard_curve_datum.statistic_type
-                if hazard_curve_datum.statistic_type == 'quantile':
-                    common['quantileValue'] = hazard_curve_datum.quantile
+            if hazard_curve.end_branch_label is None:
+                common['statistics'] = hazard_curve.statistic_type
+                if hazard_curve.statistic_type == 'quantile':
+                    common['quantileValue'] = hazard_curve.quantile
             else:
-                common['endBranchLabel'] = hazard_curve_datum.end_branch_label
+                common['endBranchLabel'] = hazard_curve.end_branch_label
+
+            hazard_curve_data = models.HazardCurveData.objects.filter(
+                hazard_curve=hazard_curve).extra(
+                select=db_utils.point_coordinates(
+                    models.HazardCurveData)).order_by('id').values_list(
+                'lon', 'lat', 'poes')
 
-            for datum in hazard_curve_data:
-                attrs = common.copy()
-                attrs['PoEValues'] = datum.poes
+            for batch in db_utils.stream_values_list(hazard_curve_data, size):
+                points = []
 
-                loc = datum.location
-                points.append((shapes.Site(loc.x, loc.y), attrs))
+                for lon, lat, poes in batch:
+                    attrs = common.copy()
+                    attrs['PoEValues'] = poes
 
-        return points
+                    points.append((shapes.Site(lon, lat), attrs))
+
+                yield points
 
 
 class HazardCurveDBWriter(writer.DBWriter):
@@ -796,16 +852,22 @@ class GmfDBReader(object):
 
         The structure of the result is documented in :class:`GmfDBWriter`.
         """
-        gmf_data = models.GmfData.objects.filter(output=output_id)
-        points = {}
+        return dict(itertools.chain.from_iterable(
+            GmfDBReader.stream(output_id)))
 
-        for datum in gmf_data:
-            loc = datum.location
-            points[shapes.Site(loc.x, loc.y)] = {
-                'groundMotion': datum.ground_motion,
-            }
+    @staticmethod
+    def stream(output_id, size=db_utils.DEFAULT_FETCH_SIZE):
+        """
+        Read the given ground motion field from the database in batches of
+        `size` (site, values) pairs, through a server-side cursor.
+        """
+        gmf_data = models.GmfData.objects.filter(output=output_id).extra(
+            select=db_utils.point_coordinates(models.GmfData)).order_by(
+            'id').values_list('lon', 'lat', 'ground_motion')
 
-        return points
+        for batch in db_utils.stream_values_list(gmf_data, size):
+            yield [(shapes.Site(lon, lat), {'groundMotion': ground_motion})
+                   for lon, lat, ground_motion in batch]
 
 
 class GmfDBWriter(writer.DBWriter):
@@ -851,16 +913,24 @@ _XML_SERIALIZER_CACHE = defaultdict(lambda: None)
 
 
 def _create_writer(job_id, serialize_to, nrml_path, create_xml_writer,
-                   create_db_writer, multistage_serialization=False):
+                   create_db_writer, multistage_serialization=False,
+                   create_hdf5_writer=None):
     """Common code for the functions below"""
 
     writers = []
 
-    if 'db' in serialize_to:
+    if 'db' in serialize_to or 'hdf5' in serialize_to:
         assert job_id, "No job_id supplied"
         job_id = int(job_id)
+
+    if 'db' in serialize_to:
         writers.append(create_db_writer(nrml_path, job_id))
 
+    # the outputs of the archive are named after their NRML files
+    if ('hdf5' in serialize_to and create_hdf5_writer is not None
+        and nrml_path):
+        writers.append(create_hdf5_writer(nrml_path, job_id))
+
     if 'xml' in serialize_to and nrml_path:
         if multistage_serialization:
             obj = _XML_SERIALIZER_CACHE[(job_id, nrml_path)]
@@ -880,14 +950,18 @@ def create_hazardcurve_writer(job_id, serialize_to, nrml_path):
     :param job_id: the id of the job the curve belongs to.
     :type job_id: int
     :param serialize_to: where to serialize
-    :type serialize_to: list of strings. Permitted values: 'db', 'xml'.
+    :type serialize_to: list of strings. Permitted values: 'db', 'xml',
+        'hdf5'.
     :param str nrml_path: the full path of the XML/NRML representation of the
         hazard curve.
-    :returns: an :py:class:`output.hazard.HazardCurveXMLWriter` or an
-        :py:class:`output.hazard.HazardCurveDBWriter` instance.
+    :returns: an :py:class:`output.hazard.HazardCurveXMLWriter`, an
+        :py:class:`output.hazard.HazardCurveDBWriter` or an
+        :py:class:`output.hdf5.HazardCurveHDF5Writer` instance, or a
+        composition of them.
     """
     return _create_writer(job_id, serialize_to, nrml_path,
-                          HazardCurveXMLWriter, HazardCurveDBWriter, True)
+                          HazardCurveXMLWriter, HazardCurveDBWriter, True,
+                          hdf5.HazardCurveHDF5Writer)
 
 
 def create_hazardmap_writer(job_id, serialize_to, nrml_path):
@@ -896,14 +970,17 @@ def create_hazardmap_writer(job_id, serialize_to, nrml_path):
     :param job_id: the id of the job the curve belongs to.
     :type job_id: int
     :param serialize_to: where to serialize
-    :type serialize_to: list of strings. Permitted values: 'db', 'xml'.
+    :type serialize_to: list of strings. Permitted values: 'db', 'xml',
+        'hdf5'.
     :param str nrml_path: the full path of the XML/NRML representation of the
         hazard map.
-    :returns: an :py:class:`output.hazard.HazardMapXMLWriter` or an
-        :py:class:`output.hazard.HazardMapDBWriter` instance.
+    :returns: an :py:class:`output.hazard.HazardMapXMLWriter`, an
+        :py:class:`output.hazard.HazardMapDBWriter` or an
+        :py:class:`output.hdf5.HazardMapHDF5Writer` instance, or a
+        composition of them.
     """
     return _create_writer(job_id, serialize_to, nrml_path, HazardMapXMLWriter,
-                          HazardMapDBWriter, True)
+                          HazardMapDBWriter, True, hdf5.HazardMapHDF5Writer)
 
 
 def create_gmf_writer(job_id, serialize_to, nrml_path):
@@ -912,19 +989,26 @@ def create_gmf_writer(job_id, serialize_to, nrml_path):
     :param job_id: the id of the job the curve belongs to.
     :type job_id: int
     :param serialize_to: where to serialize
-    :type serialize_to: list of strings. Permitted values: 'db', 'xml'.
+    :type serialize_to: list of strings. Permitted values: 'db', 'xml',
+        'hdf5'.
     :param str nrml_path: the full path of the XML/NRML representation of the
         ground motion field.
-    :returns: an :py:class:`output.hazard.GMFXMLWriter` or an
-        :py:class:`output.hazard.GmfDBWriter` instance.
+    :returns: an :py:class:`output.hazard.GMFXMLWriter`, an
+        :py:class:`output.hazard.GmfDBWriter` or an
+        :py:class:`output.hdf5.GmfHDF5Writer` instance, or a composition of
+        them.
     """
     return _create_writer(
-        job_id, serialize_to, nrml_path, GMFXMLWriter, GmfDBWriter)
+        job_id, serialize_to, nrml_path, GMFXMLWriter, GmfDBWriter,
+        create_hdf5_writer=hdf5.GmfHDF5Writer)
 
 
 @general.singleton
-class SerializerContext(object):
-    """Used to facilitate multi-stage XML serialization."""
+class SerializerContext(threading.local):
+    """Used to facilitate multi-stage XML serialization.
+
+    The context is per thread, so that the results can be serialized by
+    :class:`openquake.writer.ResultSink` workers."""
     def __init__(self):
         self.blocks = 0
         self.cblock = 0
@@ -992,3 +1076,34 @@ class SerializerContext(object):
                 middle = True
 
         return mode(start, middle, end)
+
+
+def serialize_in_stages(xml_writer, batches):
+    """Serialize batches of items, e.g. the ones yielded by the `stream`
+    method of the DB readers, with a multi-stage XML writer.
+
+    The XML serialization context is set for each batch, so that the
+    document is written once, when the last batch is serialized.
+
+    :param xml_writer: a writer relying on :class:`SerializerContext`, like
+        :class:`HazardCurveXMLWriter` or :class:`HazardMapXMLWriter`
+    :param batches: an iterable of lists of items to be serialized
+    """
+    xsc = namedtuple("XSC", "blocks, cblock, i_total, i_done, i_next")
+    batches = iter(batches)
+
+    done = 0
+    batch = next(batches, [])
+
+    while batch is not None:
+        following = next(batches, None)
+
+        # the total is not known in advance, it is enough to expect one
+        # more item while there are batches left
+        total = done + len(batch) + (0 if following is None else 1)
+
+        SerializerContext().update(xsc(1, 1, total, done, len(batch)))
+        xml_writer.serialize(batch)
+
+        done += len(batch)
+        batch = following
@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2010-2012, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# only, as published by the Free Software Foundation.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License version 3 for more details
+# (a copy is included in the LICENSE file that accompanied this code).
+#
+# You should have received a copy of the GNU Lesser General Public License
+# version 3 along with OpenQuake.  If not, see
+# <http://www.gnu.org/licenses/lgpl-3.0.txt> for a copy of the LGPLv3 License.
+
+"""
+Serialization of calculation results to a columnar HDF5 archive.
+
+There is one archive per calculation, in the output directory of the
+calculation. Each kind of result has its own group (e.g. `hazard_curves`,
+`loss_maps`) holding a subgroup per output, with:
+
+    * `lons` and `lats`: the coordinates of the sites
+    * the values, as datasets with a row per site (or asset)
+
+The metadata of an output are stored as attributes of its group.
+
+All the datasets are chunked, compressed and resizable along their first
+axis: the results of a calculation are appended block by block and they can
+be read lazily, see :func:`read_batches`.
+"""
+
+import os
+import threading
+
+import h5py
+import numpy
+
+from openquake import shapes
+
+
+# number of rows per chunk of the datasets
+CHUNK_ROWS = 1024
+
+# the same archive is written by all the writers of a calculation
+_ARCHIVE_LOCK = threading.Lock()
+
+_FLOAT_ARRAY = h5py.special_dtype(vlen=numpy.float64)
+_STRING = h5py.special_dtype(vlen=str)
+
+
+def archive_path(directory, job_id):
+    """The path of the HDF5 archive of a calculation.
+
+    :param str directory: the output directory of the calculation
+    :param int job_id: the id of the calculation
+    """
+    return os.path.join(directory, "calculation-%s.hdf5" % job_id)
+
+
+def read_batches(path, name, size=CHUNK_ROWS):
+    """Read an output of an archive in batches of rows.
+
+    Only the rows of the batch being read are loaded in memory.
+
+    :param str path: the path of the archive
+    :param str name: the name of the output, e.g. `hazard_curves/mean`
+    :param int size: the number of rows of a batch
+    :returns: a generator of dictionaries, mapping the names of the
+        datasets of the output to their rows in the batch
+    """
+    with h5py.File(path, "r") as archive:
+        group = archive[name]
+        rows = len(group["lons"])
+
+        for start in xrange(0, rows, size):
+            yield dict((key, dataset[start:start + size])
+                       for key, dataset in group.iteritems())
+
+
+def _append(group, name, values, dtype=numpy.float64):
+    """Append rows to a dataset of the given group, creating it if needed."""
+    if dtype in (_FLOAT_ARRAY, _STRING):
+        rows = numpy.empty(len(values), dtype=object)
+        rows[:] = values
+    else:
+        rows = numpy.asarray(values, dtype=dtype)
+
+    if name not in group:
+        group.create_dataset(
+            name, data=rows, dtype=dtype, maxshape=(None,) + rows.shape[1:],
+            chunks=(CHUNK_ROWS,) + rows.shape[1:], compression="gzip")
+    elif len(rows):
+        dataset = group[name]
+        size = len(dataset)
+
+        dataset.resize(size + len(rows), axis=0)
+        dataset[size:] = rows
+
+
+def _append_sites(group, sites):
+    """Append the coordinates of the given sites to a group."""
+    sites = [site.site if isinstance(site, shapes.GridPoint) else site
+             for site in sites]
+
+    _append(group, "lons", [site.longitude for site in sites])
+    _append(group, "lats", [site.latitude for site in sites])
+
+
+def _set_attributes(group, values, keys):
+    """Store the metadata found in `values` as attributes of a group."""
+    for key in keys:
+        if values.get(key) is not None:
+            group.attrs[key] = values[key]
+
+
+class HDF5Writer(object):
+    """
+    Base class of the writers appending results to the HDF5 archive of a
+    calculation.
+
+    Subclasses set the archive `group` of the kind of result written and
+    implement :meth:`append`.
+    """
+
+    group = None
+
+    def __init__(self, nrml_path, oq_calculation_id):
+        self.path = archive_path(
+            os.path.dirname(os.path.abspath(nrml_path)), oq_calculation_id)
+        # the outputs are named after their NRML files
+        self.name = os.path.splitext(os.path.basename(nrml_path))[0]
+
+    def serialize(self, iterable):
+        """Append the given items to the archive."""
+        if isinstance(iterable, dict):
+            iterable = iterable.items()
+
+        with _ARCHIVE_LOCK:
+            with h5py.File(self.path, "a") as archive:
+                self.append(archive.require_group(self.group), list(iterable))
+
+    def append(self, group, items):
+        """
+        Append the items to the group of the kind of result written.
+
+        :param group: the :class:`h5py.Group` of the kind of result
+        :param list items: the items passed to :meth:`serialize`
+        """
+        raise NotImplementedError
+
+
+class HazardCurveHDF5Writer(HDF5Writer):
+    """
+    Append hazard curves to the archive: the curves of a realization or of
+    a statistic are stored in the `hazard_curves/<label>` group, with a row
+    of PoEs per site in the `poes` dataset.
+
+    The items serialized are the ones documented in
+    :class:`openquake.output.hazard.HazardCurveDBWriter`.
+    """
+
+    group = "hazard_curves"
+
+    def append(self, group, items):
+        curves_per_label = {}
+
+        for site, values in items:
+            if 'endBranchLabel' in values:
+                label = values['endBranchLabel']
+            elif values.get('statistics') == 'quantile':
+                label = "quantile-%s" % values['quantileValue']
+            else:
+                label = values['statistics']
+
+            curves_per_label.setdefault(label, []).append((site, values))
+
+        for label, curves in curves_per_label.iteritems():
+            curves_group = group.require_group(label)
+
+            _set_attributes(curves_group, curves[0][1], (
+                'IMT', 'investigationTimeSpan', 'endBranchLabel',
+                'statistics', 'quantileValue'))
+            curves_group.attrs['IMLValues'] = curves[0][1]['IMLValues']
+
+            _append_sites(curves_group, [site for site, _ in curves])
+            _append(curves_group, "poes",
+                    [values['PoEValues'] for _, values in curves])
+
+
+class HazardMapHDF5Writer(HDF5Writer):
+    """
+    Append hazard maps to the archive, in the `hazard_maps/<name>` group,
+    with the IML of each site in the `imls` dataset.
+
+    The items serialized are the ones documented in
+    :class:`openquake.output.hazard.HazardMapDBWriter`.
+    """
+
+    group = "hazard_maps"
+
+    def append(self, group, items):
+        # the sites without an IML are not stored, as in the database
+        items = [(site, values) for site, values in items
+                 if values.get('IML') is not None]
+
+        map_group = group.require_group(self.name)
+
+        if items:
+            _set_attributes(map_group, items[0][1], (
+                'IMT', 'investigationTimeSpan', 'poE', 'vs30',
+                'endBranchLabel', 'statistics', 'quantileValue'))
+
+        _append_sites(map_group, [site for site, _ in items])
+        _append(map_group, "imls", [values['IML'] for _, values in items])
+
+
+class GmfHDF5Writer(HDF5Writer):
+    """
+    Append ground motion fields to the archive, in the `gmfs/<name>` group,
+    with the ground motion of each site in the `ground_motion` dataset.
+
+    The items serialized are the ones documented in
+    :class:`openquake.output.hazard.GmfDBWriter`.
+    """
+
+    group = "gmfs"
+
+    def append(self, group, items):
+        gmf_group = group.require_group(self.name)
+
+        _append_sites(gmf_group, [site for site, _ in items])
+        _append(gmf_group, "ground_motion",
+                [values['groundMotion'] for _, values in items])
+
+
+class LossCurveHDF5Writer(HDF5Writer):
+    """
+    Append loss (or loss ratio) curves to the archive, in the
+    `loss_curves/<name>` (or `loss_ratio_curves/<name>`) group, with a row
+    per asset. The curves of the assets can have a different number of
+    values, their abscissae and PoEs are stored as variable length rows.
+
+    The items serialized are the ones documented in
+    :class:`openquake.output.risk.LossCurveDBWriter`.
+    """
+
+    def __init__(self, nrml_path, oq_calculation_id, curve_mode):
+        super(LossCurveHDF5Writer, self).__init__(
+            nrml_path, oq_calculation_id)
+
+        assert curve_mode in ('loss', 'loss_ratio')
+        self.group = "%s_curves" % curve_mode
+
+    def append(self, group, items):
+        curves_group = group.require_group(self.name)
+
+        if items:
+            _set_attributes(curves_group, items[0][1][1], (
+                'assetValueUnit', 'endBranchLabel', 'lossCategory'))
+
+        _append_sites(curves_group, [site for site, _ in items])
+        _append(curves_group, "asset_refs",
+                [asset['assetID'] for _, (_, asset) in items], _STRING)
+        _append(curves_group, "abscissae",
+                [curve.abscissae for _, (curve, _) in items], _FLOAT_ARRAY)
+        _append(curves_group, "poes",
+                [curve.ordinates for _, (curve, _) in items], _FLOAT_ARRAY)
+
+
+class LossMapHDF5Writer(HDF5Writer):
+    """
+    Append loss maps to the archive, in the `loss_maps/<name>` group, with a
+    row per asset: the `values` dataset holds the mean (scenario) or the
+    conditional (non scenario) losses, `std_devs` the standard deviations
+    of the scenario losses.
+
+    The items serialized are the ones documented in
+    :class:`openquake.output.risk.LossMapDBWriter`.
+    """
+
+    group = "loss_maps"
+
+    def append(self, group, items):
+        map_group = group.require_group(self.name)
+
+        if items and isinstance(items[0], dict):
+            _set_attributes(map_group, items[0], (
+                'scenario', 'timespan', 'poe', 'endBranchLabel',
+                'lossCategory', 'unit'))
+            items = items[1:]
+
+        scenario = map_group.attrs.get('scenario', False)
+        rows = [(site, loss, asset)
+                for site, losses in items for loss, asset in losses]
+
+        _append_sites(map_group, [site for site, _, _ in rows])
+        _append(map_group, "asset_refs",
+                [asset['assetID'] for _, _, asset in rows], _STRING)
+
+        if scenario:
+            _append(map_group, "values",
+                    [loss['mean_loss'] for _, loss, _ in rows])
+            _append(map_group, "std_devs",
+                    [loss['stddev_loss'] for _, loss, _ in rows])
+        else:
+            _append(map_group, "values",
+                    [loss['value'] for _, loss, _ in rows])
+            _append(map_group, "std_devs", [0.0] * len(rows))
@@ -24,6 +24,8 @@ NRML serialization of risk-related data sets.
 - loss maps for Scenario, Probabilistic and Classical
 """
 
+import itertools
+
 from collections import defaultdict
 
 from lxml import etree
@@ -34,7 +36,9 @@ from openquake import shapes
 from openquake import writer
 from openquake import xml
 
+from openquake.output import hdf5
 from openquake.output import nrml
+from openquake.utils import db as db_utils
 from openquake.xml import NRML_NS, GML_NS
 
 NAMESPACES = {'gml': GML_NS, 'nrml': NRML_NS}
@@ -507,7 +511,8 @@ def create_loss_map_writer(job_id, serialize_to, nrml_path, scenario):
     :param job_id: the id of the job the curve belongs to.
     :type job_id: int
     :param serialize_to: where to serialize
-    :type serialize_to: list of strings. Permitted values: 'db', 'xml'.
+    :type serialize_to: list of strings. Permitted values: 'db', 'xml',
+        'hdf5'.
     :param nrml_path: the full path of the XML/NRML representation of the
         loss map.
     :type nrml_path: string
@@ -518,12 +523,16 @@ def create_loss_map_writer(job_id, serialize_to, nrml_path, scenario):
         :py:class:`output.risk.LossMapXMLWriter` or
         :py:class:`output.risk.LossMapDBWriter`
         :py:class:`output.risk.LossMapNonScenarioXMLWriter`
+        :py:class:`output.hdf5.LossMapHDF5Writer`
     """
     writers = []
 
     if 'db' in serialize_to:
         writers.append(LossMapDBWriter(nrml_path, job_id))
 
+    if 'hdf5' in serialize_to:
+        writers.append(hdf5.LossMapHDF5Writer(nrml_path, job_id))
+
     if 'xml' in serialize_to:
         if scenario:
             writers.append(LossMapXMLWriter(nrml_path))
@@ -713,26 +722,41 @@ class LossCurveDBReader(object):
         The structure of the result is documented in
         :class:`LossCurveDBWriter`.
         """
+        return list(itertools.chain.from_iterable(
+            LossCurveDBReader.stream(output_id)))
+
+    @staticmethod
+    def stream(output_id, size=db_utils.DEFAULT_FETCH_SIZE):
+        """
+        Read the given loss curves from the database in batches of `size`
+        curves, through a server-side cursor.
+        """
         loss_curve = models.LossCurve.objects.get(output=output_id)
-        loss_curve_data = loss_curve.losscurvedata_set.all()
 
-        curves = []
         asset = {
             'assetValueUnit': loss_curve.unit,
             'endBranchLabel': loss_curve.end_branch_label,
             'lossCategory': loss_curve.category,
         }
 
-        for datum in loss_curve_data:
-            curve = shapes.Curve(zip(datum.losses, datum.poes))
+        loss_curve_data = models.LossCurveData.objects.filter(
+            loss_curve=loss_curve).extra(
+            select=db_utils.point_coordinates(models.LossCurveData)).order_by(
+            'id').values_list('lon', 'lat', 'asset_ref', 'losses', 'poes')
 
-            asset_object = asset.copy()
-            asset_object['assetID'] = datum.asset_ref
+        for batch in db_utils.stream_values_list(loss_curve_data, size):
+            curves = []
 
-            loc = datum.location
-            curves.append((shapes.Site(loc.x, loc.y), (curve, asset_object)))
+            for lon, lat, asset_ref, losses, poes in batch:
+                curve = shapes.Curve.from_arrays(losses, poes)
 
-        return curves
+                asset_object = asset.copy()
+                asset_object['assetID'] = asset_ref
+
+                curves.append(
+                    (shapes.Site(lon, lat), (curve, asset_object)))
+
+            yield curves
 
 
 class LossCurveDBWriter(writer.DBWriter):
@@ -849,14 +873,16 @@ def create_loss_curve_writer(job_id, serialize_to, nrml_path, curve_mode):
     :param job_id: the id of the job the curve belongs to.
     :type job_id: int
     :param serialize_to: where to serialize
-    :type serialize_to: list of strings. Permitted values: 'db', 'xml'.
+    :type serialize_to: list of strings. Permitted values: 'db', 'xml',
+        'hdf5'.
     :param str nrml_path: the full path of the XML/NRML representation of the
         hazard map.
     :param str curve_mode: one of 'loss', 'loss_ratio'
     :returns: None or an instance of
         :py:class:`output.risk.LossCurveXMLWriter`,
         :py:class:`output.risk.LossCurveDBWriter`,
-        :py:class:`output.risk.LossRatioCurveXMLWriter`
+        :py:class:`output.risk.LossRatioCurveXMLWriter`,
+        :py:class:`output.hdf5.LossCurveHDF5Writer`
     """
 
     assert curve_mode in ('loss', 'loss_ratio')
@@ -874,6 +900,13 @@ def create_loss_curve_writer(job_id, serialize_to, nrml_path, curve_mode):
             # We are non interested in storing loss ratios in the db
             pass
 
+    if 'hdf5' in serialize_to:
+        if job_id is None:
+            raise RuntimeError("No job_id supplied")
+
+        writers.append(
+            hdf5.LossCurveHDF5Writer(nrml_path, int(job_id), curve_mode))
+
     if 'xml' in serialize_to:
         if curve_mode == 'loss':
             writer_class = LossCurveXMLWriter
@@ -22,8 +22,15 @@
 These can include building, population, critical infrastructure,
 and other asset classes."""
 
+import cPickle
+import hashlib
+import os
+import tempfile
+
+from itertools import islice
 from lxml import etree
 
+from openquake import logs
 from openquake import producer
 from openquake import shapes
 from openquake import xml
@@ -33,6 +40,15 @@ from openquake.xml import NRML, GML
 # do not use namespace for now
 RISKML_NS = ''
 
+LOG = logs.LOG
+
+# the version of the format of the cached exposures, to be increased
+# whenever the parser or the cache change what is stored
+CACHE_VERSION = 2
+
+# number of assets read, filtered and cached at once
+BATCH_SIZE = 1000
+
 
 def _to_site(element):
     """Convert current GML attributes to Site object
@@ -170,3 +186,149 @@ class ExposurePortfolioFile(producer.FileProducer):
         site_attributes.update(self._current_meta)
 
         return site_attributes
+
+
+def _content_hash(path, chunk_size=1 << 20):
+    """The SHA-1 hex digest of the contents of the file at `path`."""
+    digest = hashlib.sha1()
+    with open(path, "rb") as exposure_file:
+        for chunk in iter(lambda: exposure_file.read(chunk_size), ""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _batches(pairs):
+    """Split the given (site, asset) pairs in lists of `BATCH_SIZE`."""
+    pairs = iter(pairs)
+    return iter(lambda: list(islice(pairs, BATCH_SIZE)), [])
+
+
+def _read_cache(cache_path):
+    """Yield the (site, asset) pairs stored in an exposure cache.
+
+    :raises EOFError: if the cache ends before its end marker
+    """
+    with open(cache_path, "rb") as cache:
+        while True:
+            records = cPickle.load(cache)
+
+            if records is None:
+                return
+
+            for (lon, lat), asset in records:
+                yield shapes.Site(lon, lat), asset
+
+
+def _write_cache(pairs, cache_path):
+    """Yield the given (site, asset) pairs, storing them in batches in a new
+    exposure cache. The cache ends with a `None` marker.
+
+    A cache that cannot be written is logged and ignored.
+    """
+    cache_dir = os.path.dirname(cache_path)
+    cache, tmp_path = None, None
+
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        # write to a temporary file first, concurrent jobs must never
+        # see a partially written cache
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+        cache = os.fdopen(fd, "wb")
+    except (IOError, OSError), ex:
+        LOG.warn("Unable to cache exposure %s: %s" % (cache_path, ex))
+
+    try:
+        for batch in _batches(pairs):
+            for pair in batch:
+                yield pair
+
+            if cache is not None:
+                try:
+                    cPickle.dump(
+                        [((site.longitude, site.latitude), asset)
+                         for site, asset in batch],
+                        cache, cPickle.HIGHEST_PROTOCOL)
+                except Exception, ex:  # pylint: disable=W0703
+                    LOG.warn("Unable to cache exposure %s: %s"
+                             % (cache_path, ex))
+                    cache.close()
+                    cache = None
+
+        if cache is not None:
+            try:
+                cPickle.dump(None, cache, cPickle.HIGHEST_PROTOCOL)
+                cache.close()
+                cache = None
+                os.rename(tmp_path, cache_path)
+            except (IOError, OSError), ex:
+                LOG.warn("Unable to cache exposure %s: %s"
+                         % (cache_path, ex))
+    finally:
+        if cache is not None:
+            cache.close()
+
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def read_exposure(path, cache_dir=None, constraint=None):
+    """Parse and validate the exposure file at `path` once, keeping only the
+    assets located within the region of interest.
+
+    The exposure is read as a stream, in batches of `BATCH_SIZE` assets,
+    and the assets outside of the region are dropped as soon as they are
+    read.
+
+    When `cache_dir` is given the parsed assets are pickled there, in a
+    file named after the cache version and the hash of the exposure
+    contents, and later reads of an identical exposure (even under another
+    path) skip parsing and schema validation entirely. A cache that cannot
+    be read or written is logged and ignored.
+
+    :param path: path to an NRML exposure portfolio file
+    :type path: str
+    :param cache_dir: directory holding the parsed exposure cache
+    :type cache_dir: str
+    :param constraint: the region of interest, all the assets are kept
+        when `None`
+    :type constraint: :py:class:`openquake.shapes.RegionConstraint`
+    :returns: a list of (:py:class:`openquake.shapes.Site`, asset) pairs
+        in file order, the assets being the dicts yielded by
+        :py:class:`ExposurePortfolioFile`
+    """
+    def select(pairs):
+        """The pairs within the region of interest."""
+        assets = []
+
+        for batch in _batches(pairs):
+            if constraint is not None:
+                batch = constraint.filter_sites(
+                    batch, key=lambda site_asset: site_asset[0])
+
+            assets.extend(batch)
+
+        return assets
+
+    cache_path = None
+
+    if cache_dir:
+        cache_path = os.path.join(cache_dir, "exposure-v%s-%s.pickle" % (
+            CACHE_VERSION, _content_hash(path)))
+
+        if os.path.exists(cache_path):
+            try:
+                LOG.debug("Reading exposure %s from cache %s"
+                          % (path, cache_path))
+                return select(_read_cache(cache_path))
+            except Exception, ex:  # pylint: disable=W0703
+                LOG.warn("Unable to read cached exposure %s: %s"
+                         % (cache_path, ex))
+
+    pairs = ExposurePortfolioFile(path)
+
+    if cache_path:
+        pairs = _write_cache(pairs, cache_path)
+
+    return select(pairs)
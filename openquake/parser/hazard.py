@@ -26,10 +26,12 @@ NRML instance documents is <HazardResultList>.
 
 from lxml import etree
 
+import numpy
+
 from openquake import producer
 from openquake import shapes
 
-from openquake.xml import NRML_NS, GML_NS, NRML
+from openquake.xml import NRML_NS, GML_NS, NRML, GML
 
 
 NAMESPACES = {'gml': GML_NS, 'nrml': NRML_NS}
@@ -90,11 +92,16 @@ class NrmlFile(producer.FileProducer):
      'PoEValues': [9.8728e-01, 9.8266e-01, ...],
     }
 
+    The document is parsed as a stream: the IML list, the IMT and the
+    branch label of each hazardCurveField are read once, and the parsed
+    nodes are cleared. To read many curves at once use :py:meth:`batches`.
+
     Notes:
     1) TODO(fab): require that attribute values of 'IMT' are from list
        of allowed values (see NRML XML Schema)
-    2) 'endBranchLabel' can be replaced by 'aggregationType'
-    3) TODO(fab): require that value of 'aggregationType' element is from a
+    2) 'endBranchLabel' can be replaced by 'statistics' (and
+       'quantileValue')
+    3) TODO(fab): require that value of 'statistics' element is from a
        list of allowed values (see NRML XML Schema)
     4) 'saPeriod', 'saDamping', 'calcSettingsID', are optional
     5) NRML output can also contain hazard maps, parsing of those is not yet
@@ -106,19 +113,116 @@ class NrmlFile(producer.FileProducer):
                              ('investigationTimeSpan', float),
                              ('saPeriod', float), ('saDamping', float))
 
+    DEFAULT_BATCH_SIZE = 1000
+
     def __init__(self, path):
         super(NrmlFile, self).__init__(path)
         self._current_hazard_meta = None
 
     def _parse(self):
+        for lon, lat, poes, field_meta in self._parse_nodes():
+            attributes = dict(field_meta)
+            attributes['IMLValues'] = field_meta['IMLValues'].tolist()
+            attributes['PoEValues'] = poes.tolist()
+
+            yield (shapes.Site(lon, lat), attributes)
+
+    def batches(self, size=DEFAULT_BATCH_SIZE):
+        """Parse the hazard curves in batches of (at most) `size` sites.
+
+        All the curves in a batch belong to the same hazardCurveField.
+
+        :returns: a triple for each batch, with
+            * a :py:class:`dict` with the attributes shared by the curves
+              (as in the attribute dictionary above, without 'PoEValues'
+              and with 'IMLValues' as a :py:class:`numpy.ndarray`)
+            * a :py:class:`openquake.shapes.SiteCollection` with the sites
+            * a 2-dimensional :py:class:`numpy.ndarray` with the PoEs, one
+              row per site
+        """
+        lons, lats, rows = [], [], []
+        current_meta = None
+
+        for lon, lat, poes, field_meta in self._parse_nodes():
+            if rows and (field_meta is not current_meta or len(rows) == size):
+                yield (dict(current_meta),
+                       shapes.SiteCollection(lons, lats), numpy.array(rows))
+                lons, lats, rows = [], [], []
+
+            current_meta = field_meta
+            lons.append(lon)
+            lats.append(lat)
+            rows.append(poes)
+
+        if rows:
+            yield (dict(current_meta),
+                   shapes.SiteCollection(lons, lats), numpy.array(rows))
+
+    def _parse_nodes(self):
+        """Parse the HCNode elements as (lon, lat, PoEs, field metadata)
+        quadruples. The metadata dictionary is the same object for all the
+        nodes of a hazardCurveField."""
+        field_meta = None
+        position = None
+        poes = None
+
         for event, element in etree.iterparse(
                 self.file, events=('start', 'end')):
-            if event == 'start' and element.tag == NRML + 'hazardProcessing':
-                self._hazard_curve_meta(element)
-            elif event == 'end' and element.tag == NRML + 'HCNode':
-                site_data = (_to_site(element), self._to_attributes(element))
-                del element
-                yield site_data
+            tag = element.tag
+
+            if event == 'start':
+                if tag == NRML + 'hazardProcessing':
+                    self._hazard_curve_meta(element)
+                elif tag == NRML + 'hazardCurveField':
+                    field_meta = self._field_meta(element)
+            elif tag == GML + 'pos':
+                position = element.text
+            elif tag == NRML + 'poE':
+                poes = element.text
+            elif tag == NRML + 'IML':
+                field_meta['IMLValues'] = _to_floats(
+                    element.text, 'IMLValues')
+                field_meta['IMT'] = _strip(element.get('IMT'), 'IMT')
+            elif tag == NRML + 'HCNode':
+                if self._current_hazard_meta is None:
+                    raise ValueError(
+                        "config element 'hazardProcessing' is missing")
+
+                if field_meta is None or 'IMLValues' not in field_meta:
+                    raise ValueError('invalid or missing IMLValues value')
+
+                # one PoE per IML
+                poes = _to_floats(poes, 'PoEValues',
+                                  len(field_meta['IMLValues']))
+                lon, lat = _to_coordinates(position)
+
+                yield (lon, lat, poes, field_meta)
+
+                position = None
+                poes = None
+
+                _clear(element)
+            elif tag == NRML + 'hazardCurveField':
+                _clear(element)
+
+    def _field_meta(self, element):
+        """ Metadata shared by the curves of a hazardCurveField element """
+        field_meta = dict(self._current_hazard_meta or {})
+
+        if element.get('endBranchLabel') is not None:
+            field_meta['endBranchLabel'] = _strip(
+                element.get('endBranchLabel'), 'endBranchLabel')
+        elif element.get('statistics') is not None:
+            field_meta['statistics'] = _strip(
+                element.get('statistics'), 'statistics')
+
+            if element.get('quantileValue') is not None:
+                field_meta['quantileValue'] = float(
+                    element.get('quantileValue'))
+        else:
+            raise ValueError('invalid or missing endBranchLabel value')
+
+        return field_meta
 
     def _hazard_curve_meta(self, element):
         """ Hazard curve metadata from the element """
@@ -133,35 +237,50 @@ class NrmlFile(producer.FileProducer):
                     "missing required attribute %s" % required_attribute
                 raise ValueError(error_str)
 
-    def _to_attributes(self, element):
-        """ Build an attributes dict from an HCNode element """
 
-        attributes = {}
+def _clear(element):
+    """Free the memory of an element, and of its siblings already parsed."""
+    element.clear()
 
-        invalid_value_error = 'invalid or missing %s value'
+    while element.getprevious() is not None:
+        del element.getparent()[0]
 
-        float_strip = lambda x: [float(o) for o in x[0].text.strip().split()]
-        get_imt = lambda x: x[0].get('IMT').strip()
-        get_ebl = lambda x: x[0].get('endBranchLabel').strip()
 
-        for (child_el, child_key, etl) in (
-            ('./nrml:hazardCurve/nrml:poE', 'PoEValues', float_strip),
-            ('../nrml:IML', 'IMLValues', float_strip),
-            ('../nrml:IML', 'IMT', get_imt),
-            ('../../nrml:hazardCurveField', 'endBranchLabel', get_ebl)):
-            child_node = element.xpath(child_el,
-                namespaces=NAMESPACES)
+def _strip(value, key):
+    """The stripped value of an XML attribute, which is mandatory."""
+    try:
+        return value.strip()
+    except AttributeError:
+        raise ValueError('invalid or missing %s value' % key)
+
+
+def _to_floats(text, key, size=None):
+    """Parse a whitespace separated list of floats into a numpy array.
+
+    The parsing stops silently at the first value that is not a number,
+    so the number of parsed values is checked against the given size
+    (or against the number of values in the text)."""
+    try:
+        values = numpy.fromstring(text, dtype=float, sep=' ')
+    except (TypeError, ValueError):
+        raise ValueError('invalid or missing %s value' % key)
 
-            try:
-                attributes[child_key] = etl(child_node)
-            except Exception:
-                raise ValueError(invalid_value_error % child_key)
+    if size is None:
+        size = len(text.split())
 
-        if self._current_hazard_meta is None:
-            raise ValueError("config element 'hazardProcessing' is missing")
+    if values.size == 0 or values.size != size:
+        raise ValueError('invalid or missing %s value' % key)
 
-        attributes.update(self._current_hazard_meta)
-        return attributes
+    return values
+
+
+def _to_coordinates(text):
+    """Parse the lon/lat of a gml:pos element."""
+    try:
+        lon, lat = text.split()
+        return float(lon), float(lat)
+    except (AttributeError, ValueError, TypeError):
+        raise ValueError('Missing or invalid lon/lat')
 
 
 class GMFReader(producer.FileProducer):
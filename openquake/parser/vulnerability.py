@@ -114,7 +114,7 @@ class VulnerabilityModelFile(producer.FileProducer):
                 yield dict(vuln_function)
 
 
-# TODO (ac): These two functions should be probably moved elsewhere
+# TODO (ac): These functions should be probably moved elsewhere
 def load_vulnerability_model(job_id, path, retrofitted=False):
     """Load and store the vulnerability model defined in the
     given NRML file in the underlying kvs system."""
@@ -127,22 +127,38 @@ def load_vulnerability_model(job_id, path, retrofitted=False):
         vuln_func = shapes.VulnerabilityFunction(vuln_curve['IML'],
             vuln_curve['lossRatio'], vuln_curve['coefficientsVariation'])
 
-        vulnerability_model[vuln_curve["ID"]] = vuln_func.to_json()
+        vulnerability_model[vuln_curve["ID"]] = vuln_func
 
-    kvs.set_value_json_encoded(kvs.tokens.vuln_key(job_id, retrofitted),
-            vulnerability_model)
+    store_vuln_model(job_id, vulnerability_model, retrofitted)
+
+
+def store_vuln_model(job_id, vulnerability_model, retrofitted=False):
+    """Share the given vulnerability model with all the tasks of the job.
+
+    The model is stored once as a job artifact (see
+    :func:`openquake.kvs.share_artifact`) and only its reference is kept
+    under the vulnerability model key of the job.
+
+    :param vulnerability_model: dict of
+        :py:class:`openquake.shapes.VulnerabilityFunction` objects, keyed
+        by the vulnerability function ID
+    """
+    artifact_key = kvs.share_artifact(job_id, vulnerability_model)
+    kvs.get_client().set(
+        kvs.tokens.vuln_key(job_id, retrofitted), artifact_key)
 
 
 def load_vuln_model_from_kvs(job_id, retrofitted=False):
-    """Load the vulnerability model from kvs for the given job."""
+    """Load the vulnerability model from kvs for the given job.
 
-    vulnerability_model = kvs.get_value_json_decoded(
-            kvs.tokens.vuln_key(job_id, retrofitted))
+    The model is fetched only once per process and then cached for the
+    lifetime of the job, so the returned dict must not be modified.
+    """
 
-    vulnerability_curves = {}
+    artifact_key = kvs.get_client().get(
+        kvs.tokens.vuln_key(job_id, retrofitted))
 
-    if vulnerability_model is not None:
-        for k, v in vulnerability_model.items():
-            vulnerability_curves[k] = shapes.VulnerabilityFunction.from_json(v)
+    if artifact_key is None:
+        return {}
 
-    return vulnerability_curves
+    return kvs.get_artifact(job_id, artifact_key)
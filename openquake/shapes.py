@@ -19,7 +19,7 @@
 
 """Collection of base classes for processing spatially-related data."""
 
-import hashlib
+import cPickle
 import json
 import math
 import numpy
@@ -31,7 +31,7 @@ from numpy import allclose
 from numpy import sin, cos, arctan2, sqrt, radians
 
 from shapely import geometry
-from scipy.interpolate import interp1d
+from shapely.prepared import prep
 
 from openquake import java
 from openquake.utils import round_float
@@ -50,6 +50,8 @@ class Region(object):
 
     def __init__(self, polygon):
         self._grid = None
+        self._rectangle = None
+        self._prepared = None
         # TODO(JMC): Make this a multipolygon instead?
         self.polygon = polygon
         self.cell_size = 0.1
@@ -95,6 +97,131 @@ class Region(object):
         """Returns a bounding box containing the whole region"""
         return self.polygon.bounds
 
+    def covers(self, longitude, latitude):
+        """Is the given point inside the region or on its boundary?
+
+        Points outside the bounding box are rejected without touching the
+        polygon, the others are tested against a prepared (indexed) copy
+        of it.
+        """
+        (minx, miny, maxx, maxy) = self.polygon.bounds
+
+        if not (minx <= longitude <= maxx and miny <= latitude <= maxy):
+            return False
+
+        if self._prepare():
+            return True
+
+        # a point intersects a polygon when the polygon contains it
+        # or the point lies on its boundary
+        return self._prepared.intersects(geometry.Point(longitude, latitude))
+
+    def covers_all(self, longitudes, latitudes):
+        """Vectorized :py:meth:`covers` over coordinate arrays.
+
+        :returns: a boolean numpy array, True where the point at the same
+            position is inside the region or on its boundary
+        """
+        longitudes = numpy.asarray(longitudes, dtype=float)
+        latitudes = numpy.asarray(latitudes, dtype=float)
+        (minx, miny, maxx, maxy) = self.polygon.bounds
+
+        mask = ((longitudes >= minx) & (longitudes <= maxx)
+                & (latitudes >= miny) & (latitudes <= maxy))
+
+        if not self._prepare():
+            for index in numpy.flatnonzero(mask):
+                mask[index] = self._prepared.intersects(
+                    geometry.Point(longitudes[index], latitudes[index]))
+
+        return mask
+
+    def covers_grid(self, longitudes, latitudes):
+        """Which points of a regular grid are covered by the region?
+
+        The grid rows are scanned one at a time: the crossings of each
+        row with the polygon edges tell which points are inside (even-odd
+        rule). Only the points lying (almost) on an edge, where rounding
+        could make a difference, are tested against the polygon.
+
+        :param longitudes: the longitudes of the grid columns
+        :param latitudes: the latitudes of the grid rows
+        :returns: a (rows, columns) boolean numpy array
+        """
+        longitudes = numpy.asarray(longitudes, dtype=float)
+        latitudes = numpy.asarray(latitudes, dtype=float)
+
+        if self._prepare():
+            # the bounding box test is exact
+            return self.covers_all(
+                numpy.tile(longitudes, len(latitudes)),
+                numpy.repeat(latitudes, len(longitudes))).reshape(
+                    len(latitudes), len(longitudes))
+
+        edges = []
+        for ring in [self.polygon.exterior] + list(self.polygon.interiors):
+            coords = numpy.array(ring.coords)
+            edges.append(numpy.hstack([coords[:-1], coords[1:]]))
+
+        x_1, y_1, x_2, y_2 = numpy.vstack(edges).T
+        vertex_ys = numpy.unique(numpy.concatenate([y_1, y_2]))
+
+        eps = 1e-6
+        covered = numpy.zeros((len(latitudes), len(longitudes)), dtype=bool)
+        uncertain = numpy.zeros_like(covered)
+
+        for row, lat in enumerate(latitudes.tolist()):
+            near = numpy.searchsorted(vertex_ys, [lat - eps, lat + eps])
+            if near[0] != near[1]:
+                # a vertex (or a horizontal edge) is on this row
+                uncertain[row] = True
+                continue
+
+            crossing = (y_1 < lat) != (y_2 < lat)
+            xs = x_1[crossing] + (lat - y_1[crossing]) * (
+                (x_2[crossing] - x_1[crossing]) /
+                (y_2[crossing] - y_1[crossing]))
+            xs.sort()
+
+            if not len(xs):
+                continue
+
+            index = numpy.searchsorted(xs, longitudes)
+            covered[row] = index % 2 == 1
+
+            distance = numpy.minimum(
+                numpy.abs(longitudes - xs[numpy.maximum(index - 1, 0)]),
+                numpy.abs(longitudes - xs[numpy.minimum(index,
+                                                        len(xs) - 1)]))
+            uncertain[row] = distance <= eps
+
+        rows, columns = numpy.nonzero(uncertain)
+        covered[rows, columns] = self.covers_all(
+            longitudes[columns], latitudes[rows])
+
+        return covered
+
+    def _prepare(self):
+        """Prepare the polygon for the point tests, unless it coincides
+        with its bounding box (so that the bounding box test is exact).
+
+        :returns: True if the polygon is a rectangle
+        """
+        if self._rectangle is None:
+            self._rectangle = self.polygon.equals(self.polygon.envelope)
+
+            if not self._rectangle:
+                self._prepared = prep(self.polygon)
+
+        return self._rectangle
+
+    def __getstate__(self):
+        # prepared geometries can't be pickled, they are rebuilt on demand
+        state = self.__dict__.copy()
+        state["_rectangle"] = None
+        state["_prepared"] = None
+        return state
+
     @property
     def lower_left_corner(self):
         """
@@ -173,18 +300,36 @@ class RegionConstraint(Region):
     """Extends a basic region to work as a constraint on parsers"""
 
     def match(self, point):
-        """Point (specified by Point class or tuple) is contained?"""
+        """Point (specified by Site, Point class or tuple) is contained?"""
         if isinstance(point, Site):
             point = point.point
-        if not isinstance(point, geometry.Point):
-            point = geometry.Point(point[0], point[1])
-        test = self.polygon.contains(point) or self.polygon.touches(point)
-        return test
+        if isinstance(point, geometry.Point):
+            return self.covers(point.x, point.y)
+        return self.covers(point[0], point[1])
+
+    def filter_sites(self, items, key=None):
+        """Return the items whose site lies within the region, in order.
+
+        All the sites are tested at once, see :py:meth:`Region.covers_all`.
+
+        :param items: a sequence of :py:class:`Site` objects, or of any
+            other objects when `key` is given
+        :param key: a function returning the :py:class:`Site` of an item
+        """
+        items = list(items)
+        sites = [key(item) for item in items] if key else items
+
+        mask = self.covers_all([site.longitude for site in sites],
+                               [site.latitude for site in sites])
+
+        return [item for item, inside in izip(items, mask) if inside]
 
 
 class GridPoint(object):
     """Simple (trivial) point class"""
 
+    __slots__ = ("grid", "column", "row")
+
     def __init__(self, grid, column, row):
         self.column = column
         self.row = row
@@ -215,10 +360,23 @@ class GridPoint(object):
         #, int(self.grid.cell_size)
         return self.column * 1000000000 + self.row
 
+    def __ne__(self, other):
+        return not self == other
+
+    def __reduce__(self):
+        return (GridPoint, (self.grid, self.column, self.row))
+
     def __str__(self):
         return self.__repr__()
 
 
+def _round_half_away(values):
+    """Round half away from zero, like the `round` built-in, returning
+    an integer numpy array."""
+    return (numpy.sign(values)
+            * numpy.floor(numpy.abs(values) + 0.5)).astype(int)
+
+
 class BoundsException(Exception):
     """Point is outside of region"""
     pass
@@ -231,6 +389,7 @@ class Grid(object):
     def __init__(self, region, cell_size):
         self.region = region
         self.cell_size = cell_size
+        self._raster = None
         self.lower_left_corner = self.region.lower_left_corner
         self.columns = self._longitude_to_column(
                     self.region.upper_right_corner.longitude) + 1
@@ -245,24 +404,24 @@ class Grid(object):
             check = self.check_point(site.point)
         except BoundsException:
             LOGGER.debug("Site %s %s isn't on region" %
-                (site.point.site.longitude, site.point.site.latitude))
+                (site.longitude, site.latitude))
 
         return check
 
     def check_point(self, point):
         """ Confirm that the point is within the polygon
         underlying the gridded region"""
-        if (self.region.polygon.contains(point)):
-            return True
-        if self.region.polygon.touches(point):
+        if self.region.covers(point.x, point.y):
             return True
         raise BoundsException("Point is not on the Grid")
 
     def check_gridpoint(self, gridpoint):
         """Confirm that the point is contained by the region"""
-        point = Point(round_float(self._column_to_longitude(gridpoint.column)),
-                      round_float(self._row_to_latitude(gridpoint.row)))
-        return self.check_point(point)
+        if self.region.covers(
+                round_float(self._column_to_longitude(gridpoint.column)),
+                round_float(self._row_to_latitude(gridpoint.row))):
+            return True
+        raise BoundsException("Point is not on the Grid")
 
     def _latitude_to_row(self, latitude):
         """Calculate row from latitude value"""
@@ -289,23 +448,89 @@ class Grid(object):
         column = self._longitude_to_column(site.longitude)
         return GridPoint(self, column, row)
 
+    def cells_at(self, longitudes, latitudes):
+        """Translate many locations at once into matrix coordinates.
+
+        The rounding is the same as in :meth:`point_at`, but the locations
+        are not checked against the region.
+
+        :param longitudes: the longitudes of the locations
+        :param latitudes: the latitudes of the locations
+        :returns: a tuple (rows, columns) of integer numpy arrays
+        """
+        rows = _round_half_away(
+            numpy.abs(numpy.asarray(latitudes, dtype=float)
+                      - self.lower_left_corner.latitude) / self.cell_size)
+        columns = _round_half_away(
+            (numpy.asarray(longitudes, dtype=float)
+             - self.lower_left_corner.longitude) / self.cell_size)
+
+        return rows, columns
+
+    def on_grid(self, longitudes, latitudes):
+        """Tell which of the given locations fall in a cell of the grid.
+
+        :meth:`cells_at` does not check the locations: the ones below
+        the lower left corner of the region would be mirrored on the grid,
+        the others would be out of its bounds.
+
+        :param longitudes: the longitudes of the locations
+        :param latitudes: the latitudes of the locations
+        :returns: a boolean numpy array, True for the locations in the grid
+        """
+        rows = _round_half_away(
+            (numpy.asarray(latitudes, dtype=float)
+             - self.lower_left_corner.latitude) / self.cell_size)
+        columns = _round_half_away(
+            (numpy.asarray(longitudes, dtype=float)
+             - self.lower_left_corner.longitude) / self.cell_size)
+
+        return ((rows >= 0) & (rows < self.rows)
+                & (columns >= 0) & (columns < self.columns))
+
     def site_at(self, gridpoint):
         """Construct a site at the given grid point"""
         return Site(self._column_to_longitude(gridpoint.column),
                              self._row_to_latitude(gridpoint.row))
 
+    def rasterize(self):
+        """Compute at once all the grid points lying within the region.
+
+        The result is cached, the region is not supposed to change.
+
+        :returns: a tuple (rows, columns, longitudes, latitudes) of numpy
+            arrays, one entry per grid point in row major order
+        """
+        if self._raster is None:
+            longitudes = numpy.array(
+                [round_float(self._column_to_longitude(col))
+                 for col in range(self.columns)])
+            latitudes = numpy.array(
+                [round_float(self._row_to_latitude(row))
+                 for row in range(self.rows)])
+
+            rows, columns = numpy.nonzero(
+                self.region.covers_grid(longitudes, latitudes))
+
+            self._raster = (rows, columns,
+                            longitudes[columns], latitudes[rows])
+
+        return self._raster
+
+    def site_collection(self):
+        """The sites of the grid points lying within the region, as a
+        :py:class:`SiteCollection` (with the grid rows and columns),
+        in the same order as :py:meth:`__iter__`."""
+        rows, columns, longitudes, latitudes = self.rasterize()
+
+        return SiteCollection(longitudes, latitudes,
+                              rows=rows, columns=columns)
+
     def __iter__(self):
-        for row in range(0, self.rows):
-            for col in range(0, self.columns):
-                try:
-                    point = GridPoint(self, col, row)
-                    self.check_gridpoint(point)
-                    yield point
-                except BoundsException:
-                    LOGGER.debug(
-                            "Point (col %s row %s) at %s %s isn't on grid"
-                            % (col, row, point.site.longitude,
-                                point.site.latitude))
+        rows, columns, _, _ = self.rasterize()
+
+        for row, col in izip(rows.tolist(), columns.tolist()):
+            yield GridPoint(self, col, row)
 
 
 def c_mul(val_a, val_b):
@@ -315,28 +540,31 @@ def c_mul(val_a, val_b):
 
 
 class Site(object):
-    """Site is a dictionary-keyable point"""
+    """Site is a dictionary-keyable point
+
+    Only the two (rounded) coordinates are stored, the shapely point is
+    built on demand.
+    """
+
+    __slots__ = ("longitude", "latitude", "_point")
 
     def __init__(self, longitude, latitude):
-        longitude = round_float(longitude)
-        latitude = round_float(latitude)
-        self.point = geometry.Point(longitude, latitude)
+        self.longitude = round_float(longitude)
+        self.latitude = round_float(latitude)
+        self._point = None
+
+    @property
+    def point(self):
+        """The shapely point at this site"""
+        if self._point is None:
+            self._point = geometry.Point(self.longitude, self.latitude)
+        return self._point
 
     @property
     def coords(self):
         """Return a tuple with the coordinates of this point"""
         return (self.longitude, self.latitude)
 
-    @property
-    def longitude(self):
-        """Point x value is longitude"""
-        return self.point.x
-
-    @property
-    def latitude(self):
-        """Point y value is latitude"""
-        return self.point.y
-
     def __eq__(self, other):
         """
         Compare lat and lon values to determine equality.
@@ -355,8 +583,14 @@ class Site(object):
         return self == other
 
     def __hash__(self):
-        return hash(
-            hashlib.md5(repr((self.longitude, self.latitude))).hexdigest())
+        # the coordinates have (at most) 7 decimal digits: as fixed point
+        # integers they pack without collisions into a single integer,
+        # whose hash is stable across processes (it is used in KVS keys)
+        return hash(int(round(self.longitude * 1e7)) * (1 << 32)
+                    + int(round(self.latitude * 1e7)))
+
+    def __reduce__(self):
+        return (Site, (self.longitude, self.latitude))
 
     def to_java(self):
         """Converts to a Java Site object"""
@@ -376,6 +610,83 @@ class Site(object):
         return self.__repr__()
 
 
+class SiteCollection(object):
+    """An ordered collection of sites, stored as numpy arrays of
+    coordinates rather than as a list of :py:class:`Site` objects.
+
+    It behaves like a (read only) list of sites: it can be iterated,
+    indexed and sliced, the slices being site collections themselves.
+    Besides the coordinates it can hold the grid position and the site
+    parameters of each site.
+    """
+
+    # the optional per-site arrays
+    FIELDS = ("columns", "rows", "vs30", "depth_to_2pt5", "depth_to_1pt0")
+
+    def __init__(self, longitudes, latitudes, **arrays):
+        """
+        :param longitudes: the (rounded, see :py:class:`Site`) longitudes
+        :param latitudes: the (rounded) latitudes
+        :param arrays: the optional per-site arrays listed in
+            :py:attr:`FIELDS`, same length as the coordinates
+        """
+        self.longitudes = numpy.asarray(longitudes, dtype=float)
+        self.latitudes = numpy.asarray(latitudes, dtype=float)
+
+        assert len(self.longitudes) == len(self.latitudes)
+
+        for field in self.FIELDS:
+            values = arrays.pop(field, None)
+
+            if values is not None:
+                values = numpy.asarray(values)
+                assert len(values) == len(self.longitudes)
+
+            setattr(self, field, values)
+
+        if arrays:
+            raise TypeError("unknown site arrays %s" % ", ".join(arrays))
+
+    @classmethod
+    def from_sites(cls, sites):
+        """Build a collection out of an iterable of :py:class:`Site`."""
+        sites = list(sites)
+        return cls([site.longitude for site in sites],
+                   [site.latitude for site in sites])
+
+    def __len__(self):
+        return len(self.longitudes)
+
+    def __iter__(self):
+        for lon, lat in izip(self.longitudes.tolist(),
+                             self.latitudes.tolist()):
+            yield Site(lon, lat)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            arrays = dict((field, getattr(self, field)[index])
+                          for field in self.FIELDS
+                          if getattr(self, field) is not None)
+            return SiteCollection(self.longitudes[index],
+                                  self.latitudes[index], **arrays)
+
+        return Site(float(self.longitudes[index]),
+                    float(self.latitudes[index]))
+
+    def __eq__(self, other):
+        if isinstance(other, SiteCollection):
+            return (numpy.array_equal(self.longitudes, other.longitudes)
+                    and numpy.array_equal(self.latitudes, other.latitudes))
+
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "<SiteCollection of %s sites>" % len(self)
+
+
 class Field(object):
     """Uses a 2 dimensional numpy array to store a field of values."""
 
@@ -498,7 +809,12 @@ def range_clip(val, val_range):
 
 class Curve(object):
     """This class defines a curve (discrete function)
-    used in the risk domain."""
+    used in the risk domain.
+
+    Curves are immutable: the abscissae and ordinates are read only numpy
+    arrays, so that the range checks and the inverted curve used by the
+    interpolation can be computed once and cached.
+    """
 
     @classmethod
     def from_json(cls, json_str):
@@ -522,6 +838,32 @@ class Curve(object):
 
         return cls(data)
 
+    @classmethod
+    def from_arrays(cls, abscissae, ordinates):
+        """Construct a curve from the sequences of its x and y values.
+
+        The values are sorted on the x axis, unless they already are.
+        """
+        abscissae = numpy.array(abscissae, dtype=float)
+        ordinates = numpy.array(ordinates, dtype=float)
+
+        assert len(abscissae) == len(ordinates), \
+            "a curve needs one ordinate for each abscissa"
+
+        if len(abscissae) > 1 and (numpy.diff(abscissae) < 0).any():
+            order = abscissae.argsort(kind="mergesort")
+            abscissae = abscissae[order]
+            ordinates = ordinates[order]
+
+        return cls._from_sorted(abscissae, ordinates)
+
+    @classmethod
+    def _from_sorted(cls, abscissae, ordinates):
+        """Wrap arrays already sorted on the x axis, without copying."""
+        curve = cls.__new__(cls)
+        curve._set_values(abscissae, ordinates)
+        return curve
+
     def __init__(self, values):
         """Construct a curve from a sequence of tuples.
 
@@ -536,20 +878,37 @@ class Curve(object):
 
         Curve([(0.1, [1.0, 0.5]), (0.2, [2.0, 0.5])])
         """
+        values = list(values)
+
+        if not values:
+            self._set_values(empty(0), empty(0))
+            return
+
+        abscissae = numpy.array([value[0] for value in values], dtype=float)
 
-        # sort the values on x axis
-        values = sorted(values, key=lambda data: data[0])
+        # sort the values on x axis (a stable sort, like sorted())
+        order = abscissae.argsort(kind="mergesort")
 
-        elements = len(values)
-        self.x_values = empty(elements)
-        self.y_values = empty(elements)
+        self._set_values(
+            abscissae[order],
+            numpy.array([value[1] for value in values], dtype=float)[order])
 
-        if elements and type(values[0][1]) in (tuple, list):
-            self.y_values = empty((elements, len(values[0][1])))
+    def _set_values(self, abscissae, ordinates):
+        """Store the values of this curve as read only arrays."""
+        abscissae.setflags(write=False)
+        ordinates.setflags(write=False)
 
-        for index, (key, val) in enumerate(values):
-            self.x_values[index] = key
-            self.y_values[index] = val
+        self.x_values = abscissae
+        self.y_values = ordinates
+        self._range_checked = False
+        self._inverse_interpolation = None
+
+    def __getstate__(self):
+        # the interpolation checks and data are rebuilt on demand
+        return (self.x_values, self.y_values)
+
+    def __setstate__(self, state):
+        self._set_values(*state)
 
     def __eq__(self, other):
         return allclose(self.x_values, other.x_values) \
@@ -563,11 +922,8 @@ class Curve(object):
         """Return a new curve with each abscissa value multiplied
         by the value passed as parameter."""
 
-        result = Curve(())
-        result.x_values = self.x_values * value
-        result.y_values = self.y_values
-
-        return result
+        # the ordinates are shared, curves are immutable
+        return Curve._from_sorted(self.x_values * value, self.y_values)
 
     @property
     def abscissae(self):
@@ -591,38 +947,52 @@ class Curve(object):
         false otherwise."""
         return self.y_values.ndim > 1
 
+    def _first_ordinates(self):
+        """The first ordinate of each point of the curve."""
+        if self.is_multi_value:
+            return self.y_values[:, 0]
+        return self.y_values
+
     def ordinate_for(self, x_value, y_index=0):
         """
             Return the y value corresponding to the given x value.
-            interp1d parameters can be a list of x_values, y_values
-            this is very useful to speed up the computation and feed
-            "directly" numpy
-        """
+            x_value can be a list of x values, this is very useful
+            to speed up the computation and feed "directly" numpy.
 
-        x_value = range_clip(x_value, self.x_values)
+            x values outside the curve are clipped to its range.
+        """
+        if not self._range_checked:
+            _check_interpolation_range(self.x_values)
+            self._range_checked = True
 
         y_values = self.y_values
 
-        if self.y_values.ndim > 1:
+        if self.is_multi_value:
             y_values = self.y_values[:, y_index]
 
-        return interp1d(self.x_values, y_values)(x_value)
+        return numpy.interp(x_value, self.x_values, y_values)
 
     def abscissa_for(self, y_value):
         """Return the x value corresponding to the given y value."""
 
-        # inverting the function
-        inverted_func = [(ordinate, x_value) for ordinate, x_value in
-                zip(self.ordinate_for(self.abscissae), self.abscissae)]
+        if self._inverse_interpolation is None:
+            _check_interpolation_range(self.x_values)
+
+            # inverting the function
+            ordinates = self._first_ordinates()
+            order = ordinates.argsort(kind="mergesort")
+            _check_interpolation_range(ordinates[order])
+
+            self._inverse_interpolation = (
+                ordinates[order], self.x_values[order])
 
-        return Curve(inverted_func).ordinate_for(y_value)
+        return numpy.interp(y_value, *self._inverse_interpolation)
 
     def ordinate_out_of_bounds(self, y_value):
         """Check if the given value is outside the Y values boundaries."""
-        ordinates = list(self.ordinates)
-        ordinates.sort()
+        ordinates = self.y_values.ravel()
 
-        return y_value < ordinates[0] or y_value > ordinates[-1]
+        return y_value < ordinates.min() or y_value > ordinates.max()
 
     def to_json(self):
         """Serialize this curve in json format."""
@@ -636,6 +1006,108 @@ class Curve(object):
 
         return json.JSONEncoder().encode(as_dict)
 
+    def to_binary(self):
+        """Serialize this curve as a compact binary string, keeping the
+        full precision of the values (unlike :py:meth:`to_json`)."""
+        return cPickle.dumps(self, cPickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def from_binary(data):
+        """Construct a curve serialized with :py:meth:`to_binary`."""
+        return cPickle.loads(data)
+
+
+def _read_only_array(values):
+    """A read only float numpy array with a copy of the given values."""
+    values = numpy.array(values, dtype=float)
+    values.setflags(write=False)
+    return values
+
+
+def _check_interpolation_range(values):
+    """Check that the given (sorted) values can be used to interpolate,
+    see :py:func:`range_clip`."""
+    assert len(values) >= 2, "val_range must contain at least 2 elements"
+    assert (numpy.diff(values) > 0).all(), \
+        "val_range must be arranged in ascending order with no duplicates"
+
+
+class CurveSet(object):
+    """Many curves sharing the same abscissae, stored as a single
+    (curves, abscissae) matrix of ordinates.
+
+    Indexing and iterating give :py:class:`Curve` objects.
+    """
+
+    def __init__(self, abscissae, ordinates):
+        """
+        :param abscissae: the x values shared by all the curves
+        :param ordinates: the y values, one row per curve
+        :type ordinates: 2-dimensional array-like
+        """
+        self.abscissae = numpy.array(abscissae, dtype=float)
+        self.ordinates = numpy.array(ordinates, dtype=float, ndmin=2)
+
+        assert self.ordinates.shape[1] == len(self.abscissae)
+
+        # sorted on the x axis, unless they already are, like
+        # Curve.from_arrays
+        if len(self.abscissae) > 1 and (numpy.diff(self.abscissae) < 0).any():
+            order = self.abscissae.argsort(kind="mergesort")
+            self.abscissae = self.abscissae[order]
+            self.ordinates = self.ordinates[:, order]
+
+        self.abscissae.setflags(write=False)
+        self.ordinates.setflags(write=False)
+
+    @classmethod
+    def from_curves(cls, curves):
+        """Stack single valued curves defined on the same abscissae."""
+        curves = list(curves)
+        abscissae = curves[0].abscissae
+
+        assert all(numpy.array_equal(abscissae, curve.abscissae)
+                   for curve in curves)
+
+        return cls(abscissae, [curve.ordinates for curve in curves])
+
+    def __len__(self):
+        return len(self.ordinates)
+
+    def __getitem__(self, index):
+        return Curve._from_sorted(self.abscissae, self.ordinates[index])
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self[index]
+
+    def ordinates_for(self, x_values):
+        """Interpolate all the curves at once.
+
+        x values outside the curves are clipped to their range.
+
+        :param x_values: the x value(s) to interpolate
+        :returns: the interpolated values, one row per curve
+        """
+        _check_interpolation_range(self.abscissae)
+
+        x_values = numpy.clip(numpy.asarray(x_values, dtype=float),
+                              self.abscissae[0], self.abscissae[-1])
+
+        upper = numpy.clip(numpy.searchsorted(self.abscissae, x_values),
+                           1, len(self.abscissae) - 1)
+        lower = upper - 1
+
+        weights = (x_values - self.abscissae[lower]) / (
+            self.abscissae[upper] - self.abscissae[lower])
+
+        return self.ordinates[:, lower] + weights * (
+            self.ordinates[:, upper] - self.ordinates[:, lower])
+
+    def rescale_abscissae(self, value):
+        """Return a new set with each abscissa multiplied by `value`."""
+        return CurveSet(self.abscissae * value, self.ordinates)
+
 
 class VulnerabilityFunction(object):
     """
@@ -657,16 +1129,19 @@ class VulnerabilityFunction(object):
         :param covs: Coefficients of Variation. All values must be >= 0.0.
         :type covs: list of floats, equal in length to imls
         """
-        self._imls = imls
-        self._loss_ratios = loss_ratios
-        self._covs = covs
+        self._imls = _read_only_array(imls)
+        self._loss_ratios = _read_only_array(loss_ratios)
+        self._covs = _read_only_array(covs)
 
         # Check for proper IML ordering:
-        assert self._imls == sorted(set(self._imls)), \
+        assert (numpy.diff(self._imls) > 0.0).all(), \
             "IML values must be in ascending order with no duplicates."
 
+        # empty functions are allowed, but can not be interpolated
+        self._interpolable = len(self._imls) >= 2
+
         # Check for proper IML values (> 0.0).
-        assert all(x >= 0.0 for x in self._imls), \
+        assert (self._imls >= 0.0).all(), \
             "IML values must be >= 0.0."
 
         # Check CoV and loss ratio list lengths:
@@ -676,13 +1151,33 @@ class VulnerabilityFunction(object):
             "Loss ratio list should be the same length as the IML list."
 
         # Check for proper CoV values (>= 0.0):
-        assert all(x >= 0.0 for x in self._covs), \
+        assert (self._covs >= 0.0).all(), \
             "CoV values must be >= 0.0."
 
         # Check for proper loss ratio values (0.0 <= value <= 1.0):
-        assert all(x >= 0.0 and x <= 1.0 for x in self._loss_ratios), \
+        assert ((self._loss_ratios >= 0.0)
+                & (self._loss_ratios <= 1.0)).all(), \
             "Loss ratio values must be in the interval [0.0, 1.0]."
 
+        self._stddevs = _read_only_array(self._covs * self._loss_ratios)
+
+        # parameters of the log-normal distribution of the loss ratios at
+        # each IML (undefined where the mean loss ratio is zero)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            variances = self._stddevs ** 2.0
+            self._sigmas = _read_only_array(numpy.sqrt(numpy.log(
+                (variances / self._loss_ratios ** 2.0) + 1.0)))
+            self._mus = _read_only_array(numpy.log(
+                self._loss_ratios ** 2.0 /
+                numpy.sqrt(variances + self._loss_ratios ** 2.0)))
+
+    def __getstate__(self):
+        # the derived arrays are rebuilt when unpickling
+        return (self._imls, self._loss_ratios, self._covs)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
     def __eq__(self, other):
         """
         Compares IML, loss ratio, and CoV values to determine equality.
@@ -696,23 +1191,23 @@ class VulnerabilityFunction(object):
     @property
     def imls(self):
         """
-        IML values as a numpy.array.
+        IML values as a (read only) numpy.array.
         """
-        return numpy.array(self._imls)
+        return self._imls
 
     @property
     def loss_ratios(self):
         """
-        Loss ratios as a numpy.array.
+        Loss ratios as a (read only) numpy.array.
         """
-        return numpy.array(self._loss_ratios)
+        return self._loss_ratios
 
     @property
     def covs(self):
         """
-        Coeffecicients of Variation as a numpy.array.
+        Coeffecicients of Variation as a (read only) numpy.array.
         """
-        return numpy.array(self._covs)
+        return self._covs
 
     @property
     def is_empty(self):
@@ -724,11 +1219,26 @@ class VulnerabilityFunction(object):
     @property
     def stddevs(self):
         """
-            Convenience method: returns a list of calculated
-            Standard Deviations
+            Convenience method: returns the Standard Deviations
+            as a (read only) numpy.array
+        """
+        return self._stddevs
+
+    @property
+    def sigmas(self):
+        """
+        The sigma of the log-normal distribution of the loss ratios
+        at each IML, as a (read only) numpy.array.
+        """
+        return self._sigmas
+
+    @property
+    def mus(self):
+        """
+        The mu of the log-normal distribution of the loss ratios
+        at each IML, as a (read only) numpy.array.
         """
-        return [cov * loss_ratio for cov, loss_ratio in izip(self.covs,
-            self.loss_ratios)]
+        return self._mus
 
     def loss_ratio_for(self, iml):
         """
@@ -745,9 +1255,9 @@ class VulnerabilityFunction(object):
         :returns: :py:class:`numpy.ndarray` containing a number of interpolated
             values equal to the size of the input (1 or many)
         """
-        iml = range_clip(iml, self.imls)
+        assert self._interpolable, "val_range must contain at least 2 elements"
 
-        return interp1d(self.imls, self.loss_ratios)(iml)
+        return numpy.interp(iml, self.imls, self.loss_ratios)
 
     def cov_for(self, iml):
         """
@@ -764,9 +1274,43 @@ class VulnerabilityFunction(object):
         :returns: :py:class:`numpy.ndarray` containing a number of interpolated
             values equal to the size of the input (1 or many)
         """
-        iml = range_clip(iml, self.imls)
+        assert self._interpolable, "val_range must contain at least 2 elements"
+
+        return numpy.interp(iml, self.imls, self.covs)
+
+    def sample_loss_ratios(self, imls, epsilons, means=None):
+        """
+        Sample the loss ratios for the given IMLs from the log-normal
+        distributions defined by the interpolated mean loss ratios and
+        coefficients of variation, using one epsilon per IML.
+
+        Loss ratios are zero where the mean loss ratio is not positive.
+
+        :param imls: IML values
+        :type imls: list of floats, or :py:class:`numpy.ndarray` of floats
+        :param epsilons: one epsilon (standard normal sample) per IML
+        :param means: the mean loss ratios of the IMLs, when already
+            interpolated by the caller
+        :returns: :py:class:`numpy.ndarray` of loss ratios
+        """
+        imls = numpy.asarray(imls, dtype=float)
+
+        if means is None:
+            means = self.loss_ratio_for(imls)
+
+        covs = self.cov_for(imls)
+        epsilons = numpy.asarray(epsilons, dtype=float)
+
+        loss_ratios = zeros(means.size)
+        positive = means > 0.0
+
+        # variance / mean_ratio ** 2 == cov ** 2
+        sigmas = sqrt(numpy.log(covs[positive] ** 2.0 + 1.0))
+        mus = numpy.log(means[positive] / sqrt(covs[positive] ** 2.0 + 1.0))
+
+        loss_ratios[positive] = numpy.exp(mus + epsilons[positive] * sigmas)
 
-        return interp1d(self.imls, self.covs)(iml)
+        return loss_ratios
 
     def __iter__(self):
         """Iterate on the values of this function, returning triples
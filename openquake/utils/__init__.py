@@ -22,6 +22,15 @@ def round_float(value):
     places
     """
     float_decimal_places = 7
+
+    # already rounded values (the vast majority of the coordinates read
+    # from the input files) are returned as they are, the decimal
+    # arithmetic below is much slower
+    if (isinstance(value, float) and abs(value) < 1e4
+            and round(value, float_decimal_places) == value):
+        # numpy.float64 is a float subclass
+        return float(value)
+
     quantize_str = '0.' + '0' * float_decimal_places
 
     return float(
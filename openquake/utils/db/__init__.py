@@ -22,3 +22,70 @@
 This module contains constants and some basic utilities and scaffolding to
 assist with database interactions.
 """
+
+import uuid
+
+from django.db import connections
+
+
+# number of rows fetched at a time by stream_values_list
+DEFAULT_FETCH_SIZE = 1000
+
+
+def point_coordinates(model, field="location"):
+    """
+    The SQL expressions of the longitude and latitude of a point field, to
+    be passed to `QuerySet.extra(select=...)`: reading the raw coordinates
+    is much cheaper than building a GEOS geometry per row.
+
+    :param model: a Django model class
+    :param str field: the name of the point field of the model
+    :returns: a dictionary with the `lon` and `lat` expressions
+    """
+    # pylint: disable=W0212
+    column = '"%s"."%s"' % (model._meta.db_table,
+                            model._meta.get_field(field).column)
+
+    return {"lon": "ST_X(%s)" % column, "lat": "ST_Y(%s)" % column}
+
+
+def stream_values_list(queryset, size=DEFAULT_FETCH_SIZE):
+    """
+    Read the rows of a `values_list` query set in batches through a
+    server-side cursor, so that the memory used does not depend on the
+    number of rows.
+
+    :param queryset: a query set built with `QuerySet.values_list`
+    :param int size: the number of rows fetched at a time
+    :returns: a generator of lists of tuples, with the values in the order
+        of the fields given to `values_list`
+    """
+    query = queryset.query
+
+    # the extra select columns come first in the SQL, see
+    # `django.db.models.query.ValuesListQuerySet.iterator`
+    names = (query.extra_select.keys() + queryset.field_names
+             + query.aggregate_select.keys())
+    # pylint: disable=W0212
+    order = [names.index(name) for name in queryset._fields or names]
+
+    sql, params = query.get_compiler(queryset.db).as_sql()
+
+    connection = connections[queryset.db]
+    # make sure the connection is open, psycopg2 named cursors are
+    # server-side cursors
+    connection.cursor()
+    cursor = connection.connection.cursor(name="oq_%s" % uuid.uuid4().hex)
+
+    try:
+        cursor.execute(sql, params)
+
+        while True:
+            rows = cursor.fetchmany(size)
+
+            if not rows:
+                break
+
+            yield [tuple(row[i] for i in order) for row in rows]
+    finally:
+        cursor.close()
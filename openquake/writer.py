@@ -21,6 +21,11 @@ Base classes for the output methods of the various codecs.
 """
 
 import logging
+import Queue
+import sys
+import threading
+from cStringIO import StringIO
+from itertools import izip
 from os.path import basename
 
 from django.db import transaction
@@ -32,6 +37,13 @@ from openquake.db import models
 
 LOGGER = logging.getLogger('serializer')
 
+# number of entries inserted at a time by BulkInserter
+DEFAULT_CHUNK_SIZE = 10000
+
+# number of threads used by ResultSink and of batches queued per thread
+DEFAULT_SINK_WORKERS = 4
+DEFAULT_SINK_QUEUE_SIZE = 8
+
 
 class FileWriter(object):
     """Simple output half of the codec process."""
@@ -209,17 +221,193 @@ def compose_writers(writers):
         return CompositeWriter(*writers)
 
 
+class ResultSink(object):
+    """
+    Serialize results in background threads, off the critical path of the
+    calculators.
+
+    Each output artifact (e.g. a NRML file) is assigned to one of a fixed
+    number of worker threads, so that the batches submitted for an artifact
+    are serialized in order. The workers are fed by bounded queues: a
+    calculator producing results faster than they can be written is held
+    back instead of piling them up in memory.
+
+    The first error raised by a writer is raised again in the calculator by
+    the next call to :meth:`submit`, :meth:`flush` or :meth:`close`; the
+    following batches of the artifact that failed are discarded.
+    """
+
+    def __init__(self, workers=DEFAULT_SINK_WORKERS,
+                 queue_size=DEFAULT_SINK_QUEUE_SIZE):
+        """
+        :param int workers: the number of worker threads
+        :param int queue_size: the number of batches per worker waiting
+            to be serialized before :meth:`submit` blocks
+        """
+        assert workers > 0, "at least a worker is needed"
+
+        self.workers = workers
+        self.queue_size = queue_size
+        self._queues = []
+        self._threads = []
+        self._failed = set()
+        self._errors = []
+
+    def submit(self, artifact, writer, items, prepare=None):
+        """
+        Queue a batch of items to be serialized.
+
+        :param artifact: the output written (e.g. its path); the batches of
+            the same artifact are serialized in order
+        :param writer: the writer of the batch, nothing is done if None
+        :param items: the items passed to the `serialize` method of the
+            writer
+        :param prepare: a function called, in the worker thread, before
+            the items are serialized (e.g. to set the XML serialization
+            context)
+        """
+        self.check()
+
+        if writer is None:
+            return
+
+        if not self._queues:
+            self._start()
+
+        queue = self._queues[hash(artifact) % self.workers]
+        queue.put((artifact, writer, items, prepare))
+
+    def flush(self):
+        """Wait until all the batches submitted so far are serialized."""
+        for queue in self._queues:
+            queue.join()
+
+        self.check()
+
+    def close(self):
+        """Serialize all the batches submitted and stop the workers."""
+        for queue in self._queues:
+            queue.put(None)
+
+        for thread in self._threads:
+            thread.join()
+
+        del self._queues[:]
+        del self._threads[:]
+        self._failed.clear()
+
+        self.check()
+
+    def check(self):
+        """Raise the first error raised by a writer, if any."""
+        if self._errors:
+            artifact, (exc_type, exc_value, exc_tb) = self._errors[0]
+            del self._errors[:]
+
+            LOGGER.error("failed to serialize %s", artifact)
+            raise exc_type, exc_value, exc_tb
+
+    def _start(self):
+        """Start the worker threads."""
+        for i in xrange(self.workers):
+            queue = Queue.Queue(self.queue_size)
+
+            thread = threading.Thread(target=self._serialize, args=(queue,),
+                                      name="result-sink-%s" % i)
+            thread.daemon = True
+            thread.start()
+
+            self._queues.append(queue)
+            self._threads.append(thread)
+
+    def _serialize(self, queue):
+        """Serialize the queued batches until the queue is closed."""
+        try:
+            while True:
+                batch = queue.get()
+
+                try:
+                    if batch is None:
+                        return
+
+                    artifact, writer, items, prepare = batch
+
+                    if artifact in self._failed:
+                        continue
+
+                    if prepare is not None:
+                        prepare()
+
+                    writer.serialize(items)
+                # pylint: disable=W0703
+                except Exception:
+                    self._failed.add(artifact)
+                    self._errors.append((artifact, sys.exc_info()))
+                finally:
+                    queue.task_done()
+        finally:
+            # each thread has its own database connections; only the
+            # databases already used by the process are looked at
+            # pylint: disable=W0212
+            for connection in connections._connections.values():
+                connection.close()
+
+
+def copy_value(value):
+    """Format a value for the text format of the COPY protocol.
+
+    Lists and tuples are formatted as (one dimensional) arrays."""
+    if value is None:
+        return "\\N"
+
+    if isinstance(value, float):
+        # repr() keeps all the significant digits, str() does not
+        return repr(value)
+
+    if isinstance(value, (list, tuple)):
+        value = "{%s}" % ",".join(_array_item(item) for item in value)
+
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+
+    return str(value).replace("\\", "\\\\").replace(
+        "\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def _array_item(item):
+    """Format an element of an array literal."""
+    if item is None:
+        return "NULL"
+
+    if isinstance(item, float):
+        return repr(item)
+
+    if isinstance(item, (int, long)):
+        return str(item)
+
+    if isinstance(item, unicode):
+        item = item.encode("utf-8")
+
+    return '"%s"' % str(item).replace("\\", "\\\\").replace('"', '\\"')
+
+
 class BulkInserter(object):
-    """Handle bulk object insertion"""
+    """Handle bulk object insertion.
 
-    def __init__(self, dj_model):
+    The entries are inserted with the PostgreSQL COPY protocol, at most
+    `chunk_size` entries at a time."""
+
+    def __init__(self, dj_model, chunk_size=DEFAULT_CHUNK_SIZE):
         """
         Create a new bulk inserter for a Django model class
 
         :param dj_model: Django model
         :type dj_model: :class:`django.db.models.Model`
+        :param int chunk_size: the number of entries buffered before
+            being flushed to the database
         """
         self.table = dj_model
+        self.chunk_size = chunk_size
         self.fields = None
         self.values = []
         self.count = 0
@@ -232,7 +420,7 @@ class BulkInserter(object):
         subsequent add_entry() calls must provide the same set of
         keyword arguments.
 
-        Handles PostGIS/GeoDjango types.
+        Handles PostGIS/GeoDjango types: geometries are given as WKT.
         """
         if not self.fields:
             self.fields = kwargs.keys()
@@ -241,31 +429,53 @@ class BulkInserter(object):
             self.values.append(kwargs[k])
         self.count += 1
 
-    def flush(self):
-        """Inserts the entries in the database using a bulk insert query"""
-        if not self.values:
-            return
+        if self.count >= self.chunk_size:
+            self.flush()
 
-        alias = router.db_for_write(self.table)
-        cursor = connections[alias].cursor()
-        value_args = []
+    def copy_data(self):
+        """
+        The entries buffered so far, in the text format of the COPY
+        protocol.
 
+        :returns: a file-like object with one line per entry
+        """
         field_map = dict()
         for f in self.table._meta.fields:  # pylint: disable=W0212
             field_map[f.column] = f
 
+        # the geometries are passed as EWKT
+        formats = []
         for f in self.fields:
             col = field_map[f]
             if isinstance(col, gis_models.GeometryField):
-                value_args.append('GeomFromText(%%s, %d)' % col.srid)
+                formats.append("SRID=%d;%%s" % col.srid)
             else:
-                value_args.append('%s')
+                formats.append("%s")
+
+        width = len(self.fields)
+        rows = StringIO()
+
+        for i in xrange(0, len(self.values), width):
+            rows.write("\t".join(
+                fmt % copy_value(value) for fmt, value in
+                izip(formats, self.values[i:i + width])))
+            rows.write("\n")
+
+        rows.seek(0)
+        return rows
+
+    def flush(self):
+        """Inserts the entries in the database using a single COPY"""
+        if not self.values:
+            return
+
+        alias = router.db_for_write(self.table)
+        cursor = connections[alias].cursor()
 
         # pylint: disable=W0212
-        sql = "INSERT INTO \"%s\" (%s) VALUES " % (
-            self.table._meta.db_table, ", ".join(self.fields)) + \
-            ", ".join(["(" + ", ".join(value_args) + ")"] * self.count)
-        cursor.execute(sql, self.values)
+        cursor.copy_expert("COPY \"%s\" (%s) FROM STDIN" % (
+            self.table._meta.db_table, ", ".join(self.fields)),
+            self.copy_data())
         transaction.set_dirty(using=alias)
 
         self.fields = None
@@ -36,6 +36,7 @@ from logs_unittest import *
 from loss_map_output_unittest import *
 from loss_output_unittest import *
 from output_hazard_unittest import *
+from output_hdf5_unittest import *
 from output_risk_unittest import *
 from output_unittest import *
 from output_writers_unittest import *
@@ -44,6 +44,10 @@ class DummyConnection(object):
         self.sql = sql
         self.values = values
 
+    def copy_expert(self, sql, data):
+        self.sql = sql
+        self.data = data.read()
+
 
 class BulkInserterTestCase(unittest.TestCase):
     """
@@ -109,8 +113,7 @@ class BulkInserterTestCase(unittest.TestCase):
         fields = inserter.fields
         inserter.flush()
 
-        self.assertEquals('INSERT INTO "admin"."oq_user" (%s) VALUES' \
-                              ' (%%s, %%s)' %
+        self.assertEquals('COPY "admin"."oq_user" (%s) FROM STDIN' %
                           (", ".join(fields)), connection.sql)
 
         inserter.add_entry(user_name='user1', full_name='An user')
@@ -118,9 +121,26 @@ class BulkInserterTestCase(unittest.TestCase):
         fields = inserter.fields
         inserter.flush()
 
-        self.assertEquals('INSERT INTO "admin"."oq_user" (%s) VALUES' \
-                              ' (%%s, %%s), (%%s, %%s)' %
+        self.assertEquals('COPY "admin"."oq_user" (%s) FROM STDIN' %
                           (", ".join(fields)), connection.sql)
+        self.assertEquals(2, len(connection.data.splitlines()))
+        self.assertEquals(0, inserter.count)
+
+    @transaction.commit_on_success('admin')
+    def test_flush_in_chunks(self):
+        inserter = BulkInserter(OqUser, chunk_size=2)
+        connection = writer.connections['admin']
+
+        inserter.add_entry(user_name='user1', full_name='An user')
+        self.assertFalse(hasattr(connection, 'data'))
+
+        inserter.add_entry(user_name='user2', full_name='Another user')
+        self.assertEquals(2, len(connection.data.splitlines()))
+        self.assertEquals(0, inserter.count)
+
+        inserter.add_entry(user_name='user3', full_name='A third user')
+        inserter.flush()
+        self.assertEquals(1, len(connection.data.splitlines()))
 
     @transaction.commit_on_success('reslt_writer')
     def test_flush_geometry(self):
@@ -132,9 +152,46 @@ class BulkInserterTestCase(unittest.TestCase):
         inserter.flush()
 
         if fields[0] == 'output_id':
-            values = '%s, GeomFromText(%s, 4326)'
+            values = '1\tSRID=4326;POINT(1 1)\n'
         else:
-            values = 'GeomFromText(%s, 4326), %s'
+            values = 'SRID=4326;POINT(1 1)\t1\n'
+
+        self.assertEquals('COPY "hzrdr"."gmf_data" (%s) FROM STDIN' %
+                          ", ".join(fields), connection.sql)
+        self.assertEquals(values, connection.data)
+
+    def test_copy_data(self):
+        inserter = BulkInserter(GmfData)
+
+        inserter.add_entry(output_id=1, ground_motion=0.1,
+                           location='POINT(1 1)')
+        inserter.add_entry(output_id=2, ground_motion=None,
+                           location='POINT(2 1)')
+
+        rows = [dict(zip(inserter.fields, line.split('\t')))
+                for line in inserter.copy_data().read().splitlines()]
+
+        self.assertEquals(
+            [{'output_id': '1', 'ground_motion': '0.1',
+              'location': 'SRID=4326;POINT(1 1)'},
+             {'output_id': '2', 'ground_motion': '\\N',
+              'location': 'SRID=4326;POINT(2 1)'}], rows)
+
+
+class CopyValueTestCase(unittest.TestCase):
+    """
+    Tests for the formatting of values for the COPY protocol.
+    """
 
-        self.assertEquals('INSERT INTO "hzrdr"."gmf_data" (%s) VALUES (%s)' %
-                          (", ".join(fields), values), connection.sql)
+    def test_copy_value(self):
+        self.assertEqual("\\N", writer.copy_value(None))
+        self.assertEqual("0.1", writer.copy_value(0.1))
+        self.assertEqual("a\\tb\\\\c\\n", writer.copy_value("a\tb\\c\n"))
+        self.assertEqual("\xc3\xa8", writer.copy_value(u"\xe8"))
+
+    def test_copy_array(self):
+        self.assertEqual("{0.1,2,NULL}", writer.copy_value([0.1, 2, None]))
+        self.assertEqual("{}", writer.copy_value(()))
+        # escaped in the array literal, then in the COPY text
+        self.assertEqual('{"a b","c\\\\"d"}',
+                         writer.copy_value(["a b", 'c"d']))
@@ -112,6 +112,7 @@ class UHSCoreTestCase(UHSBaseTestCase):
                 self.assertIsNotNone(ds)
                 self.assertEquals(numpy.float64, ds.dtype)
                 self.assertEquals((n_samples, n_periods), ds.shape)
+                self.assertEquals((1, n_periods), ds.chunks)
 
         # Clean up the test file.
         os.unlink(path)
@@ -147,6 +147,9 @@ class BaseRiskCalculator(unittest.TestCase):
                                              block=0),
                 file_name)
 
+            # The curves are written in the background.
+            calc_proxy.result_sink.close()
+
 
 class BetaDistributionTestCase(unittest.TestCase):
     """ Beta Distribution related testcase """
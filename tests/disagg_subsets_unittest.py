@@ -27,6 +27,7 @@ from tests.utils import helpers
 from openquake.shapes import Site
 
 from openquake.calculators.hazard.disagg import FULL_DISAGG_MATRIX
+from openquake.calculators.hazard.disagg import core as disagg_core
 from openquake.calculators.hazard.disagg import subsets as disagg_subsets
 
 
@@ -145,3 +146,30 @@ class SubsetExtractionTestCase(unittest.TestCase):
         for name, (datafile, shape) in pmfs.items():
             expected_result = self.read_data_file(datafile, shape)
             helpers.assertDeepAlmostEqual(self, expected_result, result[name])
+
+    def test_chunked_full_matrix(self):
+        # The matrices saved by the calculator are chunked by latitude bin,
+        # the subsets must not depend on the layout.
+        matrix_path = disagg_core.save_5d_matrix_to_h5(
+            self.tempdir,
+            self.read_data_file(self.FULL_MATRIX_DATA,
+                                self.FULL_MATRIX_SHAPE))
+        target_path = os.path.join(self.tempdir, 'chunked.hdf5')
+        pmfs = {
+            'MagPMF': ('MagPMF.dat', [self.NMAG - 1]),
+            'LatLonPMF': ('LatLonPMF.dat', [self.NLAT - 1, self.NLON - 1]),
+            FULL_DISAGG_MATRIX: (self.FULL_MATRIX_DATA,
+                                 self.FULL_MATRIX_SHAPE)
+        }
+        disagg_subsets.extract_subsets(
+            113, self.SITE, matrix_path,
+            self.LATITUDE_BIN_LIMITS, self.LONGITUDE_BIN_LIMITS,
+            self.MAGNITUDE_BIN_LIMITS, self.EPSILON_BIN_LIMITS,
+            self.DISTANCE_BIN_LIMITS,
+            target_path,
+            pmfs.keys()
+        )
+        result = h5py.File(target_path, 'r')
+        for name, (datafile, shape) in pmfs.items():
+            expected_result = self.read_data_file(datafile, shape)
+            helpers.assertDeepAlmostEqual(self, expected_result, result[name])
@@ -59,6 +59,12 @@ class DisaggregationFuncsTestCase(unittest.TestCase):
         # the data should be the same as it was written:
         self.assertTrue((data == actual_data).all())
 
+        # one latitude bin per compressed chunk
+        with h5py.File(file_path, 'r') as read_hdf:
+            dataset = read_hdf[FULL_DISAGG_MATRIX]
+            self.assertEqual((1, 2, 2, 2, 2), dataset.chunks)
+            self.assertEqual("gzip", dataset.compression)
+
         # For clean up, delete the hdf5 we generated.
         os.unlink(file_path)
 
@@ -20,6 +20,7 @@
 import os
 import unittest
 
+from collections import namedtuple
 from lxml import etree
 
 from openquake import shapes
@@ -86,6 +87,89 @@ class HazardCurveXMLWriterTestCase(unittest.TestCase):
         self._initialize_writer(path)
         self.assertRaises(RuntimeError, self.writer.close)
 
+    def test_groups_the_curves_by_branch_label(self):
+        data = [(shapes.Site(-122.5000, 37.5000),
+                {"IDmodel": "MMI_3_1",
+                "investigationTimeSpan": 50.0,
+                "saPeriod": 0.1,
+                "saDamping": 1.0,
+                "endBranchLabel": "3_1",
+                "IMLValues": [5.0, 6.0, 7.0],
+                "IMT": "PGA",
+                "PoEValues": [0.1, 0.2, 0.3]}),
+                (shapes.Site(-122.5000, 37.5000),
+                {"IDmodel": "MMI_3_1",
+                "investigationTimeSpan": 50.0,
+                "saPeriod": 0.1,
+                "saDamping": 1.0,
+                "statistics": "quantile",
+                "quantileValue": 0.5,
+                "IMLValues": [8.0, 9.0],
+                "IMT": "PGA",
+                "PoEValues": [0.4, 0.5]}),
+                (shapes.Site(-122.4000, 37.5000),
+                {"IDmodel": "MMI_3_1",
+                "investigationTimeSpan": 50.0,
+                "saPeriod": 0.1,
+                "saDamping": 1.0,
+                "endBranchLabel": "3_1",
+                "IMLValues": [5.0, 6.0, 7.0],
+                "IMT": "PGA",
+                "PoEValues": [0.6, 0.7, 0.8]})]
+
+        path = helpers.get_output_path(TEST_FILE_STATISTICS)
+        self._initialize_writer(path)
+        self.writer.serialize(data)
+
+        try:
+            batches = list(hazard_parser.NrmlFile(path).batches())
+        finally:
+            self._delete_test_file(path)
+
+        self.assertEqual(2, len(batches))
+
+        meta, sites, poes = batches[0]
+        self.assertEqual("3_1", meta["endBranchLabel"])
+        self.assertEqual(
+            [shapes.Site(-122.5, 37.5), shapes.Site(-122.4, 37.5)], sites)
+        self.assertEqual([[0.1, 0.2, 0.3], [0.6, 0.7, 0.8]], poes.tolist())
+
+        meta, sites, poes = batches[1]
+        self.assertEqual("quantile", meta["statistics"])
+        self.assertEqual(0.5, meta["quantileValue"])
+        self.assertEqual([8.0, 9.0], meta["IMLValues"].tolist())
+        self.assertEqual([[0.4, 0.5]], poes.tolist())
+
+    def test_serializes_batches_in_stages(self):
+        data = [(shapes.Site(-122.5 + i * 0.1, 37.5),
+                {"investigationTimeSpan": 50.0,
+                "endBranchLabel": "3_1",
+                "IMLValues": [5.0, 6.0, 7.0],
+                "IMT": "PGA",
+                "PoEValues": [0.1 * i, 0.2, 0.3]}) for i in xrange(5)]
+
+        path = helpers.get_output_path(TEST_FILE)
+        self._initialize_writer(path)
+        self.writer.serialize(data)
+
+        with open(path) as single_pass:
+            expected = single_pass.read()
+
+        self._initialize_writer(path)
+
+        try:
+            hazard_output.serialize_in_stages(
+                self.writer, [data[:2], data[2:4], data[4:]])
+
+            with open(path) as multi_stage:
+                self.assertEqual(expected, multi_stage.read())
+        finally:
+            self._delete_test_file(path)
+            # back to single pass serialization
+            hazard_output.SerializerContext().update(
+                namedtuple("XSC", "blocks, cblock, i_total, i_done, i_next")(
+                    0, 0, 0, 0, 0))
+
     def test_writes_a_single_result(self):
         data = [(shapes.Site(-122.5000, 37.5000),
                 {"IDmodel": "MMI_3_1",
@@ -21,7 +21,9 @@
 import unittest
 import os
 
+from openquake.db.models import HazardCurveData
 from openquake.shapes import Site
+from openquake.input.exposure import ExposureBulkWriter
 from openquake.input.exposure import ExposureDBWriter
 from openquake.output.hazard import GmfDBWriter
 from openquake.output.hazard import HazardCurveDBWriter
@@ -134,6 +136,28 @@ class HazardCurveDBReadTestCase(unittest.TestCase, helpers.DbTestCase):
         self.assertEquals(list(curve2.ordinates),
                           [0.454, 0.214, 0.123, 0.102])
 
+    def test_read_curves(self):
+        """Verify _get_db_curves reads many sites at once."""
+        the_job = helpers.create_job({}, job_id=self.job.id)
+        calculator = ClassicalRiskCalculator(the_job)
+        sites = [Site(-122.2, 37.5), Site(-122.1, 37.5)]
+
+        curves = calculator._get_db_curves(sites)
+
+        self.assertEquals(set(sites), set(curves.keys()))
+        self.assertEquals(list(curves[sites[0]].ordinates),
+                          [0.354, 0.114, 0.023, 0.002])
+        self.assertEquals(list(curves[sites[1]].ordinates),
+                          [0.454, 0.214, 0.123, 0.102])
+
+    def test_read_curves_without_curve(self):
+        """_get_db_curves fails for a site without a hazard curve."""
+        the_job = helpers.create_job({}, job_id=self.job.id)
+        calculator = ClassicalRiskCalculator(the_job)
+
+        self.assertRaises(HazardCurveData.DoesNotExist,
+                          calculator._get_db_curves, [Site(-121.0, 37.5)])
+
 
 class GmfDBReadTestCase(unittest.TestCase, helpers.DbTestCase):
     """
@@ -244,3 +268,39 @@ class ExposureDBWriterTestCase(unittest.TestCase, helpers.DbTestCase):
         self.assertEquals(500000, assets[2].value)
         self.assertEquals('RC/DMRF-D/LR', assets[2].taxonomy)
         self.assertEquals(Site(9.14777, 45.17999), _to_site(assets[2].site))
+
+
+class ExposureBulkWriterTestCase(unittest.TestCase, helpers.DbTestCase):
+    """
+    Test the code to serialize exposure model to DB with COPY.
+    """
+
+    def setUp(self):
+        self.path = os.path.join(helpers.SCHEMA_EXAMPLES_DIR, TEST_FILE)
+
+    def test_bulk_load(self):
+        writer = ExposureBulkWriter(self.default_user(), chunk_size=2)
+
+        self.assertEqual(3, writer.serialize(ExposurePortfolioFile(self.path)))
+
+        assets = sorted(writer.model.exposuredata_set.all(),
+                        key=lambda e: e.value)
+
+        self.assertEqual(["asset_01", "asset_02", "asset_03"],
+                         [asset.asset_ref for asset in assets])
+        self.assertEqual(Site(9.15333, 45.12200),
+                         Site(assets[1].site.x, assets[1].site.y))
+        self.assertEqual('RC/DMRF-D/HR', assets[1].taxonomy)
+
+    def test_resume_bulk_load(self):
+        writer = ExposureBulkWriter(self.default_user(), chunk_size=2)
+        assets = list(ExposurePortfolioFile(self.path))
+
+        # the load was interrupted after the first chunk
+        self.assertEqual(2, writer.serialize(assets[:2]))
+
+        writer = ExposureBulkWriter(
+            self.default_user(), chunk_size=2, model=writer.model)
+
+        self.assertEqual(1, writer.serialize(assets))
+        self.assertEqual(3, writer.model.exposuredata_set.count())
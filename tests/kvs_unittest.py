@@ -294,6 +294,53 @@ class GarbageCollectionTestCase(unittest.TestCase):
             self.assertRaises(RuntimeError, kvs.cache_gc, self.test_job)
 
 
+class JobArtifactsTestCase(unittest.TestCase):
+    """
+    Tests for the shared job artifacts.
+    """
+
+    def setUp(self):
+        self.client = kvs.get_client()
+        self.client.flushdb()
+
+        self.job_id = 1
+        kvs.mark_job_as_current(self.job_id)
+
+    def tearDown(self):
+        kvs.clear_artifact_cache(self.job_id)
+        self.client.flushdb()
+
+    def test_artifacts_are_content_addressed(self):
+        key = kvs.share_artifact(self.job_id, {"ID": [1.0, 2.0]})
+
+        self.assertEqual(key, kvs.share_artifact(self.job_id,
+                                                 {"ID": [1.0, 2.0]}))
+        self.assertNotEqual(key, kvs.share_artifact(self.job_id,
+                                                    {"ID": [1.0, 3.0]}))
+        self.assertTrue(
+            key.startswith(kvs.tokens.generate_job_key(self.job_id)))
+
+    def test_artifacts_are_fetched_once(self):
+        key = kvs.share_artifact(self.job_id, {"ID": [1.0, 2.0]})
+        kvs.clear_artifact_cache(self.job_id)
+
+        artifact = kvs.get_artifact(self.job_id, key)
+        self.assertEqual({"ID": [1.0, 2.0]}, artifact)
+
+        self.client.delete(key)
+        self.assertIs(artifact, kvs.get_artifact(self.job_id, key))
+
+    def test_get_unknown_artifact(self):
+        self.assertRaises(KeyError, kvs.get_artifact, self.job_id,
+                          kvs.tokens.generate_blob_key(self.job_id, "xxx"))
+
+    def test_gc_clears_the_artifact_cache(self):
+        key = kvs.share_artifact(self.job_id, {"ID": [1.0, 2.0]})
+        kvs.cache_gc(self.job_id)
+
+        self.assertRaises(KeyError, kvs.get_artifact, self.job_id, key)
+
+
 class GetClientTestCase(unittest.TestCase):
     """
     Tests for get_client()
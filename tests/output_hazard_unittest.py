@@ -18,6 +18,7 @@
 # <http://www.gnu.org/licenses/lgpl-3.0.txt> for a copy of the LGPLv3 License.
 
 
+import itertools
 import os
 import unittest
 
@@ -420,6 +421,17 @@ class HazardCurveDBReaderTestCase(HazardCurveDBBaseTestCase):
         self.assertEquals(self.sort(_normalize(HAZARD_CURVE_DATA())),
                           self.sort(_normalize(data)))
 
+    def test_stream(self):
+        """Hazard curves are read back in batches"""
+        self.writer.serialize(HAZARD_CURVE_DATA())
+
+        batches = list(self.reader.stream(self.writer.output.id, size=2))
+
+        self.assertTrue(all(0 < len(batch) <= 2 for batch in batches))
+        self.assertEquals(
+            self.sort(self.reader.deserialize(self.writer.output.id)),
+            self.sort(itertools.chain.from_iterable(batches)))
+
 
 class GmfDBBaseTestCase(unittest.TestCase, helpers.DbTestCase):
     """Common code for ground motion field db reader/writer test"""
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2010-2012, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# only, as published by the Free Software Foundation.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License version 3 for more details
+# (a copy is included in the LICENSE file that accompanied this code).
+#
+# You should have received a copy of the GNU Lesser General Public License
+# version 3 along with OpenQuake.  If not, see
+# <http://www.gnu.org/licenses/lgpl-3.0.txt> for a copy of the LGPLv3 License.
+
+"""
+Tests for the serialization of the results to HDF5 archives.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import h5py
+import numpy
+
+from openquake import shapes
+from openquake.output import hazard
+from openquake.output import hdf5
+
+
+class HDF5WriterTestCase(unittest.TestCase):
+    """Tests for the writers of :mod:`openquake.output.hdf5`."""
+
+    JOB_ID = 7
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.path = hdf5.archive_path(self.output_dir, self.JOB_ID)
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def nrml_path(self, name):
+        return os.path.join(self.output_dir, "%s.xml" % name)
+
+    def read(self, name):
+        """Read all the datasets of an output."""
+        batches = list(hdf5.read_batches(self.path, name))
+
+        return dict((key, numpy.concatenate([batch[key] for batch in batches]))
+                    for key in batches[0])
+
+    def test_hazard_curves_are_appended_per_label(self):
+        writer = hdf5.HazardCurveHDF5Writer(
+            self.nrml_path("hazardcurve-0"), self.JOB_ID)
+
+        def curve(lon, label, poes):
+            values = {'IMLValues': [0.1, 0.2], 'IMT': 'PGA',
+                      'investigationTimeSpan': 50.0, 'PoEValues': poes}
+
+            if label == 'mean':
+                values['statistics'] = 'mean'
+            else:
+                values['endBranchLabel'] = label
+
+            return shapes.Site(lon, 37.5), values
+
+        writer.serialize([curve(-122.5, '0', [0.9, 0.5]),
+                          curve(-122.5, 'mean', [0.8, 0.4])])
+        # the next block is appended
+        writer.serialize([curve(-122.4, '0', [0.7, 0.3])])
+
+        curves = self.read("hazard_curves/0")
+        self.assertEqual([-122.5, -122.4], curves['lons'].tolist())
+        self.assertEqual([37.5, 37.5], curves['lats'].tolist())
+        self.assertEqual([[0.9, 0.5], [0.7, 0.3]], curves['poes'].tolist())
+
+        with h5py.File(self.path, "r") as archive:
+            mean = archive["hazard_curves/mean"]
+
+            self.assertEqual([[0.8, 0.4]], mean["poes"][:].tolist())
+            self.assertEqual("mean", mean.attrs["statistics"])
+            self.assertEqual([0.1, 0.2], mean.attrs["IMLValues"].tolist())
+
+            self.assertEqual(hdf5.CHUNK_ROWS, mean["poes"].chunks[0])
+            self.assertEqual("gzip", mean["poes"].compression)
+
+    def test_gmfs(self):
+        writer = hdf5.GmfHDF5Writer(self.nrml_path("gmf-1"), self.JOB_ID)
+        writer.serialize({shapes.Site(-117, 40): {'groundMotion': 0.2}})
+
+        gmf = self.read("gmfs/gmf-1")
+        self.assertEqual([-117.0], gmf['lons'].tolist())
+        self.assertEqual([0.2], gmf['ground_motion'].tolist())
+
+    def test_no_gmf_writer_without_nrml_path(self):
+        # the GMFs of event based calculations without GMF_OUTPUT
+        self.assertTrue(
+            hazard.create_gmf_writer(self.JOB_ID, ['hdf5'], '') is None)
+
+    def test_hazard_maps_skip_the_sites_without_iml(self):
+        writer = hdf5.HazardMapHDF5Writer(
+            self.nrml_path("hazardmap-0.1-mean"), self.JOB_ID)
+        writer.serialize([
+            (shapes.Site(-121.7, 37.6),
+             {'IML': 1.9, 'IMT': 'PGA', 'poE': 0.1, 'statistics': 'mean'}),
+            (shapes.Site(-121.8, 37.6),
+             {'IMT': 'PGA', 'poE': 0.1, 'statistics': 'mean'})])
+
+        hazard_map = self.read("hazard_maps/hazardmap-0.1-mean")
+        self.assertEqual([-121.7], hazard_map['lons'].tolist())
+        self.assertEqual([1.9], hazard_map['imls'].tolist())
+
+    def test_loss_curves_of_different_lengths(self):
+        writer = hdf5.LossCurveHDF5Writer(
+            self.nrml_path("losscurves"), self.JOB_ID, "loss")
+        writer.serialize([
+            (shapes.Site(-118.0, 33.8),
+             (shapes.Curve([(1.0, 0.5), (2.0, 0.1)]),
+              {'assetID': 'a1', 'assetValueUnit': 'EUR'})),
+            (shapes.Site(-118.1, 33.8),
+             (shapes.Curve([(3.0, 0.2)]), {'assetID': 'a2'}))])
+
+        curves = self.read("loss_curves/losscurves")
+        self.assertEqual(['a1', 'a2'], curves['asset_refs'].tolist())
+        self.assertEqual([[1.0, 2.0], [3.0]],
+                         [row.tolist() for row in curves['abscissae']])
+        self.assertEqual([[0.5, 0.1], [0.2]],
+                         [row.tolist() for row in curves['poes']])
+
+    def test_scenario_loss_maps(self):
+        writer = hdf5.LossMapHDF5Writer(
+            self.nrml_path("lossmap"), self.JOB_ID)
+        writer.serialize([
+            {'scenario': True, 'unit': 'EUR', 'endBranchLabel': None},
+            (shapes.Site(-121.7, 37.6),
+             [({'mean_loss': 10.0, 'stddev_loss': 1.0}, {'assetID': 'a1'}),
+              ({'mean_loss': 20.0, 'stddev_loss': 2.0}, {'assetID': 'a2'})])])
+
+        loss_map = self.read("loss_maps/lossmap")
+        self.assertEqual([-121.7, -121.7], loss_map['lons'].tolist())
+        self.assertEqual(['a1', 'a2'], loss_map['asset_refs'].tolist())
+        self.assertEqual([10.0, 20.0], loss_map['values'].tolist())
+        self.assertEqual([1.0, 2.0], loss_map['std_devs'].tolist())
+
+        with h5py.File(self.path, "r") as archive:
+            attrs = archive["loss_maps/lossmap"].attrs
+
+            self.assertEqual("EUR", attrs["unit"])
+            self.assertFalse("endBranchLabel" in attrs)
+
+    def test_read_batches(self):
+        writer = hdf5.GmfHDF5Writer(self.nrml_path("gmf-1"), self.JOB_ID)
+        writer.serialize([(shapes.Site(i, 0), {'groundMotion': i})
+                          for i in xrange(5)])
+
+        batches = list(hdf5.read_batches(self.path, "gmfs/gmf-1", size=2))
+
+        self.assertEqual([[0.0, 1.0], [2.0, 3.0], [4.0]],
+                         [batch['ground_motion'].tolist()
+                          for batch in batches])
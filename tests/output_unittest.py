@@ -36,6 +36,7 @@ from osgeo import gdal, gdalconst
 from openquake import writer
 from openquake import shapes
 from tests.utils import helpers
+from tests.parser_hazard_curve_unittest import HAZARD_CURVES
 from openquake.output import geotiff, curve, cpt
 
 # we define some test regions which have a lower-left corner at 0.0/0.0
@@ -388,6 +389,65 @@ class OutputTestCase(unittest.TestCase):
             self.assertTrue(os.path.getsize(svg_file) > 0)
             os.remove(svg_file)
 
+    def test_hazardcurve_plot_batch(self):
+        """Create the SVG plots of all the sites at once, one file per site,
+        in worker processes."""
+
+        path = helpers.get_output_path(HAZARDCURVE_PLOT_FILENAME)
+        hazardcurve_path = helpers.touch(HAZARD_CURVES)
+
+        plotter = curve.HazardCurvePlotter(path, hazardcurve_path,
+            curve_title='Example Hazard Curves')
+        os.remove(hazardcurve_path)
+
+        svg_files = plotter.plot_batch(processes=2)
+
+        self.assertEqual(4, len(svg_files))
+        self.assertEqual(sorted(svg_files), sorted(plotter.filenames()))
+
+        for svg_file in svg_files:
+            self.assertTrue(os.path.getsize(svg_file) > 0)
+            os.remove(svg_file)
+
+    def test_riskcurve_plot_batch_many_sites_per_file(self):
+        """Create SVG files with the plots of many sites side by side."""
+
+        path = helpers.get_output_path(LOSS_CURVE_PLOT_FILENAME)
+        loss_curve_path = helpers.get_data_path(LOSS_CURVE_PLOT_INPUTFILE)
+
+        plotter = curve.RiskCurvePlotter(path, loss_curve_path, mode='loss',
+            curve_title="This is a test loss curve")
+
+        svg_files = plotter.plot_batch(sites_per_file=2, processes=1)
+
+        self.assertEqual((len(plotter.data) + 1) // 2, len(svg_files))
+
+        for svg_file in svg_files:
+            self.assertTrue(svg_file.startswith(plotter.output_base_path))
+            self.assertTrue(os.path.getsize(svg_file) > 0)
+            os.remove(svg_file)
+
+    def test_curve_plot_batch_without_sites(self):
+        """Nothing is plotted for an empty dataset."""
+
+        self.assertEqual(None, curve.plot_sheets([], processes=2))
+
+    def test_curve_figure_with_too_many_sites(self):
+        """A figure cannot draw more sites than it has plots."""
+
+        test_hc_data = {'1_1':
+                {'abscissa': [0.0, 1.0, 1.8],
+                 'ordinate': [1.0, 0.5, 0.2],
+                 'abscissa_property': 'PGA',
+                 'ordinate_property': 'Probability of Exceedance',
+                 'curve_title': 'Hazard Curve'}}
+
+        figure = curve.CurveFigure()
+        path = helpers.get_output_path(HAZARDCURVE_PLOT_SIMPLE_FILENAME)
+
+        self.assertRaises(ValueError, figure.draw, path,
+                          [test_hc_data, test_hc_data])
+
     def test_geotiff_generation_and_metadata_validation(self):
         """Create a GeoTIFF, and check if it has the correct metadata."""
         path = helpers.get_output_path(GEOTIFF_FILENAME_WITHOUT_NUMBER)
@@ -471,6 +531,37 @@ class OutputTestCase(unittest.TestCase):
         self._assert_geotiff_metadata_and_raster_is_correct(path,
             asymmetric_region, GEOTIFF_USED_CHANNEL_IDX, reference_raster)
 
+    def test_geotiff_generation_with_bulk_writes(self):
+        """Writing all the cells at once must produce the same raster as
+        writing them one by one."""
+        path = helpers.get_output_path(
+            GEOTIFF_FILENAME_LARGE_ASYMMETRIC_REGION)
+        asymmetric_region = shapes.Region.from_coordinates(
+            TEST_REGION_LARGE_ASYMMETRIC)
+        grid = asymmetric_region.grid
+        gwriter = geotiff.LossMapGeoTiffFile(
+            path, grid, pixel_type=gdal.GDT_Float32, normalize=False)
+
+        rows, columns = numpy.indices((grid.rows, grid.columns))
+        reference_raster = (rows + 1.0) * (columns + 1.0)
+        gwriter.write_cells(rows.ravel(), columns.ravel(),
+                            reference_raster.ravel())
+        gwriter.close()
+
+        self._assert_geotiff_metadata_and_raster_is_correct(path,
+            asymmetric_region, GEOTIFF_USED_CHANNEL_IDX, reference_raster)
+
+    def test_geotiff_write_raster_with_wrong_shape(self):
+        """A raster not matching the grid is rejected."""
+        path = helpers.get_output_path(GEOTIFF_FILENAME_SQUARE_REGION)
+        squareregion = shapes.Region.from_coordinates(TEST_REGION_SQUARE)
+        gwriter = geotiff.LossMapGeoTiffFile(
+            path, squareregion.grid, normalize=False)
+
+        self.assertRaises(ValueError, gwriter.write_raster,
+            numpy.zeros((squareregion.grid.rows + 1,
+                         squareregion.grid.columns)))
+
     def _assert_geotiff_metadata_is_correct(self, path, region):
         """
         Verifies:
@@ -28,6 +28,7 @@ import unittest
 
 from openquake import writer
 from openquake.output import hazard as hazard_output
+from openquake.output import hdf5
 from openquake.output import risk as risk_output
 
 from tests.utils import helpers
@@ -85,6 +86,16 @@ class CreateWriterTestBase(object):
         writer = self.create_function(11, ['db'], "/tmp/c.xml")
         self.assertTrue(isinstance(writer, self.db_writer_class))
 
+    def test_create_writer_with_hdf5(self):
+        """
+        A `*HDF5Writer` instance, appending to the archive of the
+        calculation, is returned when the serialize_to parameter is set to
+        'hdf5'.
+        """
+        writer = self.create_function(11, ['hdf5'], "/tmp/c.xml")
+        self.assertTrue(isinstance(writer, self.hdf5_writer_class))
+        self.assertEqual("/tmp/calculation-11.hdf5", writer.path)
+
     def test_create_writer_with_db_and_no_job_id(self):
         """
         An AssertionError is raised when the serialize_to  parameter is set to
@@ -120,6 +131,7 @@ class CreateHazardmapWriterTestCase(unittest.TestCase, CreateWriterTestBase):
     create_function = SMWrapper(hazard_output.create_hazardmap_writer)
     xml_writer_class = hazard_output.HazardMapXMLWriter
     db_writer_class = hazard_output.HazardMapDBWriter
+    hdf5_writer_class = hdf5.HazardMapHDF5Writer
 
 
 class CreateHazardcurveWriterTestCase(unittest.TestCase, CreateWriterTestBase):
@@ -128,6 +140,7 @@ class CreateHazardcurveWriterTestCase(unittest.TestCase, CreateWriterTestBase):
     create_function = SMWrapper(hazard_output.create_hazardcurve_writer)
     xml_writer_class = hazard_output.HazardCurveXMLWriter
     db_writer_class = hazard_output.HazardCurveDBWriter
+    hdf5_writer_class = hdf5.HazardCurveHDF5Writer
 
 
 class CreateGMFWriterTestCase(unittest.TestCase, CreateWriterTestBase):
@@ -136,6 +149,7 @@ class CreateGMFWriterTestCase(unittest.TestCase, CreateWriterTestBase):
     create_function = SMWrapper(hazard_output.create_gmf_writer)
     xml_writer_class = hazard_output.GMFXMLWriter
     db_writer_class = hazard_output.GmfDBWriter
+    hdf5_writer_class = hdf5.GmfHDF5Writer
 
 
 class CreateRiskWriterTest(unittest.TestCase):
@@ -157,6 +171,12 @@ class CreateRiskWriterTest(unittest.TestCase):
             1, ['db'], "fakepath.xml", "loss")
         self.assertEqual(type(writer), risk_output.LossCurveDBWriter)
 
+        # HDF5 writers
+        writer = risk_output.create_loss_curve_writer(
+            1, ['hdf5'], "fakepath.xml", "loss_ratio")
+        self.assertEqual(type(writer), hdf5.LossCurveHDF5Writer)
+        self.assertEqual("loss_ratio_curves", writer.group)
+
     def test_scenario_loss_map_writer_creation(self):
         # XML writer
         writer = risk_output.create_loss_map_writer(
@@ -168,6 +188,11 @@ class CreateRiskWriterTest(unittest.TestCase):
             1, ['db'], "fakepath.xml", True)
         self.assertEqual(type(writer), risk_output.LossMapDBWriter)
 
+        # HDF5 writer
+        writer = risk_output.create_loss_map_writer(
+            1, ['hdf5'], "fakepath.xml", True)
+        self.assertEqual(type(writer), hdf5.LossMapHDF5Writer)
+
     def test_nonscenario_loss_map_writer_creation(self):
         # XML writer
         writer = risk_output.create_loss_map_writer(
@@ -19,6 +19,8 @@
 
 
 import os
+import shutil
+import tempfile
 import unittest
 
 from openquake.parser import exposure
@@ -143,3 +145,70 @@ class ExposurePortfolioFileTestCase(unittest.TestCase):
         self.assertTrue(ctr == expected_result_ctr - 1,
             "filter yielded wrong number of items (%s), expected were %s" % (
                 ctr + 1, expected_result_ctr))
+
+
+class ReadExposureTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.path = os.path.join(helpers.SCHEMA_EXAMPLES_DIR, TEST_FILE)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_read_exposure_without_cache(self):
+        self.assertEqual(list(exposure.ExposurePortfolioFile(self.path)),
+                         exposure.read_exposure(self.path))
+        self.assertEqual([], os.listdir(self.cache_dir))
+
+    def test_cached_exposure_is_not_parsed_again(self):
+        expected = exposure.read_exposure(self.path, self.cache_dir)
+        self.assertEqual(1, len(os.listdir(self.cache_dir)))
+
+        with helpers.patch(
+            "openquake.parser.exposure.ExposurePortfolioFile") as parser:
+            self.assertEqual(
+                expected, exposure.read_exposure(self.path, self.cache_dir))
+            self.assertFalse(parser.called)
+
+    def test_cache_is_versioned(self):
+        exposure.read_exposure(self.path, self.cache_dir)
+
+        [cache_file] = os.listdir(self.cache_dir)
+        self.assertTrue(cache_file.startswith(
+            "exposure-v%s-" % exposure.CACHE_VERSION))
+
+    def test_read_exposure_within_region(self):
+        constraint = shapes.RegionConstraint.from_simple(
+            (9.14, 45.19), (9.16, 45.15))
+        assets = exposure.read_exposure(self.path, self.cache_dir)
+
+        expected = [assets[0], assets[2]]
+
+        self.assertEqual(expected, exposure.read_exposure(
+            self.path, self.cache_dir, constraint))
+        self.assertEqual(expected, exposure.read_exposure(
+            self.path, constraint=constraint))
+
+    def test_corrupt_cache_is_parsed_again(self):
+        expected = exposure.read_exposure(self.path, self.cache_dir)
+
+        [cache_file] = os.listdir(self.cache_dir)
+        with open(os.path.join(self.cache_dir, cache_file), "wb") as cache:
+            cache.write("not a pickle")
+
+        self.assertEqual(
+            expected, exposure.read_exposure(self.path, self.cache_dir))
+        # the cache is written again
+        self.assertEqual(
+            expected, exposure.read_exposure(self.path, self.cache_dir))
+
+    def test_failed_cache_write_leaves_no_file(self):
+        with helpers.patch("cPickle.dump") as dump:
+            dump.side_effect = IOError("disk full")
+
+            self.assertEqual(
+                list(exposure.ExposurePortfolioFile(self.path)),
+                exposure.read_exposure(self.path, self.cache_dir))
+
+        self.assertEqual([], os.listdir(self.cache_dir))
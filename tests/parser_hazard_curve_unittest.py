@@ -18,6 +18,7 @@
 # <http://www.gnu.org/licenses/lgpl-3.0.txt> for a copy of the LGPLv3 License.
 
 
+import numpy
 import os
 import unittest
 
@@ -41,6 +42,41 @@ FAIL_EXAMPLE_DIR = os.path.join(EXAMPLE_DIR, 'failures')
 TEST_FILE = os.path.join(EXAMPLE_DIR,
                          'hazard-curves.xml')
 
+HAZARD_CURVES = """<?xml version="1.0" encoding="UTF-8"?>
+<nrml xmlns:gml="http://www.opengis.net/gml"
+      xmlns="http://openquake.org/xmlns/nrml/0.3" gml:id="nrml">
+  <hazardResult gml:id="hr">
+    <config>
+      <hazardProcessing investigationTimeSpan="50.0" IDmodel="PGA_1_1"
+          saPeriod="0.1" saDamping="0.2"/>
+    </config>
+    <hazardCurveField gml:id="hcf_1" endBranchLabel="1_1">
+      <IML IMT="PGA">5.0000e-03 7.0000e-03 1.3700e-02</IML>
+      <HCNode gml:id="hcn_1">
+        <site><gml:Point><gml:pos>-122.5 37.5</gml:pos></gml:Point></site>
+        <hazardCurve><poE>9.8728e-01 9.8266e-01 9.4957e-01</poE></hazardCurve>
+      </HCNode>
+      <HCNode gml:id="hcn_2">
+        <site><gml:Point><gml:pos>-123.5 37.5</gml:pos></gml:Point></site>
+        <hazardCurve><poE>9.8728e-02 9.8266e-02 9.4957e-02</poE></hazardCurve>
+      </HCNode>
+      <HCNode gml:id="hcn_3">
+        <site><gml:Point><gml:pos>-124.5 37.5</gml:pos></gml:Point></site>
+        <hazardCurve><poE>0.3 0.2 0.1</poE></hazardCurve>
+      </HCNode>
+    </hazardCurveField>
+    <hazardCurveField gml:id="hcf_2" statistics="quantile"
+        quantileValue="0.5">
+      <IML IMT="SA">0.0001 0.0002</IML>
+      <HCNode gml:id="hcn_4">
+        <site><gml:Point><gml:pos>-125.5 37.5</gml:pos></gml:Point></site>
+        <hazardCurve><poE>9.3e-01 9.2e-01</poE></hazardCurve>
+      </HCNode>
+    </hazardCurveField>
+  </hazardResult>
+</nrml>
+"""
+
 
 class NrmlFileTestCase(unittest.TestCase):
 
@@ -259,6 +295,73 @@ class NrmlFileTestCase(unittest.TestCase):
             self.nrml_element.reset()
 
 
+class NrmlFileStreamingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = helpers.touch(HAZARD_CURVES)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_parses_the_curves_of_each_field(self):
+        curves = list(hazard_parser.NrmlFile(self.path))
+
+        self.assertEqual(4, len(curves))
+        self.assertEqual(shapes.Site(-122.5, 37.5), curves[0][0])
+        self.assertEqual(
+            {'IMT': 'PGA',
+             'IDmodel': 'PGA_1_1',
+             'investigationTimeSpan': 50.0,
+             'endBranchLabel': '1_1',
+             'saDamping': 0.2,
+             'saPeriod': 0.1,
+             'IMLValues': [5.0000e-03, 7.0000e-03, 1.3700e-02],
+             'PoEValues': [9.8728e-01, 9.8266e-01, 9.4957e-01]},
+            curves[0][1])
+
+        self.assertEqual(shapes.Site(-125.5, 37.5), curves[3][0])
+        self.assertEqual('SA', curves[3][1]['IMT'])
+        self.assertEqual('quantile', curves[3][1]['statistics'])
+        self.assertEqual(0.5, curves[3][1]['quantileValue'])
+        self.assertEqual([0.0001, 0.0002], curves[3][1]['IMLValues'])
+
+    def test_batches(self):
+        batches = list(hazard_parser.NrmlFile(self.path).batches(size=2))
+
+        # the second field starts a new batch
+        self.assertEqual([2, 1, 1], [len(sites) for _, sites, _ in batches])
+
+        meta, sites, poes = batches[1]
+        self.assertEqual('1_1', meta['endBranchLabel'])
+        self.assertTrue(numpy.allclose(
+            [5.0000e-03, 7.0000e-03, 1.3700e-02], meta['IMLValues']))
+        self.assertEqual([shapes.Site(-124.5, 37.5)], sites)
+        self.assertTrue(numpy.allclose([[0.3, 0.2, 0.1]], poes))
+
+        meta, sites, poes = batches[0]
+        self.assertEqual((2, 3), poes.shape)
+        self.assertTrue(numpy.allclose(
+            [9.8728e-02, 9.8266e-02, 9.4957e-02], poes[1]))
+
+    def test_raises_on_missing_poes(self):
+        path = helpers.touch(HAZARD_CURVES.replace(
+            "0.3 0.2 0.1", "0.3 0.2"))
+
+        try:
+            self.assertRaises(ValueError, list, hazard_parser.NrmlFile(path))
+        finally:
+            os.remove(path)
+
+    def test_raises_on_invalid_imls(self):
+        path = helpers.touch(HAZARD_CURVES.replace(
+            "0.0001 0.0002", "0.0001 abc"))
+
+        try:
+            self.assertRaises(ValueError, list, hazard_parser.NrmlFile(path))
+        finally:
+            os.remove(path)
+
+
 class GMFReaderTestCase(unittest.TestCase):
 
     def test_gmf_reader_yields_correct_parsed_values(self):
@@ -42,7 +42,6 @@ class LossMapCurveSerialization(unittest.TestCase):
         calc_proxy.blocks_keys = []
 
         self.calculator = EventBasedRiskCalculator(calc_proxy)
-        self.calculator.store_exposure_assets = lambda: None
         self.calculator.store_vulnerability_model = lambda: None
         self.calculator.partition = lambda: None
 
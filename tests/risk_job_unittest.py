@@ -18,6 +18,7 @@
 # <http://www.gnu.org/licenses/lgpl-3.0.txt> for a copy of the LGPLv3 License.
 
 import mock
+import numpy
 import os
 import redis
 import unittest
@@ -28,6 +29,8 @@ from openquake.job import config
 from openquake.parser import exposure
 from openquake.calculators.risk import general
 from openquake.calculators.risk.general import Block
+from openquake.calculators.risk.general import BlockAssets
+from openquake.calculators.risk.scenario import core as scenario
 
 from tests.utils import helpers
 
@@ -105,6 +108,146 @@ class EpsilonTestCase(unittest.TestCase):
             break
 
 
+class SeededEpsilonTestCase(unittest.TestCase):
+    """Tests the `epsilons` method in class `SeededEpsilonProvider`"""
+
+    def setUp(self):
+        self.asset_1 = {"assetID": "a1", "taxonomy": "RC"}
+        self.asset_2 = {"assetID": "a2", "taxonomy": "RC"}
+        self.asset_3 = {"assetID": "a3", "taxonomy": "MS"}
+
+    def test_uncorrelated(self):
+        """Each asset has its own reproducible stream of epsilons."""
+        provider = general.SeededEpsilonProvider(
+            {"EPSILON_RANDOM_SEED": "37"})
+
+        epsilons = provider.epsilons(self.asset_1, 10)
+
+        self.assertEqual(10, len(epsilons))
+        self.assertTrue(numpy.allclose(
+            epsilons, general.SeededEpsilonProvider(
+                {"EPSILON_RANDOM_SEED": "37"}).epsilons(self.asset_1, 10)))
+        self.assertFalse(numpy.allclose(
+            epsilons, provider.epsilons(self.asset_2, 10)))
+        self.assertFalse(numpy.allclose(
+            epsilons, general.SeededEpsilonProvider(
+                {"EPSILON_RANDOM_SEED": "38"}).epsilons(self.asset_1, 10)))
+
+    def test_epsilons_are_keyed_on_the_event_index(self):
+        provider = general.SeededEpsilonProvider(
+            {"EPSILON_RANDOM_SEED": "37"})
+
+        epsilons = provider.epsilons(self.asset_1, 10)
+
+        self.assertTrue(numpy.allclose(
+            epsilons[4:7], provider.epsilons(self.asset_1, 3, start=4)))
+
+    def test_epsilons_of_a_batch_crossing_chunks(self):
+        provider = general.SeededEpsilonProvider(
+            {"EPSILON_RANDOM_SEED": "37"})
+        start = general.EPSILON_CHUNK - 3
+
+        epsilons = provider.epsilons(
+            self.asset_1, start + general.EPSILON_CHUNK + 10)
+
+        self.assertTrue(numpy.allclose(
+            epsilons[start:], provider.epsilons(
+                self.asset_1, general.EPSILON_CHUNK + 10, start=start)))
+        self.assertTrue(numpy.allclose(
+            epsilons[start:start + 6],
+            provider.epsilons(self.asset_1, 6, start=start)))
+        self.assertEqual(0, len(provider.epsilons(self.asset_1, 0, start)))
+
+    def test_correlated(self):
+        """Assets with the same taxonomy share the same epsilons."""
+        provider = general.SeededEpsilonProvider(
+            {"EPSILON_RANDOM_SEED": "37", "ASSET_CORRELATION": "perfect"})
+
+        self.assertTrue(numpy.allclose(
+            provider.epsilons(self.asset_1, 5),
+            provider.epsilons(self.asset_2, 5)))
+        self.assertFalse(numpy.allclose(
+            provider.epsilons(self.asset_1, 5),
+            provider.epsilons(self.asset_3, 5)))
+
+    def test_incorrect_configuration_setting(self):
+        self.assertRaises(ValueError, general.SeededEpsilonProvider,
+            {"EPSILON_RANDOM_SEED": "37", "ASSET_CORRELATION": "wrong"})
+
+    def test_correlated_with_no_taxonomy(self):
+        provider = general.SeededEpsilonProvider(
+            {"EPSILON_RANDOM_SEED": "37", "ASSET_CORRELATION": "perfect"})
+
+        self.assertRaises(ValueError, provider.epsilons, {"assetID": "a1"}, 5)
+
+    def test_create_epsilon_provider(self):
+        self.assertTrue(isinstance(
+            general.create_epsilon_provider({"EPSILON_RANDOM_SEED": "37"}),
+            general.SeededEpsilonProvider))
+        self.assertTrue(isinstance(
+            general.create_epsilon_provider({}), general.EpsilonProvider))
+
+    def test_sampled_loss_ratios_use_one_epsilon_per_event(self):
+        vuln_function = shapes.VulnerabilityFunction(
+            [0.10, 0.30, 0.50, 1.00], [0.05, 0.10, 0.15, 0.30],
+            [0.30, 0.30, 0.20, 0.20])
+        gmfs = {"IMLs": (0.1576, 0.9706, 0.9572, 0.4854)}
+
+        provider = general.SeededEpsilonProvider(
+            {"EPSILON_RANDOM_SEED": "37"})
+
+        scalar_provider = mock.Mock(spec=["epsilon"])
+        scalar_provider.epsilon.side_effect = list(
+            provider.epsilons(self.asset_1, 4))
+
+        expected = general.compute_loss_ratios(
+            vuln_function, gmfs, scalar_provider, self.asset_1)
+
+        self.assertTrue(numpy.allclose(expected, general.compute_loss_ratios(
+            vuln_function, gmfs, provider, self.asset_1)))
+
+    def test_sampled_loss_ratios_of_a_batch_of_events(self):
+        """A batch of events gets the loss ratios of the whole run."""
+        vuln_function = shapes.VulnerabilityFunction(
+            [0.10, 0.30, 0.50, 1.00], [0.05, 0.10, 0.15, 0.30],
+            [0.30, 0.30, 0.20, 0.20])
+        imls = (0.1576, 0.9706, 0.9572, 0.4854, 0.8003, 0.1419)
+
+        provider = general.SeededEpsilonProvider(
+            {"EPSILON_RANDOM_SEED": "37"})
+
+        expected = general.compute_loss_ratios(
+            vuln_function, {"IMLs": imls}, provider, self.asset_1)
+
+        self.assertTrue(numpy.allclose(
+            expected[2:5], general.compute_loss_ratios(
+                vuln_function, {"IMLs": imls[2:5]}, provider, self.asset_1,
+                start=2)))
+
+
+class ScenarioComputeRiskTestCase(unittest.TestCase):
+
+    def test_epsilon_provider_is_built_by_the_task(self):
+        job = helpers.create_job({"EPSILON_RANDOM_SEED": "37"}, job_id=1)
+        calculator = scenario.ScenarioRiskCalculator(job)
+
+        with helpers.patch("openquake.parser.vulnerability"
+                           ".load_vuln_model_from_kvs"):
+            with helpers.patch("openquake.calculators.risk.general"
+                               ".Block.from_kvs"):
+                with helpers.patch("openquake.calculators.risk.scenario.core"
+                                   ".ScenarioRiskCalculator"
+                                   "._compute_losses_for_block") as compute:
+                    calculator.compute_risk(0, start=1000, size=500)
+
+        [_block, _vuln_model, epsilon_provider, start, size] = \
+            compute.call_args[0]
+        self.assertTrue(isinstance(
+            epsilon_provider, general.SeededEpsilonProvider))
+        self.assertEqual(37, epsilon_provider.seed)
+        self.assertEqual((1000, 500), (start, size))
+
+
 class BlockTestCase(unittest.TestCase):
     """Tests for the :class:`openquake.calculators.risk.general.Block` class.
     """
@@ -143,6 +286,71 @@ class BlockTestCase(unittest.TestCase):
         self.assertEqual(expected_block.sites, actual_block.sites)
 
 
+class BlockAssetsTestCase(unittest.TestCase):
+    """Tests for the
+    :class:`openquake.calculators.risk.general.BlockAssets` class.
+    """
+
+    def setUp(self):
+        self.point_1 = shapes.GridPoint(None, 1, 2)
+        self.point_2 = shapes.GridPoint(None, 3, 4)
+
+        self.assets = [
+            (self.point_1, {'assetID': 'a1', 'assetValue': 10.0,
+                            'taxonomy': 'RC', 'listID': 'L1',
+                            'lon': 1.0, 'lat': 2.0}),
+            (self.point_2, {'assetID': 'a2', 'assetValue': 20.0,
+                            'taxonomy': 'W', 'listID': 'L1',
+                            'retrofittingCost': 5.0,
+                            'lon': 3.0, 'lat': 4.0}),
+            (self.point_1, {'assetID': 'a3', 'assetValue': 30.0,
+                            'taxonomy': 'RC', 'structureCategory': 'S',
+                            'lon': 1.0, 'lat': 2.0})]
+
+        self.block_assets = BlockAssets.from_assets(self.assets)
+
+    def test_assets_are_stored_by_column(self):
+        self.assertEqual([10.0, 20.0, 30.0],
+                         self.block_assets.values.tolist())
+        self.assertEqual([2, 4, 2], self.block_assets.rows.tolist())
+        self.assertEqual([1, 3, 1], self.block_assets.columns.tolist())
+
+        # the shared attributes are stored once, in the tables
+        self.assertEqual(['RC', 'W'], self.block_assets.tables['taxonomy'])
+        self.assertEqual([0, 1, 0],
+                         self.block_assets.codes['taxonomy'].tolist())
+        self.assertEqual([0, 0, -1],
+                         self.block_assets.codes['listID'].tolist())
+
+    def test_assets_round_trip(self):
+        for index, (_, asset) in enumerate(self.assets):
+            self.assertEqual(asset, self.block_assets.asset(index))
+
+    def test_assets_at(self):
+        self.assertEqual([self.assets[0][1], self.assets[2][1]],
+                         self.block_assets.assets_at(self.point_1))
+        self.assertEqual([], self.block_assets.assets_at(
+                shapes.GridPoint(None, 5, 5)))
+
+    def test_points_and_assets(self):
+        self.assertEqual(
+            [(point, asset) for point, asset in self.assets],
+            list(self.block_assets.points_and_assets(None)))
+
+    def test_block_assets_kvs_serialization(self):
+        self.block_assets.to_kvs(7, 0)
+
+        actual = BlockAssets.from_kvs(7, 0)
+
+        self.assertEqual(self.block_assets.asset_ids, actual.asset_ids)
+        self.assertEqual(self.block_assets.tables, actual.tables)
+        self.assertEqual([asset for _, asset in self.assets],
+                         [actual.asset(index) for index in xrange(3)])
+
+    def test_block_without_assets(self):
+        self.assertEqual(0, len(BlockAssets.from_kvs(7, 12345)))
+
+
 class BlockSplitterTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -245,6 +453,9 @@ class BaseRiskCalculatorTestCase(unittest.TestCase):
         params = {
             config.EXPOSURE: os.path.join(helpers.SCHEMA_EXAMPLES_DIR,
                                           EXPOSURE_TEST_FILE),
+            config.INPUT_REGION: "46.0, 9.14, 46.0, 9.16, 45.0, 9.16, "
+                                 "45.0, 9.14",
+            config.REGION_GRID_SPACING: 0.1,
             "BASE_PATH": "."
         }
         a_job = helpers.create_job(params)
@@ -265,6 +476,12 @@ class BaseRiskCalculatorTestCase(unittest.TestCase):
             expected, general.Block.from_kvs(a_job.job_id,
                                              a_job.blocks_keys[0]))
 
+        # the assets are stored along with the block, from the same parse
+        block_assets = general.BlockAssets.from_kvs(
+            a_job.job_id, a_job.blocks_keys[0])
+
+        self.assertEqual(3, len(block_assets))
+
     def test_prepares_blocks_using_the_exposure_and_filtering(self):
         """When reading the exposure file, the calculator also provides
         filtering on the region specified in the REGION_VERTEX and
@@ -314,7 +531,7 @@ class RiskCalculatorTestCase(unittest.TestCase):
             [(1.0, 3.0), (1.0, 4.0), (2.0, 4.0), (2.0, 3.0)]),
             1.0)
 
-        # this is the expected output of grid_assets_iterator and an input of
+        # this is the expected output of assets_iterator and an input of
         # asset_losses_per_site
         self.grid_assets = [
             (shapes.GridPoint(self.grid, 0, 0), GRID_ASSETS[(0, 0)]),
@@ -322,25 +539,24 @@ class RiskCalculatorTestCase(unittest.TestCase):
             (shapes.GridPoint(self.grid, 0, 1), GRID_ASSETS[(1, 0)]),
             (shapes.GridPoint(self.grid, 1, 1), GRID_ASSETS[(1, 1)])]
 
-    def test_grid_assets_iterator(self):
-        with helpers.patch('openquake.kvs.get_list_json_decoded') as get_mock:
-
-            def get_list_json_decoded(key):
-                row, col = kvs.tokens.asset_row_col_from_kvs_key(key)
-
-                return [GRID_ASSETS[(row, col)]]
+    def test_assets_iterator(self):
+        BlockAssets.from_assets(self.grid_assets[:3]).to_kvs(
+            self.job.job_id, 0)
+        BlockAssets.from_assets(self.grid_assets[3:]).to_kvs(
+            self.job.job_id, 1)
 
-            get_mock.side_effect = get_list_json_decoded
+        self.job.blocks_keys = [0, 1]
 
-            def row_col(item):
-                return item[0].row, item[0].column
+        with helpers.patch(
+            'openquake.engine.CalculationProxy.region') as region_mock:
+            region_mock.grid = self.grid
 
             calculator = general.BaseRiskCalculator(self.job)
 
-            got = sorted(calculator.grid_assets_iterator(self.grid),
-                         key=row_col)
-
-            self.assertEqual(sorted(self.grid_assets, key=row_col), got)
+            self.assertEqual(self.grid_assets,
+                             list(calculator.assets_iterator()))
+            self.assertEqual(self.grid_assets[3:],
+                             list(calculator.assets_iterator([1])))
 
     def test_that_conditional_loss_is_in_kvs(self):
         asset = {"assetID": 1}
@@ -361,7 +577,7 @@ class RiskCalculatorTestCase(unittest.TestCase):
 
     def test_asset_losses_per_site(self):
         mm = mock.MagicMock(spec=redis.Redis)
-        mm.get.return_value = 0.123
+        mm.mget.side_effect = lambda keys: [0.123] * len(keys)
         with helpers.patch('openquake.kvs.get_client') as mgc:
             mgc.return_value = mm
 
@@ -386,3 +602,89 @@ class RiskCalculatorTestCase(unittest.TestCase):
                     calculator.asset_losses_per_site(
                         0.5, self.grid_assets),
                     key=coords))
+
+            # a single round trip
+            self.assertEqual(1, mm.mget.call_count)
+
+    def test_write_output_for_block(self):
+        BlockAssets.from_assets(self.grid_assets).to_kvs(self.job.job_id, 0)
+        self.job.blocks_keys = [0]
+
+        loss_curve = shapes.Curve([(0.1, 0.5), (0.2, 0.3)])
+        loss_ratio_curve = shapes.Curve([(0.01, 0.5), (0.02, 0.3)])
+        client = kvs.get_client()
+
+        for point, asset in self.grid_assets[:2]:
+            client.set(kvs.tokens.loss_curve_key(
+                self.job.job_id, point.row, point.column, asset["assetID"]),
+                loss_curve.to_binary())
+        for point, asset in self.grid_assets[1:]:
+            client.set(kvs.tokens.loss_ratio_key(
+                self.job.job_id, point.row, point.column, asset["assetID"]),
+                loss_ratio_curve.to_binary())
+
+        with helpers.patch(
+            'openquake.engine.CalculationProxy.region') as region_mock:
+            region_mock.grid = self.grid
+            calculator = general.BaseRiskCalculator(self.job)
+
+            with helpers.patch('openquake.calculators.risk.general'
+                               '.BaseRiskCalculator._serialize') as serialize:
+                serialize.return_value = []
+                calculator._write_output_for_block(self.job.job_id, 0)
+
+        ratio_kwargs, loss_kwargs = [
+            kwargs for _args, kwargs in serialize.call_args_list]
+
+        def curve_assets(kwargs):
+            return [asset for _, (_, asset) in kwargs['curves']]
+
+        self.assertEqual('loss_ratio', ratio_kwargs['curve_mode'])
+        self.assertEqual(
+            [asset for _, asset in self.grid_assets[1:]],
+            curve_assets(ratio_kwargs))
+        self.assertEqual('loss', loss_kwargs['curve_mode'])
+        self.assertEqual(
+            [asset for _, asset in self.grid_assets[:2]],
+            curve_assets(loss_kwargs))
+
+    def test_write_block_output(self):
+        # the task writes the curves where it is told to, even if the
+        # calculation it rebuilds from the KVS doesn't know where
+        BlockAssets.from_assets(self.grid_assets).to_kvs(self.job.job_id, 0)
+        self.job.blocks_keys = [0]
+        self.job.serialize_results_to = []
+
+        loss_curve = shapes.Curve([(0.1, 0.5), (0.2, 0.3)])
+        client = kvs.get_client()
+
+        for point, asset in self.grid_assets:
+            client.set(kvs.tokens.loss_curve_key(
+                self.job.job_id, point.row, point.column, asset["assetID"]),
+                loss_curve.to_binary())
+            client.set(kvs.tokens.loss_ratio_key(
+                self.job.job_id, point.row, point.column, asset["assetID"]),
+                loss_curve.to_binary())
+
+        with helpers.patch(
+            'openquake.engine.CalculationProxy.region') as region_mock:
+            region_mock.grid = self.grid
+
+            with helpers.patch('openquake.calculators.risk.general'
+                               '.calculator_for_task') as calculator_mock:
+                calculator_mock.return_value = general.BaseRiskCalculator(
+                    self.job)
+
+                paths = general.write_block_output(
+                    self.job.job_id, 0, ['xml'])
+
+        self.assertEqual(2, len(paths))
+
+        with open(paths[1]) as loss_curves:
+            content = loss_curves.read()
+
+        for path in paths:
+            os.remove(path)
+
+        for _, asset in self.grid_assets:
+            self.assertTrue(asset["assetID"] in content)
@@ -20,7 +20,6 @@
 from django.contrib.gis.geos import GEOSGeometry
 from lxml import etree
 from StringIO import StringIO
-import json
 import numpy
 import os
 import tempfile
@@ -29,9 +28,12 @@ import unittest
 from openquake.calculators.risk.classical import core as classical_core
 from openquake.calculators.risk.event_based import core as eb_core
 from openquake.calculators.risk.general import AggregateLossCurve
+from openquake.calculators.risk.general import AggregateLosses
 from openquake.calculators.risk.general import BaseRiskCalculator
 from openquake.calculators.risk.general import Block
+from openquake.calculators.risk.general import BlockAssets
 from openquake.calculators.risk.general import compute_bcr
+from openquake.calculators.risk.general import compute_bcr_for_block
 from openquake.calculators.risk.general import _compute_conditional_loss
 from openquake.calculators.risk.general import _compute_cumulative_histogram
 from openquake.calculators.risk.general import compute_loss_curve
@@ -44,11 +46,14 @@ from openquake.calculators.risk.general import _compute_mid_po
 from openquake.calculators.risk.general import _compute_probs_of_exceedance
 from openquake.calculators.risk.general import _compute_rates_of_exceedance
 from openquake.calculators.risk.general import ProbabilisticRiskCalculator
+from openquake.calculators.risk.general import store_bcr_block
+from openquake.calculators.risk.general import load_bcr_block
 from openquake.calculators.risk.scenario import core as scenario
 from openquake import engine
 from openquake import kvs
 from openquake import shapes
 from openquake.output import hazard
+from openquake.parser import vulnerability
 
 from tests.utils import helpers
 
@@ -211,12 +216,10 @@ class ProbabilisticEventBasedTestCase(unittest.TestCase):
         # deleting keys in kvs
         kvs.get_client().flushall()
 
-        kvs.set_value_json_encoded(
-                kvs.tokens.vuln_key(self.job_id),
-                {"ID": self.vuln_function_2.to_json()})
-        kvs.set_value_json_encoded(
-                kvs.tokens.vuln_key(self.job_id, retrofitted=True),
-                {"ID": self.vuln_function_2.to_json()})
+        vulnerability.store_vuln_model(
+                self.job_id, {"ID": self.vuln_function_2})
+        vulnerability.store_vuln_model(
+                self.job_id, {"ID": self.vuln_function_2}, retrofitted=True)
 
         # store the gmfs
         self._store_gmfs(self.gmfs_1, 1, 1)
@@ -227,6 +230,8 @@ class ProbabilisticEventBasedTestCase(unittest.TestCase):
         self._store_gmfs(self.gmfs_6, 1, 6)
 
         # store the assets
+        self.block_id = 7
+        self.assets = []
         self._store_asset(self.asset_1, 1, 1)
         self._store_asset(self.asset_2, 1, 2)
         self._store_asset(self.asset_3, 1, 3)
@@ -248,8 +253,9 @@ class ProbabilisticEventBasedTestCase(unittest.TestCase):
             pass
 
     def _store_asset(self, asset, row, column):
-        key = kvs.tokens.asset_key(self.job_id, row, column)
-        kvs.get_client().rpush(key, json.JSONEncoder().encode(asset))
+        self.assets.append((shapes.GridPoint(None, column, row), asset))
+        BlockAssets.from_assets(self.assets).to_kvs(
+            self.job_id, self.block_id)
 
     def _store_gmfs(self, gmfs, row, column):
         key = kvs.tokens.gmf_set_key(self.job_id, column, row)
@@ -610,6 +616,51 @@ class ProbabilisticEventBasedTestCase(unittest.TestCase):
         aggregate_curve = AggregateLossCurve()
         self.assertEqual(None, aggregate_curve.losses)
 
+    def test_aggregate_losses_are_grouped_by_taxonomy(self):
+        aggregate_losses = AggregateLosses()
+
+        aggregate_losses.append({"taxonomy": "A"}, numpy.array([1.0, 2.0]))
+        aggregate_losses.append({"taxonomy": "B"}, numpy.array([3.0, 4.0]))
+        aggregate_losses.append({"taxonomy": "A"}, numpy.array([5.0, 6.0]))
+
+        self.assertTrue(numpy.allclose(
+                [9.0, 12.0], aggregate_losses.total.losses))
+
+        groups = aggregate_losses.groups("taxonomy")
+        self.assertEqual(["A", "B"], sorted(groups.keys()))
+        self.assertTrue(numpy.allclose([6.0, 8.0], groups["A"].losses))
+        self.assertTrue(numpy.allclose([3.0, 4.0], groups["B"].losses))
+
+    def test_aggregate_losses_merge_in_any_order(self):
+        partials = []
+
+        for taxonomy, losses in (("A", [1.0, 2.0]), ("B", [3.0, 4.0])):
+            partial = AggregateLosses()
+            partial.append({"taxonomy": taxonomy}, numpy.array(losses))
+            partials.append(partial)
+
+        merged = AggregateLosses()
+        merged.merge(partials[1])
+        merged.merge(partials[0])
+
+        self.assertTrue(numpy.allclose([4.0, 6.0], merged.total.losses))
+        self.assertTrue(numpy.allclose(
+                [1.0, 2.0], merged.groups("taxonomy")["A"].losses))
+
+    def test_aggregate_losses_round_trip_through_the_kvs(self):
+        partial = AggregateLosses()
+        partial.append({"taxonomy": "A"}, numpy.array([1.0, 2.0]))
+        partial.to_kvs(self.job_id, 7)
+
+        merged = AggregateLosses()
+        merged.merge_from_kvs(self.job_id, 7)
+
+        self.assertTrue(numpy.allclose([1.0, 2.0], merged.total.losses))
+
+        # the partial sums are consumed by the merge
+        self.assertFalse(kvs.get_client().exists(
+                kvs.tokens.aggregate_losses_key(self.job_id, 7)))
+
     def test_curve_to_plot_interface_translation(self):
         curve = shapes.Curve([(0.1, 1.0), (0.2, 2.0)])
 
@@ -680,6 +731,31 @@ class ProbabilisticEventBasedTestCase(unittest.TestCase):
                 self.assertEqual(0, write_mock.call_count)
                 self.assertEqual(0, close_mock.call_count)
 
+    def test_db_gmf_fields_skip_the_values_outside_the_grid(self):
+        # a 3x3 grid, from (1.0, 1.0) to (2.0, 2.0)
+        self.params["REGION_VERTEX"] = "2.0, 1.0, 2.0, 2.0, 1.0, 2.0, 1.0, 1.0"
+        self.params["REGION_GRID_SPACING"] = "0.5"
+        calculator = eb_core.EventBasedRiskCalculator(self.job)
+
+        gmf_values = [(1, 1.0, 1.0, 0.1), (1, 2.0, 1.5, 0.2),
+                      # below the grid, mirrored by the row rounding
+                      (1, 1.5, 0.0, 9.9),
+                      # east of the grid, beyond the last column
+                      (1, 3.0, 1.0, 9.9),
+                      # west of the grid, a negative column
+                      (2, 0.0, 1.0, 9.9)]
+
+        with helpers.patch("openquake.db.models.gmf_values") as values_mock:
+            values_mock.return_value = iter(gmf_values)
+            fields = list(calculator._get_db_gmf_fields([1, 2]))
+
+        expected = numpy.zeros((3, 3))
+        expected[0, 0] = 0.1
+        expected[1, 2] = 0.2
+
+        self.assertTrue(numpy.allclose(expected, fields[0].field))
+        self.assertTrue(numpy.allclose(numpy.zeros((3, 3)), fields[1].field))
+
     def test_compute_bcr(self):
         cfg_path = helpers.demo_file(
             'probabilistic_event_based_risk/config.gem')
@@ -722,24 +798,28 @@ class ProbabilisticEventBasedTestCase(unittest.TestCase):
 
         calculator.compute_risk(self.block_id)
 
-        result_key = kvs.tokens.bcr_block_key(self.job_id, self.block_id)
-        result = kvs.get_value_json_decoded(result_key)
-        expected_result = {'bcr': 0.0,
-                           'eal_original': 0.0,
-                           'eal_retrofitted': 0.0}
+        result = load_bcr_block(self.job_id, self.block_id)
+        expected_result = {'lat': [-1], 'lon': [-2],
+                           'assetID': [22.61],
+                           'bcr': [0.0],
+                           'eal_original': [0.0],
+                           'eal_retrofitted': [0.0]}
         helpers.assertDeepAlmostEqual(
-            self, result, [[[-1, -2], [[expected_result, 22.61]]]]
-        )
+            self, dict((field, values.tolist())
+                       for field, values in result.iteritems()),
+            expected_result)
 
 
 class ClassicalPSHABasedTestCase(unittest.TestCase, helpers.DbTestCase):
 
     def _store_asset(self, asset, row, column):
-        key = kvs.tokens.asset_key(self.job_id, row, column)
-        kvs.get_client().rpush(key, json.JSONEncoder().encode(asset))
+        self.assets.append((shapes.GridPoint(None, column, row), asset))
+        BlockAssets.from_assets(self.assets).to_kvs(
+            self.job_id, self.block_id)
 
     def setUp(self):
         self.block_id = 7
+        self.assets = []
         self.job = self.setup_classic_job()
         self.job_id = self.job.id
 
@@ -989,12 +1069,10 @@ class ClassicalPSHABasedTestCase(unittest.TestCase, helpers.DbTestCase):
         writer = hazard.HazardCurveDBWriter('test_path.xml', self.job_id)
         writer.serialize(self.hazard_curve)
 
-        kvs.set_value_json_encoded(
-                kvs.tokens.vuln_key(self.job_id),
-                {"ID": self.vuln_function.to_json()})
-        kvs.set_value_json_encoded(
-                kvs.tokens.vuln_key(self.job_id, retrofitted=True),
-                {"ID": self.vuln_function.to_json()})
+        vulnerability.store_vuln_model(
+                self.job_id, {"ID": self.vuln_function})
+        vulnerability.store_vuln_model(
+                self.job_id, {"ID": self.vuln_function}, retrofitted=True)
 
     def test_compute_risk_in_the_classical_psha_calculator(self):
         """
@@ -1030,10 +1108,10 @@ class ClassicalPSHABasedTestCase(unittest.TestCase, helpers.DbTestCase):
         # computes the loss curves and puts them in kvs
         self.assertTrue(calculator.compute_risk(self.block_id))
 
+        block_assets = BlockAssets.from_kvs(self.job_id, self.block_id)
+
         for point in block.grid(calc_proxy.region):
-            asset_key = kvs.tokens.asset_key(self.job_id, point.row,
-                point.column)
-            for asset in kvs.get_list_json_decoded(asset_key):
+            for asset in block_assets.assets_at(point):
                 loss_ratio_key = kvs.tokens.loss_ratio_key(
                     self.job_id, point.row, point.column, asset['assetID'])
                 self.assertTrue(kvs.get_client().get(loss_ratio_key))
@@ -1074,14 +1152,16 @@ class ClassicalPSHABasedTestCase(unittest.TestCase, helpers.DbTestCase):
 
         calculator.compute_risk(self.block_id)
 
-        result_key = kvs.tokens.bcr_block_key(self.job_id, self.block_id)
-        res = kvs.get_value_json_decoded(result_key)
-        expected_result = {'bcr': 0.0,
-                           'eal_original': 0.003032,
-                           'eal_retrofitted': 0.003032}
+        res = load_bcr_block(self.job_id, self.block_id)
+        expected_result = {'lat': [12.34], 'lon': [56.67],
+                           'assetID': [22.61],
+                           'bcr': [0.0],
+                           'eal_original': [0.003032],
+                           'eal_retrofitted': [0.003032]}
         helpers.assertDeepAlmostEqual(
-            self, res, [[[12.34, 56.67], [[expected_result, 22.61]]]]
-        )
+            self, dict((field, values.tolist())
+                       for field, values in res.iteritems()),
+            expected_result)
 
     def test_splits_with_real_values_from_turkey(self):
         loss_ratios = [0.0, 1.96E-15, 2.53E-12, 8.00E-10, 8.31E-08, 3.52E-06,
@@ -1196,6 +1276,20 @@ class ClassicalPSHABasedTestCase(unittest.TestCase, helpers.DbTestCase):
         self.assertAlmostEqual(0.023305,
                                compute_mean_loss(loss_ratio_curve), 3)
 
+    def test_mean_loss_matches_the_mid_curves(self):
+        loss_ratio_curve = shapes.Curve([(0, 0.3460), (0.06, 0.12),
+                (0.12, 0.057), (0.18, 0.04),
+                (0.24, 0.019), (0.3, 0.009), (0.45, 0)])
+
+        mid_curve = _compute_mid_po(_compute_mid_mean_pe(loss_ratio_curve))
+
+        self.assertAlmostEqual(
+            sum(mid_curve.abscissae * mid_curve.ordinates),
+            compute_mean_loss(loss_ratio_curve))
+        self.assertAlmostEqual(
+            10 * compute_mean_loss(loss_ratio_curve),
+            compute_mean_loss(loss_ratio_curve.rescale_abscissae(10)))
+
 
 class ScenarioEventBasedTestCase(unittest.TestCase):
 
@@ -1212,39 +1306,46 @@ class ScenarioEventBasedTestCase(unittest.TestCase):
         self.gmfs = {"IMLs": (0.1576, 0.9706, 0.9572, 0.4854, 0.8003,
                      0.1419, 0.4218, 0.9157, 0.7922, 0.9595)}
 
+    def _asset_loss_statistics(self, asset):
+        """The statistics of the losses of the given asset, as computed by
+        the scenario tasks."""
+        epsilon_provider = EpsilonProvider(asset, self.epsilons)
+        calculator = scenario.SumPerGroundMotionField(
+            {"ID": self.vuln_function}, epsilon_provider)
+
+        stats = scenario.LossStatistics()
+        stats.update(calculator.add(self.gmfs, asset))
+
+        return stats
+
     def test_computes_the_mean_loss_from_loss_ratios(self):
-        asset = {"assetValue": 1000}
         loss_ratios = numpy.array([0.20, 0.05, 0.10, 0.05, 0.10])
 
-        self.assertEqual(100, scenario._mean_loss_from_loss_ratios(
-                         loss_ratios, asset))
+        stats = scenario.LossStatistics()
+        stats.update(loss_ratios * 1000)
+
+        self.assertTrue(numpy.allclose(100, stats.mean))
 
     def test_computes_the_mean_loss(self):
-        asset = {"assetValue": 10}
-        epsilon_provider = EpsilonProvider(asset, self.epsilons)
+        asset = {"assetValue": 10, "taxonomy": "ID"}
 
         self.assertTrue(numpy.allclose(2.4887999999999999,
-                        scenario.compute_mean_loss(
-                            self.vuln_function, self.gmfs, epsilon_provider,
-                            asset),
+                        self._asset_loss_statistics(asset).mean,
                         atol=0.0001))
 
     def test_computes_the_stddev_loss_from_loss_ratios(self):
-        asset = {"assetValue": 1000}
         loss_ratios = numpy.array([0.20, 0.05, 0.10, 0.05, 0.10])
 
-        self.assertTrue(numpy.allclose(61.237,
-                        scenario._stddev_loss_from_loss_ratios(
-                        loss_ratios, asset), atol=0.001))
+        stats = scenario.LossStatistics()
+        stats.update(loss_ratios * 1000)
+
+        self.assertTrue(numpy.allclose(61.237, stats.stddev, atol=0.001))
 
     def test_computes_the_stddev_loss(self):
-        asset = {"assetValue": 10}
-        epsilon_provider = EpsilonProvider(asset, self.epsilons)
+        asset = {"assetValue": 10, "taxonomy": "ID"}
 
         self.assertTrue(numpy.allclose(1.631,
-                        scenario.compute_stddev_loss(
-                            self.vuln_function, self.gmfs, epsilon_provider,
-                            asset),
+                        self._asset_loss_statistics(asset).stddev,
                         atol=0.002))
 
     def test_calls_the_loss_ratios_calculator_correctly(self):
@@ -1352,6 +1453,39 @@ class ScenarioEventBasedTestCase(unittest.TestCase):
         # still None, no losses are added
         self.assertTrue(numpy.allclose([], calculator.losses))
 
+    def test_add_returns_the_asset_losses(self):
+        vuln_model = {"ID": self.vuln_function}
+        asset = {"assetValue": 100, "taxonomy": "ID"}
+
+        calculator = scenario.SumPerGroundMotionField(
+            vuln_model, None,
+            lr_calculator=lambda *_: numpy.array([0.1, 0.2]))
+
+        self.assertTrue(numpy.allclose(
+            [10.0, 20.0], calculator.add(None, asset)))
+
+    def test_loss_statistics_match_the_batch_statistics(self):
+        losses = numpy.array(
+            [62.63191284, 98.16576808, 166.2920523, 84.25372286, 23.10280904])
+
+        stats = scenario.LossStatistics()
+        stats.update(losses[:2])
+        stats.update(numpy.array([]))
+
+        other = scenario.LossStatistics()
+        other.update(losses[2:])
+        stats.merge(other)
+
+        self.assertEqual(5, stats.count)
+        self.assertTrue(numpy.allclose(86.88925302, stats.mean))
+        self.assertTrue(numpy.allclose(52.66886967, stats.stddev))
+
+    def test_loss_statistics_stddev_needs_two_values(self):
+        stats = scenario.LossStatistics()
+        stats.update(numpy.array([1.0]))
+
+        self.assertTrue(numpy.isnan(stats.stddev))
+
 
 class RiskCommonTestCase(unittest.TestCase):
 
@@ -1377,22 +1511,20 @@ class RiskJobGeneralTestCase(unittest.TestCase):
 
     def _prepare_bcr_result(self):
         self.job.blocks_keys = [19, 20]
-        kvs.set_value_json_encoded(kvs.tokens.bcr_block_key(self.job_id, 19), [
-            ((19.0, -1.1), [
-                ({'bcr': 35.1, 'eal_original': 12.34, 'eal_retrofitted': 4},
-                 'assetID-191'),
-                ({'bcr': 35.2, 'eal_original': 2.5, 'eal_retrofitted': 2.2},
-                 'assetID-192'),
-            ])
-        ])
-        kvs.set_value_json_encoded(kvs.tokens.bcr_block_key(self.job_id, 20), [
-            ((20.0, 2.3), [
-                ({'bcr': 35.1, 'eal_original': 1.23, 'eal_retrofitted': 0.3},
-                 'assetID-201'),
-                ({'bcr': 35.2, 'eal_original': 4, 'eal_retrofitted': 0.4},
-                 'assetID-202'),
-            ])
-        ])
+        store_bcr_block(self.job_id, 19, {
+            'lat': numpy.array([19.0, 19.0]),
+            'lon': numpy.array([-1.1, -1.1]),
+            'assetID': numpy.array(['assetID-191', 'assetID-192']),
+            'eal_original': numpy.array([12.34, 2.5]),
+            'eal_retrofitted': numpy.array([4.0, 2.2]),
+            'bcr': numpy.array([35.1, 35.2])})
+        store_bcr_block(self.job_id, 20, {
+            'lat': numpy.array([20.0, 20.0]),
+            'lon': numpy.array([2.3, 2.3]),
+            'assetID': numpy.array(['assetID-201', 'assetID-202']),
+            'eal_original': numpy.array([1.23, 4.0]),
+            'eal_retrofitted': numpy.array([0.3, 0.4]),
+            'bcr': numpy.array([35.1, 35.2])})
 
     def test_asset_bcr_per_site(self):
         self._make_job({})
@@ -1403,19 +1535,56 @@ class RiskJobGeneralTestCase(unittest.TestCase):
         bcr_per_site = calc.asset_bcr_per_site()
         self.assertEqual(bcr_per_site, [
             (shapes.Site(-1.1, 19.0), [
-                [{u'bcr': 35.1, 'eal_original': 12.34, 'eal_retrofitted': 4},
-                 u'assetID-191'],
-                [{u'bcr': 35.2, 'eal_original': 2.5, 'eal_retrofitted': 2.2},
-                 u'assetID-192']
+                ({'bcr': 35.1, 'eal_original': 12.34, 'eal_retrofitted': 4.0},
+                 'assetID-191'),
+                ({'bcr': 35.2, 'eal_original': 2.5, 'eal_retrofitted': 2.2},
+                 'assetID-192')
             ]),
             (shapes.Site(2.3, 20.0), [
-                [{u'bcr': 35.1, 'eal_original': 1.23, 'eal_retrofitted': 0.3},
-                 u'assetID-201'],
-                [{u'bcr': 35.2, 'eal_original': 4, 'eal_retrofitted': 0.4},
-                 u'assetID-202']
+                ({'bcr': 35.1, 'eal_original': 1.23, 'eal_retrofitted': 0.3},
+                 'assetID-201'),
+                ({'bcr': 35.2, 'eal_original': 4.0, 'eal_retrofitted': 0.4},
+                 'assetID-202')
             ])
         ])
 
+    def test_compute_bcr_for_block(self):
+        self._make_job({})
+
+        vuln_function = shapes.VulnerabilityFunction(
+            [0.1, 0.2], [0.05, 0.5], [0.0, 0.0])
+        retrofitted = shapes.VulnerabilityFunction(
+            [0.1, 0.2], [0.01, 0.1], [0.0, 0.0])
+        vulnerability.store_vuln_model(self.job_id, {"ID": vuln_function})
+        vulnerability.store_vuln_model(
+            self.job_id, {"ID": retrofitted}, retrofitted=True)
+
+        point = shapes.GridPoint(None, 2, 1)
+        block_assets = BlockAssets.from_assets(
+            (point, {"taxonomy": "ID", "assetID": asset_id,
+                     "assetValue": value, "retrofittingCost": 2.0,
+                     "lat": 1.0, "lon": 2.0})
+            for asset_id, value in (("a1", 10.0), ("a2", 20.0)))
+
+        calls = []
+
+        def get_mean_loss_ratios(_point, function, assets):
+            calls.append(len(assets))
+            return 0.1 if function == retrofitted else 0.5
+
+        result = compute_bcr_for_block(
+            self.job_id, [point], block_assets, get_mean_loss_ratios, 0.05, 50)
+
+        # one call per taxonomy, not per asset
+        self.assertEqual([2, 2], calls)
+        self.assertEqual(["a1", "a2"], result["assetID"].tolist())
+        self.assertTrue(numpy.allclose([5.0, 10.0], result["eal_original"]))
+        self.assertTrue(numpy.allclose(
+                [1.0, 2.0], result["eal_retrofitted"]))
+        self.assertTrue(numpy.allclose(
+                [compute_bcr(5.0, 1.0, 0.05, 50, 2.0),
+                 compute_bcr(10.0, 2.0, 0.05, 50, 2.0)], result["bcr"]))
+
     def test_write_output_bcr(self):
         self._make_job({})
         self._prepare_bcr_result()
@@ -1439,7 +1608,7 @@ class RiskJobGeneralTestCase(unittest.TestCase):
         </site>
         <benefitCostRatioValue assetRef="assetID-191">
           <expectedAnnualLossOriginal>12.34</expectedAnnualLossOriginal>
-          <expectedAnnualLossRetrofitted>4</expectedAnnualLossRetrofitted>
+          <expectedAnnualLossRetrofitted>4.0</expectedAnnualLossRetrofitted>
           <benefitCostRatio>35.1</benefitCostRatio>
         </benefitCostRatioValue>
         <benefitCostRatioValue assetRef="assetID-192">
@@ -1460,7 +1629,7 @@ class RiskJobGeneralTestCase(unittest.TestCase):
           <benefitCostRatio>35.1</benefitCostRatio>
         </benefitCostRatioValue>
         <benefitCostRatioValue assetRef="assetID-202">
-          <expectedAnnualLossOriginal>4</expectedAnnualLossOriginal>
+          <expectedAnnualLossOriginal>4.0</expectedAnnualLossOriginal>
           <expectedAnnualLossRetrofitted>0.4</expectedAnnualLossRetrofitted>
           <benefitCostRatio>35.2</benefitCostRatio>
         </benefitCostRatioValue>
@@ -22,6 +22,7 @@ This module tests the risk side of the scenario event based calculation.
 """
 
 import json
+import numpy
 import unittest
 
 from openquake import kvs
@@ -74,54 +75,50 @@ class ScenarioRiskTestCase(unittest.TestCase):
 
         self.assertEqual(expected_gmvs, actual_gmvs)
 
-    def test_load_assets_for_point(self):
-        """
-        Exercises the function
-        :py:func:`openquake.risk.job.scenario.load_assets_for_point`.
-        """
-
+    def test_load_gmvs_for_point_in_batches(self):
         kvs.get_client().flushall()
 
-        # Fabricate some test data.
-        test_assets = [
-            {'assetValue': 2129.5,
-             'assetID': '104',
-             'listDescription': 'fake_description',
-             'structureCategory': 'S4L_MC',
-             'lon': 0.11,
-             'taxonomy': 'HAZUS_S4L_MC',
-             'listID': 'LA01',
-             'assetValueUnit': 'EUR',
-             'lat': 0.11},
-            {'assetValue': 2229.5,
-             'assetID': '105',
-             'listDescription': 'fake_description',
-             'structureCategory': 'S4L_MC',
-             'lon': 0.11,
-             'taxonomy': 'HAZUS_S4L_MC',
-             'listID': 'LA02',
-             'assetValueUnit': 'EUR',
-             'lat': 0.12}]
-
-        test_site = shapes.Site(0.1, 0.1)
-        test_point = TEST_REGION.grid.point_at(test_site)
-
-        encoder = json.JSONEncoder()
-
-        assets_key = kvs.tokens.asset_key(
-            TEST_JOB_ID, test_point.row, test_point.column)
-
-        # Throw the test data into the KVS.
-        for asset in test_assets:
-            kvs.get_client().rpush(assets_key, encoder.encode(asset))
-
-        # The data should now be in the KVS.
-        # Now verify that the load_assets_for_point function returns
-        # the appropriate data.
-        actual_assets = (
-            scenario_core.load_assets_for_point(TEST_JOB_ID, test_point))
+        test_point = TEST_REGION.grid.point_at(shapes.Site(0.1, 0.2))
+        gmvs_key = kvs.tokens.ground_motion_values_key(TEST_JOB_ID, test_point)
+
+        for mag in (0.117, 0.167, 0.542, 0.231, 0.318):
+            kvs.get_client().rpush(gmvs_key, json.JSONEncoder().encode(
+                {'site_lon': 0.1, 'site_lat': 0.2, 'mag': mag}))
+
+        first = scenario_core.load_gmvs_for_point(
+            TEST_JOB_ID, test_point, 0, 2)
+        middle = scenario_core.load_gmvs_for_point(
+            TEST_JOB_ID, test_point, 2, 2)
+        last = scenario_core.load_gmvs_for_point(
+            TEST_JOB_ID, test_point, 4, 2)
 
         kvs.get_client().flushall()
 
-        # They should come out exactly the way they went in.
-        self.assertEqual(test_assets, actual_assets)
+        self.assertEqual([0.117, 0.167], first)
+        self.assertEqual([0.542, 0.231], middle)
+        self.assertEqual([0.318], last)
+
+    def test_collect_region_data_merges_the_batches(self):
+        site = shapes.Site(0.1, 0.2)
+        losses = numpy.array(
+            [62.63191284, 98.16576808, 166.2920523, 84.25372286, 23.10280904])
+
+        region_loss_map_data = {}
+
+        for batch in (losses[:2], losses[2:]):
+            stats = scenario_core.LossStatistics()
+            stats.update(batch)
+            scenario_core.collect_region_data(
+                {site: {'a1': stats}}, region_loss_map_data)
+
+        other = scenario_core.LossStatistics()
+        other.update(losses)
+        scenario_core.collect_region_data(
+            {site: {'a2': other}}, region_loss_map_data)
+
+        self.assertEqual(['a1', 'a2'], list(region_loss_map_data[site]))
+
+        stats = region_loss_map_data[site]['a1']
+        self.assertEqual(5, stats.count)
+        self.assertTrue(numpy.allclose(86.88925302, stats.mean))
+        self.assertTrue(numpy.allclose(52.66886967, stats.stddev))
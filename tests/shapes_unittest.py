@@ -18,6 +18,7 @@
 # <http://www.gnu.org/licenses/lgpl-3.0.txt> for a copy of the LGPLv3 License.
 
 
+import cPickle
 import decimal
 import json
 import numpy
@@ -93,6 +94,10 @@ class ShapesTestCase(unittest.TestCase):
         # reset the global context so we don't potentially screw up other tests
         decimal.getcontext().rounding = decimal.ROUND_HALF_EVEN
 
+    def test_round_float_returns_a_float(self):
+        for value in (29.5, numpy.float64(29.5), numpy.float64(29.00000006)):
+            self.assertTrue(type(round_float(value)) is float)
+
     def test_simple_region_uses_round_floats(self):
         """
         This test ensures the coordinate precision is properly limited for
@@ -329,6 +334,76 @@ class CurveTestCase(unittest.TestCase):
         self.assertEqual(2.0, curve.ordinate_for(0.4))
         self.assertEqual(2.0, curve.ordinate_for(0.3))
 
+    def test_can_construct_from_arrays(self):
+        curve = shapes.Curve.from_arrays([0.5, 0.4, 0.3], [1.0, 2.0, 3.0])
+
+        self.assertEqual(
+            shapes.Curve([(0.5, 1.0), (0.4, 2.0), (0.3, 3.0)]), curve)
+        self.assertEqual([0.3, 0.4, 0.5], curve.abscissae.tolist())
+
+    def test_curves_are_immutable(self):
+        curve = shapes.Curve([(0.1, 1.0), (0.2, 2.0)])
+
+        self.assertRaises(ValueError, curve.ordinates.__setitem__, 0, 5.0)
+        self.assertRaises(ValueError, curve.abscissae.__setitem__, 0, 5.0)
+
+    def test_rescale_abscissae(self):
+        curve = self.simple_curve.rescale_abscissae(2.0)
+
+        self.assertEqual([2.0, 4.0, 6.0], curve.abscissae.tolist())
+        self.assertEqual(self.y_vals, curve.ordinates.tolist())
+        self.assertEqual(9.0, curve.ordinate_for(6.0))
+
+    def test_abscissa_for_a_decreasing_curve(self):
+        curve = shapes.Curve([(1.0, 0.9), (2.0, 0.5), (3.0, 0.1)])
+
+        self.assertEqual(2.5, curve.abscissa_for(0.3))
+        self.assertEqual([1.0, 3.0], curve.abscissa_for([0.9, 0.1]).tolist())
+
+    def test_binary_serialization_keeps_the_precision(self):
+        curve = shapes.Curve([(0.1 / 3, 1.0 / 3), (0.2, 2.0)])
+        curve.ordinate_for(0.1)
+
+        self.assertEqual(curve.abscissae.tolist(), shapes.Curve.from_binary(
+            curve.to_binary()).abscissae.tolist())
+        self.assertEqual(curve.ordinates.tolist(), shapes.Curve.from_binary(
+            curve.to_binary()).ordinates.tolist())
+
+
+class CurveSetTestCase(unittest.TestCase):
+    """
+    Tests for :py:class:`openquake.shapes.CurveSet`.
+    """
+
+    def setUp(self):
+        self.curves = [shapes.Curve([(1.0, 0.9), (2.0, 0.5), (4.0, 0.1)]),
+                       shapes.Curve([(1.0, 1.0), (2.0, 2.0), (4.0, 6.0)])]
+        self.curve_set = shapes.CurveSet.from_curves(self.curves)
+
+    def test_curves_can_be_extracted(self):
+        self.assertEqual(2, len(self.curve_set))
+        self.assertEqual(self.curves, list(self.curve_set))
+        self.assertEqual(self.curves[1], self.curve_set[1])
+
+    def test_ordinates_for(self):
+        x_values = [0.5, 1.0, 1.5, 3.0, 4.0, 5.0]
+
+        self.assertTrue(allclose(
+            [curve.ordinate_for(x_values) for curve in self.curves],
+            self.curve_set.ordinates_for(x_values)))
+        self.assertTrue(allclose(
+            [0.3, 4.0], self.curve_set.ordinates_for(3.0)))
+
+    def test_abscissae_are_sorted(self):
+        curve_set = shapes.CurveSet(
+            [4.0, 1.0, 2.0], [[0.1, 0.9, 0.5], [6.0, 1.0, 2.0]])
+
+        self.assertEqual(self.curves, list(curve_set))
+
+    def test_curves_must_share_the_abscissae(self):
+        self.assertRaises(AssertionError, shapes.CurveSet.from_curves,
+                          [self.curves[0], self.curves[0].rescale_abscissae(2)])
+
 
 class VulnerabilityFunctionTestCase(unittest.TestCase):
     """
@@ -425,9 +500,9 @@ class VulnerabilityFunctionTestCase(unittest.TestCase):
 
         vuln_curve = shapes.VulnerabilityFunction.from_dict(test_dict)
 
-        self.assertEqual([0.005, 0.007, 0.0098], vuln_curve._imls)
-        self.assertEqual([0.1, 0.3, 0.5], vuln_curve._loss_ratios)
-        self.assertEqual([0.2, 0.4, 0.6], vuln_curve._covs)
+        self.assertEqual([0.005, 0.007, 0.0098], vuln_curve.imls.tolist())
+        self.assertEqual([0.1, 0.3, 0.5], vuln_curve.loss_ratios.tolist())
+        self.assertEqual([0.2, 0.4, 0.6], vuln_curve.covs.tolist())
 
     def test_from_json(self):
         """
@@ -439,9 +514,9 @@ class VulnerabilityFunctionTestCase(unittest.TestCase):
 
         vuln_curve = shapes.VulnerabilityFunction.from_json(vuln_func_json)
 
-        self.assertEqual([0.005, 0.007, 0.0098], vuln_curve._imls)
-        self.assertEqual([0.1, 0.3, 0.5], vuln_curve._loss_ratios)
-        self.assertEqual([0.2, 0.4, 0.6], vuln_curve._covs)
+        self.assertEqual([0.005, 0.007, 0.0098], vuln_curve.imls.tolist())
+        self.assertEqual([0.1, 0.3, 0.5], vuln_curve.loss_ratios.tolist())
+        self.assertEqual([0.2, 0.4, 0.6], vuln_curve.covs.tolist())
 
     def test_to_json(self):
         """
@@ -598,6 +673,12 @@ class VulnerabilityFunctionTestCase(unittest.TestCase):
         # Test non-empty function:
         self.assertFalse(self.test_func.is_empty)
 
+    def test_empty_function_can_not_be_interpolated(self):
+        empty_func = shapes.VulnerabilityFunction([], [], [])
+
+        self.assertRaises(AssertionError, empty_func.loss_ratio_for, 0.1)
+        self.assertRaises(AssertionError, empty_func.cov_for, 0.1)
+
     def test_iter(self):
         """
         Test iterability of a vulnerability function.
@@ -609,6 +690,77 @@ class VulnerabilityFunctionTestCase(unittest.TestCase):
 
         self.assertEqual(expected, actual)
 
+    def test_values_are_read_only(self):
+        imls = list(self.IMLS_GOOD)
+        func = shapes.VulnerabilityFunction(
+            imls, self.LOSS_RATIOS_GOOD, self.COVS_GOOD)
+
+        # the input values are copied
+        imls[0] = 0.001
+        self.assertEqual(0.005, func.imls[0])
+
+        self.assertRaises(ValueError, func.imls.__setitem__, 0, 0.1)
+        self.assertRaises(ValueError, func.loss_ratios.__setitem__, 0, 0.1)
+        self.assertRaises(ValueError, func.covs.__setitem__, 0, 0.1)
+
+    def test_lognormal_parameters(self):
+        for i, (_, loss_ratio, cov) in enumerate(self.test_func):
+            if loss_ratio <= 0.0:
+                continue
+
+            variance = (loss_ratio * cov) ** 2.0
+
+            self.assertAlmostEqual(numpy.sqrt(numpy.log(
+                (variance / loss_ratio ** 2.0) + 1.0)),
+                self.test_func.sigmas[i])
+            self.assertAlmostEqual(numpy.log(loss_ratio ** 2.0 /
+                numpy.sqrt(variance + loss_ratio ** 2.0)),
+                self.test_func.mus[i])
+
+    def test_sample_loss_ratios(self):
+        imls = [0.001, 0.006, 0.0098, 0.02, 0.03]
+        epsilons = [0.5, -0.5, 1.0, 0.2, -1.0]
+
+        expected = []
+
+        for iml, epsilon in zip(imls, epsilons):
+            mean_ratio = self.test_func.loss_ratio_for(iml)
+            cov = self.test_func.cov_for(iml)
+
+            if mean_ratio <= 0.0:
+                expected.append(0.0)
+                continue
+
+            variance = (mean_ratio * cov) ** 2.0
+            sigma = numpy.sqrt(numpy.log((variance / mean_ratio ** 2.0) + 1.0))
+            mu = numpy.log(
+                mean_ratio ** 2.0 / numpy.sqrt(variance + mean_ratio ** 2.0))
+
+            expected.append(numpy.exp(mu + epsilon * sigma))
+
+        self.assertTrue(allclose(expected,
+            self.test_func.sample_loss_ratios(imls, epsilons)))
+        self.assertEqual(0.0,
+            self.test_func.sample_loss_ratios(imls, epsilons)[2])
+
+    def test_sample_loss_ratios_with_the_interpolated_means(self):
+        imls = [0.001, 0.006, 0.0098, 0.02, 0.03]
+        epsilons = [0.5, -0.5, 1.0, 0.2, -1.0]
+
+        self.assertTrue(allclose(
+            self.test_func.sample_loss_ratios(imls, epsilons),
+            self.test_func.sample_loss_ratios(
+                imls, epsilons, self.test_func.loss_ratio_for(imls))))
+
+    def test_pickle(self):
+        func = cPickle.loads(cPickle.dumps(self.test_func, 2))
+
+        self.assertEqual(self.test_func, func)
+        self.assertTrue(allclose(self.test_func.sigmas[:2], func.sigmas[:2]))
+        # the pickled state is deterministic, to memoize on it
+        self.assertEqual(cPickle.dumps(self.test_func, 1),
+                         cPickle.dumps(func, 1))
+
 
 class SiteTestCase(unittest.TestCase):
     """
@@ -700,6 +852,80 @@ class SiteTestCase(unittest.TestCase):
 
         self.assertEqual(site1.__hash__(), site2.__hash__())
 
+    def test_hash_is_stable(self):
+        """
+        The site hashes are used in KVS keys, they must not depend on the
+        process computing them.
+        """
+        self.assertEqual((-1210000000 << 32) + 290000001,
+                         hash(shapes.Site(-121.0, 29.0000001)))
+
+    def test_point_is_built_on_demand(self):
+        site = shapes.Site(-121.0, 29.0000001)
+
+        self.assertEqual((-121.0, 29.0000001), (site.point.x, site.point.y))
+        self.assertIs(site.point, site.point)
+
+    def test_sites_can_be_pickled(self):
+        site = shapes.Site(-121.0, 29.0000001)
+        site.point
+
+        for protocol in range(cPickle.HIGHEST_PROTOCOL + 1):
+            copy = cPickle.loads(cPickle.dumps(site, protocol))
+            self.assertEqual(site, copy)
+            self.assertEqual(hash(site), hash(copy))
+
+
+class SiteCollectionTestCase(unittest.TestCase):
+    """
+    Tests for the :py:class:`openquake.shapes.SiteCollection` class.
+    """
+
+    def setUp(self):
+        self.sites = [shapes.Site(10.0, 20.0), shapes.Site(10.1, 20.0),
+                      shapes.Site(10.2, 20.1)]
+        self.collection = shapes.SiteCollection.from_sites(self.sites)
+
+    def test_behaves_like_a_list_of_sites(self):
+        self.assertEqual(3, len(self.collection))
+        self.assertEqual(self.sites, list(self.collection))
+        self.assertEqual(self.sites, self.collection)
+        self.assertEqual(self.sites[1], self.collection[1])
+        self.assertEqual(self.sites[-1], self.collection[-1])
+
+    def test_slices_are_collections(self):
+        collection = shapes.SiteCollection(
+            [10.0, 10.1, 10.2], [20.0, 20.0, 20.1], vs30=[760, 800, 560])
+        block = collection[1:]
+
+        self.assertTrue(isinstance(block, shapes.SiteCollection))
+        self.assertEqual(self.sites[1:], block)
+        self.assertEqual([800, 560], block.vs30.tolist())
+        self.assertTrue(block.rows is None)
+
+    def test_unknown_site_arrays(self):
+        self.assertRaises(TypeError, shapes.SiteCollection,
+                          [10.0], [20.0], vs31=[760])
+
+    def test_pickling(self):
+        collection = cPickle.loads(
+            cPickle.dumps(self.collection, cPickle.HIGHEST_PROTOCOL))
+        self.assertEqual(self.collection, collection)
+
+    def test_grid_site_collection(self):
+        region = shapes.Region.from_coordinates(
+            [(10.0, 10.0), (100.0, 10.0), (10.0, 100.0)])
+        region.cell_size = 10.0
+
+        collection = region.grid.site_collection()
+        points = list(region.grid)
+
+        self.assertEqual(region.sites, collection)
+        self.assertEqual([point.row for point in points],
+                         collection.rows.tolist())
+        self.assertEqual([point.column for point in points],
+                         collection.columns.tolist())
+
 
 class ShapesUtilsTestCase(unittest.TestCase):
     '''
@@ -840,6 +1066,87 @@ class GridTestCase(unittest.TestCase):
         constraint.cell_size = 0.02
         self._test_expected_points(constraint.grid)
 
+    def test_grid_iterates_the_points_in_a_triangle(self):
+        region = shapes.Region.from_coordinates(
+            [(10.0, 10.0), (100.0, 10.0), (10.0, 100.0)])
+        region.cell_size = 10.0
+
+        expected = []
+        for row in range(region.grid.rows):
+            for column in range(region.grid.columns):
+                point = shapes.GridPoint(region.grid, column, row)
+                if region.polygon.intersects(point.site.point):
+                    expected.append((row, column))
+
+        self.assertEqual(
+            expected, [(grid_point.row, grid_point.column)
+                       for grid_point in region.grid])
+        # the hypotenuse is part of the region
+        self.assertTrue((9, 0) in expected and (0, 9) in expected)
+        self.assertFalse((9, 9) in expected)
+
+    def test_cells_at_rounds_like_point_at(self):
+        constraint = shapes.RegionConstraint.from_simple(
+            (-118.3, 34.0), (-118.18, 34.12))
+        constraint.cell_size = 0.02
+        grid = constraint.grid
+
+        sites = [point.site for point in grid]
+        # half a cell away from the grid points
+        sites.append(shapes.Site(-118.29, 34.01))
+
+        rows, columns = grid.cells_at([site.longitude for site in sites],
+                                      [site.latitude for site in sites])
+
+        self.assertEqual(
+            [(grid.point_at(site).row, grid.point_at(site).column)
+             for site in sites], zip(rows.tolist(), columns.tolist()))
+
+    def test_on_grid(self):
+        constraint = shapes.RegionConstraint.from_simple(
+            (-118.3, 34.0), (-118.18, 34.12))
+        constraint.cell_size = 0.02
+        grid = constraint.grid
+
+        # grid corners, half a cell inside and outside, mirrored latitude
+        longitudes = [-118.3, -118.18, -118.309, -118.311, -118.169, -118.3]
+        latitudes = [34.0, 34.12, 33.991, 34.0, 34.12, 33.96]
+
+        self.assertEqual([True, True, True, False, False, False],
+                         grid.on_grid(longitudes, latitudes).tolist())
+
+    def test_rasterize_a_polygon_with_a_hole(self):
+        polygon = shapes.geometry.Polygon(
+            [(0.0, 0.0), (4.0, 0.0), (4.0, 4.0), (2.0, 2.5), (0.0, 4.0)],
+            [[(0.5, 0.5), (1.5, 0.5), (1.5, 1.5), (0.5, 1.5)]])
+        region = shapes.Region(polygon)
+        region.cell_size = 0.25
+        grid = region.grid
+
+        expected = []
+        for row in range(grid.rows):
+            for column in range(grid.columns):
+                site = shapes.GridPoint(grid, column, row).site
+                if polygon.intersects(site.point):
+                    expected.append((row, column, site))
+
+        rows, columns, lons, lats = grid.rasterize()
+
+        self.assertEqual(expected, [
+            (row, column, shapes.Site(lon, lat)) for row, column, lon, lat
+            in zip(rows, columns, lons, lats)])
+        # computed once
+        self.assertIs(grid.rasterize(), grid.rasterize())
+
+    def test_grid_points_can_be_pickled(self):
+        region = shapes.Region.from_simple((10.0, 20.0), (20.0, 10.0))
+        point = shapes.GridPoint(region.grid, 2, 3)
+
+        for protocol in range(cPickle.HIGHEST_PROTOCOL + 1):
+            copy = cPickle.loads(cPickle.dumps(point, protocol))
+            self.assertEqual((2, 3), (copy.column, copy.row))
+            self.assertEqual(point.site, copy.site)
+
 
 class RegionTestCase(unittest.TestCase):
     INSIDE = [(50, 50),
@@ -872,6 +1179,42 @@ class RegionTestCase(unittest.TestCase):
             (10.0, 10.0), (100.0, 100.0))
         self._check_match(constraint)
 
+    def test_covers_all_agrees_with_the_polygon(self):
+        constraint = shapes.RegionConstraint.from_coordinates(
+            [(10.0, 10.0), (100.0, 10.0), (55.0, 100.0)])
+
+        lons = numpy.linspace(0.0, 110.0, 23)
+        lats = numpy.linspace(0.0, 110.0, 23)
+        lons, lats = [coords.ravel() for coords in numpy.meshgrid(lons, lats)]
+
+        expected = [constraint.polygon.contains(shapes.Point(lon, lat))
+                    or constraint.polygon.touches(shapes.Point(lon, lat))
+                    for lon, lat in zip(lons, lats)]
+
+        self.assertEqual(expected, list(constraint.covers_all(lons, lats)))
+        self.assertEqual(expected, [constraint.match((lon, lat))
+                                    for lon, lat in zip(lons, lats)])
+
+    def test_filter_sites(self):
+        constraint = shapes.RegionConstraint.from_coordinates(
+            [(10.0, 10.0), (100.0, 10.0), (55.0, 100.0)])
+        inside = [shapes.Site(55.0, 50.0), shapes.Site(10.0, 10.0)]
+        outside = [shapes.Site(11.0, 99.0), shapes.Site(5.0, 50.0)]
+
+        self.assertEqual(inside, constraint.filter_sites(
+            [outside[0], inside[0], outside[1], inside[1]]))
+        self.assertEqual([(inside[0], "a")], constraint.filter_sites(
+            [(inside[0], "a"), (outside[0], "b")], key=lambda pair: pair[0]))
+
+    def test_region_can_be_pickled_once_prepared(self):
+        constraint = shapes.RegionConstraint.from_coordinates(
+            [(10.0, 10.0), (100.0, 10.0), (55.0, 100.0)])
+        self.assertTrue(constraint.match((55.0, 50.0)))
+
+        constraint = cPickle.loads(cPickle.dumps(constraint))
+        self.assertTrue(constraint.match((55.0, 50.0)))
+        self.assertFalse(constraint.match((11.0, 99.0)))
+
     def test_bounding_box(self):
         switzerland = shapes.Region.from_coordinates(
             [(10.0, 100.0), (100.0, 100.0), (100.0, 10.0), (10.0, 10.0)])
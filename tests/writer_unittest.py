@@ -22,6 +22,7 @@ Tests related to the various Writer base classes.
 
 from collections import namedtuple
 import mock
+import threading
 import unittest
 
 from openquake import writer
@@ -94,3 +95,86 @@ class FileWriterTestCase(unittest.TestCase):
             fw.mode = self.SerializerMode(False, False, True)
             fw.open()
             self.assertEqual((path, "w"), mock_open.call_args[0])
+
+
+class ResultSinkTestCase(unittest.TestCase):
+    """Tests related to the `ResultSink` class."""
+
+    class Writer(object):
+        """Record the batches serialized and the thread serializing them."""
+
+        def __init__(self, fail=False):
+            self.fail = fail
+            self.batches = []
+
+        def serialize(self, items):
+            if self.fail:
+                raise ValueError("cannot serialize %s" % items)
+
+            self.batches.append((items, threading.current_thread().name))
+
+    def setUp(self):
+        self.sink = writer.ResultSink(workers=2, queue_size=1)
+
+    def tearDown(self):
+        try:
+            self.sink.close()
+        except ValueError:
+            pass
+
+    def test_batches_are_serialized_in_order(self):
+        writers = [self.Writer(), self.Writer()]
+
+        for i in xrange(10):
+            for artifact, w in enumerate(writers):
+                self.sink.submit(artifact, w, i)
+
+        self.sink.flush()
+
+        for w in writers:
+            self.assertEqual(range(10), [items for items, _ in w.batches])
+            # all the batches of an artifact go to the same worker
+            self.assertEqual(1, len(set(name for _, name in w.batches)))
+            self.assertNotEqual(threading.current_thread().name,
+                                w.batches[0][1])
+
+    def test_prepare_is_called_before_serializing(self):
+        w = self.Writer()
+        prepare = mock.Mock(
+            side_effect=lambda: self.assertEqual([], w.batches))
+
+        self.sink.submit("a.xml", w, [1], prepare)
+        self.sink.close()
+
+        self.assertEqual(1, prepare.call_count)
+        self.assertEqual([[1]], [items for items, _ in w.batches])
+
+    def test_nothing_is_done_without_a_writer(self):
+        self.sink.submit("a.xml", None, [1])
+
+        self.assertEqual([], self.sink._threads)
+
+    def test_errors_are_raised_in_the_caller(self):
+        w = self.Writer(fail=True)
+
+        self.sink.submit("a.xml", w, [1])
+        self.assertRaises(ValueError, self.sink.flush)
+
+        # the error is raised only once, and the following batches of the
+        # artifact are discarded
+        w.fail = False
+        self.sink.submit("a.xml", w, [2])
+        self.sink.flush()
+
+        self.assertEqual([], w.batches)
+
+    def test_close_stops_the_workers(self):
+        w = self.Writer()
+
+        self.sink.submit("a.xml", w, [1])
+        threads = list(self.sink._threads)
+        self.sink.close()
+
+        self.assertEqual([[1]], [items for items, _ in w.batches])
+        self.assertFalse(any(thread.is_alive() for thread in threads))
+        self.assertEqual([], self.sink._threads)